@@ -9,6 +9,8 @@ from torchrec.datasets.utils import PATH_MANAGER_KEY, Batch
 from torchrec.datasets.criteo import BinaryCriteoUtils
 from torchrec.sparse.jagged_tensor import KeyedJaggedTensor
 
+from recsys.datasets.utils import BatchAssembler, batch_row_ranges, worker_shard, mmap_advise, read_ahead
+
 CAT_FEATURE_COUNT = 13
 INT_FEATURE_COUNT = 8
 DEFAULT_LABEL_NAME = "click"
@@ -46,6 +48,8 @@ class AvazuIterDataPipe(IterableDataset):
         mmap_mode: bool = False,
         hashes: Optional[List[int]] = None,
         path_manager_key: str = PATH_MANAGER_KEY,
+        pin_memory: bool = False,
+        num_buffers: int = 4,
     ) -> None:
         self.dense_paths = dense_paths
         self.sparse_paths = sparse_paths
@@ -57,6 +61,8 @@ class AvazuIterDataPipe(IterableDataset):
         self.mmap_mode = mmap_mode
         self.hashes = hashes
         self.path_manager_key = path_manager_key
+        self.pin_memory = pin_memory
+        self.num_buffers = num_buffers
 
         self._load_data_for_rank()
         self.num_rows_per_file: List[int] = [a.shape[0] for a in self.dense_arrs]
@@ -91,14 +97,19 @@ class AvazuIterDataPipe(IterableDataset):
             [self.dense_paths, self.sparse_paths, self.labels_paths],
         ):
             for idx, (range_left, range_right) in file_idx_to_row_range.items():
-                arrs.append(
-                    BinaryCriteoUtils.load_npy_range(
-                        paths[idx],
-                        range_left,
-                        range_right - range_left + 1,
-                        path_manager_key=self.path_manager_key,
-                        mmap_mode=self.mmap_mode,
-                    ).astype(_dtype))
+                arr = BinaryCriteoUtils.load_npy_range(
+                    paths[idx],
+                    range_left,
+                    range_right - range_left + 1,
+                    path_manager_key=self.path_manager_key,
+                    mmap_mode=self.mmap_mode,
+                )
+                # memory-mapped ranges keep their stored dtype, converted batch by batch
+                if self.mmap_mode:
+                    mmap_advise(arr, 'SEQUENTIAL')
+                    arrs.append(arr)
+                else:
+                    arrs.append(arr.astype(_dtype))
 
         # When mmap_mode is enabled, the hash is applied in def __iter__, which is
         # where samples are batched during training.
@@ -109,20 +120,12 @@ class AvazuIterDataPipe(IterableDataset):
             for sparse_arr in self.sparse_arrs:
                 sparse_arr %= hashes_np
 
-    def _np_arrays_to_batch(self, dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> Batch:
-        if self.shuffle_batches:
-            # Shuffle all 3 in unison
-            shuffler = np.random.permutation(len(dense))
-            dense = dense[shuffler]
-            sparse = sparse[shuffler]
-            labels = labels[shuffler]
-
+    def _tensors_to_batch(self, dense: torch.Tensor, values: torch.Tensor, labels: torch.Tensor) -> Batch:
         return Batch(
-            dense_features=torch.from_numpy(dense),
+            dense_features=dense,
             sparse_features=KeyedJaggedTensor(
                 keys=self.keys,
-        # transpose + reshape(-1) incurs an additional copy.
-                values=torch.from_numpy(sparse.transpose(1, 0).reshape(-1)),
+                values=values,
                 lengths=self.lengths,
                 offsets=self.offsets,
                 stride=self.stride,
@@ -130,57 +133,29 @@ class AvazuIterDataPipe(IterableDataset):
                 offset_per_key=self.offset_per_key,
                 index_per_key=self.index_per_key,
             ),
-            labels=torch.from_numpy(labels.reshape(-1)),
+            labels=labels,
         )
 
     def __iter__(self) -> Iterator[Batch]:
-        # Invariant: buffer never contains more than batch_size rows.
-        buffer: Optional[List[np.ndarray]] = None
-
-        def append_to_buffer(dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> None:
-            nonlocal buffer
-            if buffer is None:
-                buffer = [dense, sparse, labels]
-            else:
-                for idx, arr in enumerate([dense, sparse, labels]):
-                    buffer[idx] = np.concatenate((buffer[idx], arr))
-
-        # Maintain a buffer that can contain up to batch_size rows. Fill buffer as
-        # much as possible on each iteration. Only return a new batch when batch_size
-        # rows are filled.
-        file_idx = 0
-        row_idx = 0
-        batch_idx = 0
-        while batch_idx < self.num_batches:
-            buffer_row_count = 0 if buffer is None else buffer[0].shape[0]
-            if buffer_row_count == self.batch_size:
-                yield self._np_arrays_to_batch(*buffer)
-                batch_idx += 1
-                buffer = None
-            else:
-                rows_to_get = min(
-                    self.batch_size - buffer_row_count,
-                    self.num_rows_per_file[file_idx] - row_idx,
-                )
-                slice_ = slice(row_idx, row_idx + rows_to_get)
-
-                dense_inputs = self.dense_arrs[file_idx][slice_, :]
-                sparse_inputs = self.sparse_arrs[file_idx][slice_, :]
-                target_labels = self.labels_arrs[file_idx][slice_, :]
-
-                if self.mmap_mode and self.hashes is not None:
-                    sparse_inputs = sparse_inputs % np.array(self.hashes).reshape((1, CAT_FEATURE_COUNT))
-
-                append_to_buffer(
-                    dense_inputs,
-                    sparse_inputs,
-                    target_labels,
-                )
-                row_idx += rows_to_get
-
-                if row_idx >= self.num_rows_per_file[file_idx]:
-                    file_idx += 1
-                    row_idx = 0
+        # the rows are gathered once, shuffled and transposed, into a ring of reused batch buffers
+        # When mmap_mode is enabled, the hash is applied to the assembled batches.
+        assembler = BatchAssembler(self.batch_size,
+                                   self.dense_arrs[0].shape[1],
+                                   np.arange(CAT_FEATURE_COUNT),
+                                   shuffle=self.shuffle_batches,
+                                   num_buffers=self.num_buffers,
+                                   pin_memory=self.pin_memory,
+                                   hashes=self.hashes if self.mmap_mode else None)
+
+        # every DataLoader worker produces its own share of the batches
+        batches = batch_row_ranges(self.num_rows_per_file, self.batch_size, worker_shard(self.num_batches))
+        if self.mmap_mode:
+            batches = read_ahead(batches, (self.dense_arrs, self.sparse_arrs, self.labels_arrs))
+        for pieces in batches:
+            for file_idx, rows in pieces:
+                assembler.append(self.dense_arrs[file_idx][rows], self.sparse_arrs[file_idx][rows],
+                                 self.labels_arrs[file_idx][rows])
+            yield self._tensors_to_batch(*assembler.pop())
 
     def __len__(self) -> int:
         return self.num_batches
@@ -27,6 +27,7 @@ from torchrec.sparse.jagged_tensor import KeyedJaggedTensor
 from torchrec.datasets.utils import Batch
 from petastorm import make_batch_reader
 from pyarrow.parquet import ParquetDataset
+from recsys.datasets.utils import batch_buffers
 from .avazu import AvazuIterDataPipe
 
 STAGES = ["train", "val", "test"]
@@ -127,12 +128,16 @@ def get_avazu_data_loader(args, stage):
             rank=rank,
             world_size=world_size,
             shuffle_batches=args.shuffle_batches,
+            mmap_mode=args.mmap_mode,
             hashes=args.num_embeddings_per_feature if args.num_embeddings is None else
             ([args.num_embeddings] * CAT_FEATURE_COUNT),
+            pin_memory=args.pin_memory,
+            num_buffers=batch_buffers(args),
         ),
         batch_size=None,
         pin_memory=args.pin_memory,
         collate_fn=lambda x: x,
+        num_workers=args.num_workers,
     )
     return dataloader
 
@@ -195,6 +195,9 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
         " preloading the dataset when preloading takes too long or when there is "
         " insufficient memory available to load the full dataset.",
     )
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="DataLoader worker processes assembling the batches of the in-memory datasets, every "
+                        "worker producing every num_workers-th batch into shared memory")
     parser.add_argument(
         "--in_memory_binary_criteo_path",
         type=str,
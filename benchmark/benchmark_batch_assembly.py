@@ -0,0 +1,109 @@
+"""
+Batch assembly throughput of the in-memory datapipes, batches/s of:
+1. the former path: ``np.concatenate`` of the rows straddling files, shuffle gather, then feature-major transpose copy
+2. ``BatchAssembler``: a single gather of the rows into a ring of preallocated (pinned) buffers
+3. ``FeatureMajorBatchAssembler``: the same over feature-major sparse arrays, as converted by
+   scripts/preprocess/feature_major_criteo.py
+over synthetic arrays of the Criteo layout, split in files of --file_rows rows.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from recsys.datasets.utils import BatchAssembler, FeatureMajorBatchAssembler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="In-memory datapipe batch assembly throughput")
+    parser.add_argument("--batch_size", type=str, default="4096,16384,65536", help="comma separated batch sizes")
+    parser.add_argument("--num_rows", type=int, default=1 << 21, help="rows of the synthetic dataset")
+    parser.add_argument("--file_rows", type=int, default=100_000, help="rows per file, batches straddle files")
+    parser.add_argument("--num_dense", type=int, default=13)
+    parser.add_argument("--num_sparse", type=int, default=26)
+    parser.add_argument("--tables", type=int, default=0, help="assigned tables of a tablewise rank, all if 0")
+    parser.add_argument("--shuffle", action="store_true")
+    parser.add_argument("--pin_memory", action="store_true")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def iterate_pieces(arrays, batch_size):
+    """
+    The (file, row range) pieces of every batch, as the datapipes read them.
+    """
+    num_rows_per_file = [a.shape[0] for a in arrays[0]]
+    file_idx, row_idx = 0, 0
+    for _ in range(sum(num_rows_per_file) // batch_size):
+        pieces, missing = [], batch_size
+        while missing > 0:
+            rows = min(missing, num_rows_per_file[file_idx] - row_idx)
+            pieces.append(tuple(a[file_idx][row_idx:row_idx + rows] for a in arrays))
+            missing -= rows
+            row_idx += rows
+            if row_idx >= num_rows_per_file[file_idx]:
+                file_idx, row_idx = file_idx + 1, 0
+        yield pieces
+
+
+def concatenate_batches(arrays, batch_size, columns, shuffle):
+    for pieces in iterate_pieces(arrays, batch_size):
+        buffer = None
+        for dense, sparse, labels in pieces:
+            sparse = sparse.take(columns, -1)
+            if buffer is None:
+                buffer = [dense, sparse, labels]
+            else:
+                buffer = [np.concatenate((b, a)) for b, a in zip(buffer, (dense, sparse, labels))]
+        dense, sparse, labels = buffer
+        if shuffle:
+            shuffler = np.random.permutation(len(dense))
+            dense, sparse, labels = dense[shuffler], sparse[shuffler], labels[shuffler]
+        yield dense, sparse.transpose(1, 0).reshape(-1), labels.reshape(-1)
+
+
+def assembled_batches(arrays, batch_size, columns, shuffle, pin_memory, assembler_cls=BatchAssembler):
+    assembler = assembler_cls(batch_size, arrays[0][0].shape[1], columns, shuffle=shuffle, pin_memory=pin_memory)
+    for pieces in iterate_pieces(arrays, batch_size):
+        for dense, sparse, labels in pieces:
+            assembler.append(dense, sparse.T if assembler_cls is FeatureMajorBatchAssembler else sparse, labels)
+        yield assembler.pop()
+
+
+def batches_per_second(make_batches, repeat):
+    best = 0.
+    for _ in range(repeat):
+        start = time.perf_counter()
+        num_batches = sum(1 for _ in make_batches())
+        best = max(best, num_batches / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(0)
+    arrays = [[], [], []]
+    for lo in range(0, args.num_rows, args.file_rows):
+        rows = min(args.file_rows, args.num_rows - lo)
+        arrays[0].append(rng.random((rows, args.num_dense), dtype=np.float32))
+        arrays[1].append(rng.integers(0, 1 << 30, (rows, args.num_sparse), dtype=np.int64))
+        arrays[2].append(rng.integers(0, 2, (rows, 1), dtype=np.int32))
+    # the same ids stored feature-major, rows sliced as the row-major arrays
+    feature_major_arrays = [arrays[0], [np.ascontiguousarray(a.T).T for a in arrays[1]], arrays[2]]
+    columns = np.arange(args.tables if args.tables > 0 else args.num_sparse)
+
+    print(f"{'batch size':>10} {'concatenate':>14} {'assembler':>14} {'feature-major':>14} {'speedup':>8}")
+    for batch_size in map(int, args.batch_size.split(',')):
+        before = batches_per_second(lambda: concatenate_batches(arrays, batch_size, columns, args.shuffle),
+                                    args.repeat)
+        after = batches_per_second(
+            lambda: assembled_batches(arrays, batch_size, columns, args.shuffle, args.pin_memory), args.repeat)
+        feature_major = batches_per_second(
+            lambda: assembled_batches(feature_major_arrays, batch_size, columns, args.shuffle, args.pin_memory,
+                                      FeatureMajorBatchAssembler), args.repeat)
+        print(f"{batch_size:>10} {before:>10.1f} b/s {after:>10.1f} b/s {feature_major:>10.1f} b/s "
+              f"{max(after, feature_major) / before:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
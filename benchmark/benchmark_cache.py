@@ -15,6 +15,8 @@ from torch.profiler import profile, ProfilerActivity, schedule, tensorboard_trac
 
 from colossalai.nn.parallel.layers import FreqAwareEmbeddingBag, EvictionStrategy
 from recsys.datasets.criteo import get_id_freq_map
+from recsys.datasets.id_trace import IdTraceReader
+from recsys.datasets.id_remap import is_rank_space
 from data_utils import get_dataloader, NUM_EMBED, CRITEO_PATH
 
 
@@ -24,13 +26,17 @@ def benchmark_cache_embedding(batch_size,
                               id_freq_map=None,
                               warmup_ratio=0.,
                               use_limit_buf=True,
-                              use_lfu=False):
-    dataloader = get_dataloader('train', batch_size)
+                              use_lfu=False,
+                              trace=None):
+    """
+    With ``trace``, the batches are replayed from that id trace instead of the Criteo npy files.
+    """
+    dataloader = get_dataloader('train', batch_size) if trace is None else IdTraceReader(trace)
+    data_iter = iter(dataloader)
     cuda_row_num = int(cache_ratio * NUM_EMBED)
     print(f"batch size: {batch_size}, "
           f"num of batches: {len(dataloader)}, "
           f"cached rows: {cuda_row_num},  cached_ratio {cuda_row_num / NUM_EMBED}")
-    data_iter = iter(dataloader)
 
     buf_size = 0
     if use_limit_buf:
@@ -62,9 +68,13 @@ def benchmark_cache_embedding(batch_size,
             with nullcontext():
                 for it in itertools.count():
                     batch = next(data_iter)
-                    sparse_feature = batch.sparse_features.to(device)
+                    if trace is None:
+                        sparse_feature = batch.sparse_features.to(device)
+                        ids, offsets = sparse_feature.values(), sparse_feature.offsets()
+                    else:
+                        ids, offsets = (torch.from_numpy(x).to(device) for x in batch[:2])
 
-                    res = model(sparse_feature.values(), sparse_feature.offsets())
+                    res = model(ids, offsets)
 
                     grad = torch.randn_like(res) if grad is None else grad
                     res.backward(grad)
@@ -91,11 +101,13 @@ def benchmark_cache_embedding(batch_size,
         f'training max_memory_allocated {torch.cuda.max_memory_allocated()/1e9} GB, max_memory_reserved {torch.cuda.max_memory_allocated()/1e9} GB'
     )
     print(f'overall training time {timer.elapsed:.2f}s')
+    return avg_hit_rate
 
 
 if __name__ == "__main__":
     with Timer() as timer:
-        id_freq_map = get_id_freq_map(CRITEO_PATH)
+        # frequency-ranked ids need no map, the dataset eviction order is the id order
+        id_freq_map = None if is_rank_space(CRITEO_PATH) else get_id_freq_map(CRITEO_PATH)
     print(f"Counting sparse features in dataset costs: {timer.elapsed:.2f} s")
 
     batch_size = [2048]
@@ -0,0 +1,59 @@
+"""
+Exact vs. sketched id-frequency map on Criteo Kaggle:
+1. counting time and memory of the counter
+2. overlap of the hottest ids
+3. cache hit rate when the map drives the warmup and the DATASET eviction strategy
+"""
+import os
+
+import numpy as np
+import torch
+from contexttimer import Timer
+
+from recsys.datasets import criteo
+from recsys.datasets.feature_counter import GlobalFeatureCounter, SketchFeatureCounter
+from benchmark_cache import benchmark_cache_embedding
+from data_utils import CRITEO_PATH
+
+BATCH_SIZE = 2048
+EMBED_DIM = 32
+CACHE_RATIO = 0.02
+WARMUP_RATIO = 0.7
+SKETCH_CAPACITY = [100_000, 1_000_000]
+
+
+def main():
+    hash_sizes = list(map(int, criteo.KAGGLE_NUM_EMBEDDINGS_PER_FEATURE.split(',')))
+    sparse_files = [os.path.join(CRITEO_PATH, _f) for _f in os.listdir(CRITEO_PATH) if 'sparse' in _f]
+
+    with Timer() as timer:
+        exact = GlobalFeatureCounter(sparse_files, hash_sizes).compute()
+    print(f"exact counter: {timer.elapsed:.2f}s, histogram {exact.nbytes / 1024**2:.2f} MB")
+    exact_order = np.argsort(exact, kind='stable')[::-1]
+
+    hit_rates = {'exact': benchmark_cache_embedding(BATCH_SIZE,
+                                                    EMBED_DIM,
+                                                    cache_ratio=CACHE_RATIO,
+                                                    id_freq_map=torch.from_numpy(exact),
+                                                    warmup_ratio=WARMUP_RATIO)}
+    for capacity in SKETCH_CAPACITY:
+        counter = SketchFeatureCounter(sparse_files, hash_sizes, capacity=capacity)
+        with Timer() as timer:
+            cms, heavy_hitters = counter.sketch()
+        ids, _ = counter.top_ids()
+        overlap = np.intersect1d(ids, exact_order[:capacity]).shape[0] / capacity
+        print(f"sketch counter (capacity {capacity}): {timer.elapsed:.2f}s, "
+              f"count-min {cms.nbytes / 1024**2:.2f} MB, heavy hitters {heavy_hitters.nbytes / 1024**2:.2f} MB, "
+              f"top-{capacity} overlap with exact {overlap * 100:.2f}%")
+        hit_rates[f'sketch-{capacity}'] = benchmark_cache_embedding(BATCH_SIZE,
+                                                                    EMBED_DIM,
+                                                                    cache_ratio=CACHE_RATIO,
+                                                                    id_freq_map=torch.from_numpy(counter.compute()),
+                                                                    warmup_ratio=WARMUP_RATIO)
+
+    for name, hit_rate in hit_rates.items():
+        print(f"{name}: average hit rate {hit_rate * 100:.2f}%")
+
+
+if __name__ == "__main__":
+    main()
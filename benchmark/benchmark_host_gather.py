@@ -0,0 +1,73 @@
+"""
+Host table row gather / scatter bandwidth, single ``index_select`` / ``index_copy_`` vs. ``HostRowEngine``:
+1. gather of random unique rows into a (pinned) staging buffer, unsorted and sorted as the cache passes them
+2. scatter of random unique rows back into the table
+for tables of the Criteo Kaggle and Terabyte sizes. The full Terabyte table takes ~91 GB at dimension 128, use
+--scale to benchmark a fraction of it.
+"""
+import argparse
+import time
+
+import torch
+
+from recsys.cache import HostRowEngine
+from recsys.datasets import criteo
+
+TABLES = {
+    'kaggle': sum(map(int, criteo.KAGGLE_NUM_EMBEDDINGS_PER_FEATURE.split(','))),
+    'terabyte': sum(map(int, criteo.NUM_EMBEDDINGS_PER_FEATURE.split(','))),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Host table row gather / scatter bandwidth")
+    parser.add_argument("--tables", type=str, default="kaggle,terabyte", help="comma separated subset of "
+                        f"{' | '.join(TABLES)}")
+    parser.add_argument("--scale", type=float, default=1., help="fraction of the table rows allocated")
+    parser.add_argument("--embedding_dim", type=int, default=128)
+    parser.add_argument("--num_rows", type=str, default="16384,65536,262144",
+                        help="comma separated numbers of rows per call")
+    parser.add_argument("--threads", type=str, default="4,8,16", help="comma separated engine thread counts")
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser.parse_args()
+
+
+def bandwidth(fn, num_bytes, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return num_bytes * repeat / (time.perf_counter() - start) / 1e9
+
+
+def main():
+    args = parse_args()
+    pin = torch.cuda.is_available()
+    for table in args.tables.split(","):
+        num_embeddings = int(TABLES[table] * args.scale)
+        weight = torch.empty(num_embeddings, args.embedding_dim).uniform_(-1., 1.)
+        print(f"{table}: {num_embeddings:,} rows, {weight.numel() * weight.element_size() / 1024**3:.2f} GB, "
+              f"pinned staging: {pin}")
+        for num_rows in map(int, args.num_rows.split(",")):
+            rows = torch.randperm(num_embeddings)[:num_rows]
+            sorted_rows = torch.sort(rows).values
+            staging = torch.empty(num_rows, args.embedding_dim, pin_memory=pin)
+            values = torch.randn(num_rows, args.embedding_dim)
+            num_bytes = num_rows * args.embedding_dim * weight.element_size()
+
+            gather = bandwidth(lambda: torch.index_select(weight, 0, rows, out=staging), num_bytes, args.repeat)
+            scatter = bandwidth(lambda: weight.index_copy_(0, rows, values), num_bytes, args.repeat)
+            print(f"  {num_rows:>8,} rows   single call: gather {gather:6.2f} GB/s, scatter {scatter:6.2f} GB/s")
+            for num_threads in map(int, args.threads.split(",")):
+                engine = HostRowEngine(weight, num_threads)
+                gather = bandwidth(lambda: engine.gather(rows, staging, unique=True), num_bytes, args.repeat)
+                gather_sorted = bandwidth(lambda: engine.gather(sorted_rows, staging), num_bytes, args.repeat)
+                scatter = bandwidth(lambda: engine.scatter(sorted_rows, values), num_bytes, args.repeat)
+                print(f"  {num_rows:>8,} rows {num_threads:>3} threads: gather {gather:6.2f} GB/s, "
+                      f"sorted {gather_sorted:6.2f} GB/s, scatter {scatter:6.2f} GB/s")
+                engine.close()
+        del weight
+
+
+if __name__ == "__main__":
+    main()
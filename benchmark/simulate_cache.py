@@ -0,0 +1,110 @@
+"""
+Offline cache simulator: replays the training id stream (or a recorded id trace) through a model of the
+software cache for a grid of cache sizes and eviction policies, on CPU and without embedding weights.
+Reports per configuration:
+1. hit rate (the miss-ratio curve over the cache sizes)
+2. rows swapped in / out and the bytes moved
+3. projected transfer time from the host <-> device bandwidth
+
+Every simulator keeps a row -> slot map of the full table (and a ghost map for arc / 2q), so the grid size is
+bounded by host memory rather than by time.
+"""
+import argparse
+import itertools
+
+from contexttimer import Timer
+
+from recsys.cache import CacheSimulator, simulate
+from recsys.datasets import criteo, avazu
+from recsys.datasets.id_trace import IdTraceReader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Trace-driven software cache simulator")
+    parser.add_argument("--dataset_dir", type=str, required=True,
+                        help="criteo kaggle / terabyte or avazu dataset, as for dlrm_main, which also selects the "
+                        "table sizes when replaying a trace")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="replay this id trace (see --record_trace of dlrm_main) instead of the dataset")
+    parser.add_argument("--batch_size", type=int, default=16384)
+    parser.add_argument("--num_batches", type=int, default=None, help="replay only the first batches")
+    parser.add_argument("--shuffle_batches", action='store_true')
+    parser.add_argument("--shuffle_block_rows", type=int, default=0,
+                        help="read the dataset by blocks of rows in a random order through a shuffle buffer")
+    parser.add_argument("--shuffle_buffer_rows", type=int, default=1 << 20)
+    parser.add_argument("--seed", type=int, default=1024)
+    parser.add_argument("--cache_ratio", type=str, default="0.005,0.01,0.02,0.05,0.1",
+                        help="comma separated cache ratios of the grid")
+    parser.add_argument("--eviction_policy", type=str, default="dataset,lfu,lru,decayed_lfu,arc,2q",
+                        help="comma separated eviction policies of the grid")
+    parser.add_argument("--admission_filter", type=str, default='none', choices=['none', 'tinylfu'])
+    parser.add_argument("--use_freq", action='store_true',
+                        help="use the dataset freq information for the warmup and the dataset policy")
+    parser.add_argument("--warmup_ratio", type=float, default=0.7)
+    parser.add_argument("--buffer_size", type=int, default=0, help="rows per transfer, 0 for unlimited")
+    parser.add_argument("--prefetch_num", type=int, default=1, help="batches admitted per cache step")
+    parser.add_argument("--embedding_dim", type=int, default=128)
+    parser.add_argument("--element_size", type=int, default=4, help="bytes per element of the cache")
+    parser.add_argument("--bandwidth", type=float, default=12., help="host <-> device bandwidth in GB/s")
+    parser.add_argument("--latency", type=float, default=10., help="fixed cost of a transfer in us")
+    parser.add_argument("--num_workers", type=int, default=0, help="dataloader worker processes")
+    parser.add_argument("--mmap_mode", action='store_true', help="memory-map the dataset instead of loading it")
+    args = parser.parse_args()
+
+    args.pin_memory = False
+    if 'criteo' in args.dataset_dir:
+        args.data_module = criteo
+        num_embeddings_per_feature = criteo.KAGGLE_NUM_EMBEDDINGS_PER_FEATURE if 'kaggle' in args.dataset_dir \
+            else criteo.NUM_EMBEDDINGS_PER_FEATURE
+    else:
+        args.data_module = avazu
+        num_embeddings_per_feature = avazu.NUM_EMBEDDINGS_PER_FEATURE
+    args.num_embeddings_per_feature = list(map(int, num_embeddings_per_feature.split(",")))
+    return args
+
+
+def id_stream(args):
+    if args.trace is not None:
+        yield from IdTraceReader(args.trace).id_batches()
+        return
+    dataloader = args.data_module.get_dataloader(args, 'train', 0, 1)
+    for batch in dataloader:
+        yield batch.sparse_features.values()
+
+
+def main():
+    args = parse_args()
+    num_embeddings = sum(args.num_embeddings_per_feature)
+
+    id_freq_map = None
+    if args.use_freq:
+        with Timer() as timer:
+            id_freq_map = args.data_module.get_id_freq_map(args.dataset_dir)
+        print(f"id frequency map: {timer.elapsed:.2f}s")
+
+    cache_ratios = list(map(float, args.cache_ratio.split(",")))
+    policies = args.eviction_policy.split(",")
+    simulators = [
+        CacheSimulator(num_embeddings,
+                       int(ratio * num_embeddings),
+                       policy=policy,
+                       embedding_dim=args.embedding_dim,
+                       element_size=args.element_size,
+                       ids_freq_mapping=id_freq_map,
+                       warmup_ratio=args.warmup_ratio,
+                       buffer_size=args.buffer_size,
+                       admission=args.admission_filter,
+                       bandwidth=args.bandwidth * 1e9,
+                       latency=args.latency * 1e-6) for policy, ratio in itertools.product(policies, cache_ratios)
+    ]
+
+    with Timer() as timer:
+        results = simulate(id_stream(args), simulators, prefetch_num=args.prefetch_num, num_batches=args.num_batches)
+    print(f"simulated {len(simulators)} configurations over {results[0].num_steps} cache steps "
+          f"in {timer.elapsed:.2f}s")
+    for result in results:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
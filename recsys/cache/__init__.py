@@ -0,0 +1,26 @@
+from .admission import AdmissionFilter, TinyLFUFilter, ADMISSION_FILTERS, build_admission_filter
+from .base import CacheBackend, format_cache_stats
+from .policy import EvictionPolicy, LFUPolicy, DatasetPolicy, LRUPolicy, DecayedLFUPolicy, ARCPolicy, TwoQPolicy, \
+    EVICTION_POLICIES, build_eviction_policy
+from .index import CacheIndex, SwapPlan
+from .embedding import CachedEmbeddingBag
+from .registry import CACHE_BACKENDS, register_cache_backend, build_cache_backend
+from .simulator import CacheSimulator, SimulationResult, simulate
+from .prefetch import LookaheadPrefetcher
+from .host_rows import HostRowEngine
+from .transfer import TransferMetrics, TransferWorker
+from .mmap_store import MmapRowStore, frequency_order
+from .precision import CACHE_DTYPES, cache_dtype, stochastic_round, StochasticRoundingSGD
+from .quantized_store import HOST_QUANTIZATIONS, QuantizedRowStore
+from .sizing import cache_rows_for_budget
+from .resident import ResidentSplitEmbeddingBag
+
+__all__ = [
+    'AdmissionFilter', 'TinyLFUFilter', 'ADMISSION_FILTERS', 'build_admission_filter', 'CacheBackend',
+    'format_cache_stats', 'EvictionPolicy', 'LFUPolicy', 'DatasetPolicy', 'LRUPolicy', 'DecayedLFUPolicy', 'ARCPolicy',
+    'TwoQPolicy', 'EVICTION_POLICIES', 'build_eviction_policy', 'CacheIndex', 'SwapPlan', 'CachedEmbeddingBag',
+    'CACHE_BACKENDS', 'register_cache_backend', 'build_cache_backend', 'CacheSimulator', 'SimulationResult', 'simulate',
+    'LookaheadPrefetcher', 'HostRowEngine', 'TransferMetrics', 'TransferWorker', 'MmapRowStore', 'frequency_order',
+    'CACHE_DTYPES', 'cache_dtype', 'stochastic_round', 'StochasticRoundingSGD', 'HOST_QUANTIZATIONS',
+    'QuantizedRowStore', 'cache_rows_for_budget', 'ResidentSplitEmbeddingBag'
+]
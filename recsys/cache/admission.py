@@ -0,0 +1,118 @@
+import math
+from typing import Optional
+
+import torch
+
+# odd multipliers of the multiply-shift hashes are drawn from this generator seed unless given
+_DEFAULT_SEED = 1024
+
+
+class AdmissionFilter:
+    """
+    Decides whether a missed row deserves a cache slot more than the row it would evict.
+
+    :class:`recsys.cache.index.CacheIndex` reports every batch through :meth:`record` and, when the cache is full,
+    compares :meth:`estimate` of the missed rows against the estimates of the policy's victims.
+    """
+
+    def record(self, rows: torch.Tensor, counts: torch.Tensor) -> None:
+        """
+        ``rows`` (unique) were referenced ``counts`` times by the current batch.
+        """
+        raise NotImplementedError()
+
+    def estimate(self, rows: torch.Tensor) -> torch.Tensor:
+        """
+        Estimated recent reference count of every row.
+        """
+        raise NotImplementedError()
+
+
+class _MultiplyShiftHash:
+    """
+    ``depth`` multiply-shift hashes of int64 keys into ``[0, 2 ** log_width)``, relying on the wrapping int64
+    multiplication of PyTorch.
+    """
+
+    def __init__(self, depth: int, log_width: int, device: torch.device, seed: int):
+        generator = torch.Generator().manual_seed(seed)
+        self.a = (torch.randint(0, 2**62, (depth, 1), generator=generator) * 2 + 1).to(device)
+        self.b = torch.randint(0, 2**62, (depth, 1), generator=generator).to(device)
+        self.shift = 64 - log_width
+        self.mask = (1 << log_width) - 1
+
+    def __call__(self, keys: torch.Tensor) -> torch.Tensor:
+        return ((self.a * keys.view(1, -1) + self.b) >> self.shift) & self.mask
+
+
+class TinyLFUFilter(AdmissionFilter):
+    """
+    TinyLFU admission: a Bloom filter doorkeeper absorbs the first reference of every row, so one-hit wonders
+    never reach the Count-Min sketch counting the later references. The estimate of a row is its sketch count
+    plus its doorkeeper bit. After ``sample_ratio * cache_rows`` references the sketch is halved and the
+    doorkeeper cleared, so the estimates follow the recent popularity.
+
+    Args:
+        cache_rows (int): number of cache slots, which sizes the sample and the sketch.
+        device (torch.device): where the filter lives, normally the cache device.
+        sample_ratio (int): sample size relative to the cache.
+        depth (int): number of hash functions of the sketch and of the doorkeeper.
+        seed (int): seed of the hash functions.
+    """
+
+    def __init__(self,
+                 cache_rows: int,
+                 device: torch.device,
+                 sample_ratio: int = 10,
+                 depth: int = 4,
+                 seed: int = _DEFAULT_SEED):
+        self.device = device
+        self.sample_size = sample_ratio * cache_rows
+        sketch_log_width = max(1, math.ceil(math.log2(max(cache_rows, 2))))
+        doorkeeper_log_width = max(1, math.ceil(math.log2(max(self.sample_size, 2))))
+        self._sketch_hash = _MultiplyShiftHash(depth, sketch_log_width, device, seed)
+        self._doorkeeper_hash = _MultiplyShiftHash(depth, doorkeeper_log_width, device, seed + 1)
+        self.sketch = torch.zeros(depth, 1 << sketch_log_width, dtype=torch.int32, device=device)
+        self.doorkeeper = torch.zeros(1 << doorkeeper_log_width, dtype=torch.bool, device=device)
+        self.num_recorded = 0
+
+    def _in_doorkeeper(self, rows):
+        return self.doorkeeper[self._doorkeeper_hash(rows)].all(dim=0)
+
+    def _sketch_estimate(self, rows):
+        return torch.gather(self.sketch, 1, self._sketch_hash(rows)).min(dim=0).values
+
+    def record(self, rows, counts):
+        rows = rows.to(self.device)
+        counts = counts.to(device=self.device, dtype=torch.int32)
+        self.num_recorded += int(counts.sum())
+        # the first reference of a row unknown to the doorkeeper only sets its bits
+        counts = counts - (~self._in_doorkeeper(rows)).int()
+        self.doorkeeper[self._doorkeeper_hash(rows).view(-1)] = True
+        for row, idx in zip(self.sketch, self._sketch_hash(rows)):
+            row.index_add_(0, idx, counts)
+
+        if self.num_recorded >= self.sample_size:
+            self.sketch.div_(2, rounding_mode='floor')
+            self.doorkeeper.zero_()
+            self.num_recorded = 0
+
+    def estimate(self, rows):
+        rows = rows.to(self.device)
+        return self._sketch_estimate(rows) + self._in_doorkeeper(rows).int()
+
+
+ADMISSION_FILTERS = {
+    'tinylfu': TinyLFUFilter,
+}
+
+
+def build_admission_filter(name: Optional[str], cache_rows: int, device: torch.device) -> Optional[AdmissionFilter]:
+    """
+    Build the admission filter ``name`` of :data:`ADMISSION_FILTERS`, or None to admit every missed row.
+    """
+    if name is None or name == 'none':
+        return None
+    if name not in ADMISSION_FILTERS:
+        raise ValueError(f"Unsupported admission filter {name}, must be one of {' | '.join(ADMISSION_FILTERS)}")
+    return ADMISSION_FILTERS[name](cache_rows, device)
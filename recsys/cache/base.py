@@ -0,0 +1,109 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Optional
+
+import torch
+
+
+class CacheBackend(ABC):
+    """
+    Interface of the software-cached embedding bags selectable in ``FusedSparseModules``.
+
+    A backend keeps the full embedding table in a slow tier (host memory) and a subset of its rows in a cache on
+    the compute device. Ids are first translated into cache slots by :meth:`prepare_ids`, which swaps the missing
+    rows in, and the embedding bag is then computed over the cache by :meth:`lookup`.
+
+    Backends with ``supports_pinning`` can keep the rows of several prepared batches resident at once, which the
+    lookahead prefetcher of ``recsys.cache.prefetch`` relies on.
+    """
+
+    feature_major_output = True
+    supports_pinning = False
+
+    @abstractmethod
+    def prepare_ids(self, ids: torch.Tensor, pin: bool = False) -> torch.Tensor:
+        """
+        Make every row referenced by ``ids`` resident in the cache. With ``pin`` the rows stay resident until the
+        returned slots are given to :meth:`unpin`, only backends with ``supports_pinning`` accept it.
+
+        Returns:
+            torch.Tensor: the cache slot of each id, same shape as ``ids``.
+        """
+
+    @abstractmethod
+    def lookup(self,
+               ids: torch.Tensor,
+               offsets: torch.Tensor,
+               per_sample_weights: Optional[torch.Tensor] = None,
+               shape_hook: Optional[Callable] = None,
+               cache_op: bool = True) -> torch.Tensor:
+        """
+        Embedding bag over ``ids``. With ``cache_op=False`` the ids are taken as cache slots returned by an
+        earlier :meth:`prepare_ids`.
+        """
+
+    @abstractmethod
+    def flush(self) -> None:
+        """
+        Write every cached row back to the slow tier.
+        """
+
+    @abstractmethod
+    def stats(self) -> Dict[str, float]:
+        """
+        Cumulative cache statistics: ``hits``, ``misses``, ``hit_rate``, ``swap_in_rows``, ``swap_out_rows``,
+        ``swap_in_bytes`` and ``swap_out_bytes``, the bytes copied between the host and the device.
+        """
+
+    @abstractmethod
+    def element_size(self) -> float:
+        """
+        Bytes per element of the embedding weight, fractional for a quantized host table.
+        """
+
+    def unpin(self, slots: torch.Tensor) -> None:
+        """
+        Release the slots returned by a ``prepare_ids(ids, pin=True)`` call.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support pinning cache rows")
+
+    def readahead(self, ids: torch.Tensor) -> None:
+        """
+        Hint that ``ids`` will be prepared soon, backends with a slow host tier may start reading their rows.
+        """
+
+    def set_async_copy(self, enable: bool) -> None:
+        """
+        Toggle asynchronous host <-> device row transfers, if the backend supports them.
+        """
+
+    def refresh_eviction_ranking(self, freq: torch.Tensor) -> None:
+        """
+        Rank the cached rows for eviction by ``freq`` (indexed by id) instead of the counts gathered so far.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support refreshing the eviction ranking")
+
+
+def format_cache_stats(stats: Dict[str, float]) -> str:
+    stat_str = f"hit rate: {stats['hit_rate'] * 100:.2f}%, " \
+               f"swap in: {stats['swap_in_rows']:,} rows / {stats['swap_in_bytes'] / 1024**3:.2f} GB, " \
+               f"swap out: {stats['swap_out_rows']:,} rows / {stats['swap_out_bytes'] / 1024**3:.2f} GB"
+    if stats.get('rejected', 0) > 0:
+        stat_str += f", admitted: {stats['admitted']:,} rows, rejected: {stats['rejected']:,} rows, " \
+                    f"bypassed: {stats['bypassed']:,} rows"
+    if 'host_block_hits' in stats:
+        blocks = stats['host_block_hits'] + stats['host_block_misses']
+        stat_str += f", host block hit rate: {stats['host_block_hits'] / max(blocks, 1) * 100:.2f}%, " \
+                    f"uncached host rows: {stats['host_direct_rows']:,}"
+    if 'host_quantized_rows' in stats:
+        stat_str += f", quantized host table: {stats['host_table_bytes'] / 1024**3:.2f} GB " \
+                    f"(fp32: {stats['host_fp32_table_bytes'] / 1024**3:.2f} GB), " \
+                    f"rows requantized: {stats['host_quantized_rows']:,}"
+    if stats.get('transfer_jobs', 0) > 0:
+        busy = stats['transfer_busy_time']
+        stat_str += f", async transfers: {stats['transfer_jobs']:,} jobs, " \
+                    f"queue depth {stats['transfer_mean_queue_depth']:.2f} " \
+                    f"(max {stats['transfer_max_queue_depth']}), " \
+                    f"gather {stats['transfer_gather_time']:.2f}s, copy {stats['transfer_copy_time']:.2f}s, " \
+                    f"write back {stats['transfer_write_back_time']:.2f}s, " \
+                    f"overlapped {(1 - stats['transfer_wait_time'] / busy) * 100 if busy > 0 else 0:.1f}%"
+    return stat_str
@@ -0,0 +1,217 @@
+import itertools
+from typing import Callable, Dict, Optional
+
+import torch
+from colossalai.nn.parallel.layers import ParallelFreqAwareEmbeddingBag, EvictionStrategy, \
+    ParallelFreqAwareEmbeddingBagTablewise
+
+from .base import CacheBackend
+from .sizing import cache_rows_for_budget
+from ..utils import prepare_tablewise_config, get_tablewise_rank_arrange
+
+_EVICTION_STRATEGIES = {
+    'lfu': EvictionStrategy.LFU,
+    'dataset': EvictionStrategy.DATASET,
+}
+
+
+def _eviction_strategy(name):
+    if isinstance(name, (list, tuple)):
+        if len(set(name)) != 1:
+            raise ValueError("The colossalai cache backend uses the same eviction strategy for every table")
+        name = name[0]
+    if name not in _EVICTION_STRATEGIES:
+        raise ValueError(f"The colossalai cache backend only supports the {' | '.join(_EVICTION_STRATEGIES)} "
+                         f"eviction strategies, got {name}")
+    return _EVICTION_STRATEGIES[name]
+
+
+def _cache_stats(hits_history, miss_history, swap_in_numel, swap_out_numel, row_numel, element_size):
+    hits, misses = sum(hits_history), sum(miss_history)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / max(hits + misses, 1),
+        'swap_in_rows': swap_in_numel // max(row_numel, 1),
+        'swap_out_rows': swap_out_numel // max(row_numel, 1),
+        'swap_in_bytes': swap_in_numel * element_size,
+        'swap_out_bytes': swap_out_numel * element_size,
+    }
+
+
+class ColossalAICachedEmbeddingBag(ParallelFreqAwareEmbeddingBag, CacheBackend):
+    """
+    ``ParallelFreqAwareEmbeddingBag`` of ColossalAI behind the :class:`CacheBackend` interface.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ColossalAICachedEmbeddingBag, self).__init__(*args, **kwargs)
+        # lazily built inverse of the cache's id -> cpu row reorder mapping
+        self._cpu_row_to_id = None
+
+    def prepare_ids(self, ids: torch.Tensor, pin: bool = False) -> torch.Tensor:
+        if pin:
+            raise NotImplementedError("The colossalai cache backend does not support pinning cache rows")
+        return self.cache_weight_mgr.prepare_ids(ids)
+
+    def lookup(self,
+               ids: torch.Tensor,
+               offsets: torch.Tensor,
+               per_sample_weights: Optional[torch.Tensor] = None,
+               shape_hook: Optional[Callable] = None,
+               cache_op: bool = True) -> torch.Tensor:
+        self.set_cache_op(cache_op)
+        return self(ids, offsets, per_sample_weights, shape_hook=shape_hook)
+
+    def flush(self) -> None:
+        self.cache_weight_mgr.flush()
+
+    def stats(self) -> Dict[str, float]:
+        mgr = self.cache_weight_mgr
+        return _cache_stats(mgr.num_hits_history, mgr.num_miss_history, getattr(mgr, '_cpu_to_cuda_numel', 0),
+                            getattr(mgr, '_cuda_to_cpu_numel', 0), self.embedding_dim, self.element_size())
+
+    def set_async_copy(self, enable: bool) -> None:
+        self.set_cache_mgr_async_copy(enable)
+
+    @torch.no_grad()
+    def refresh_eviction_ranking(self, freq: torch.Tensor) -> None:
+        """
+        Overwrite the LFU counters of the currently cached rows with ``freq`` (indexed by id), e.g. a
+        ``DecayedFrequency`` snapshot, so the eviction follows the recent id popularity instead of the counts
+        accumulated since warmup.
+        """
+        mgr = self.cache_weight_mgr
+        if mgr._evict_strategy != EvictionStrategy.LFU:
+            raise RuntimeError("Refreshing the eviction ranking requires the LFU eviction strategy")
+        if self._cpu_row_to_id is None:
+            idx_map = mgr.idx_map.to(freq.device)
+            self._cpu_row_to_id = torch.empty_like(idx_map)
+            self._cpu_row_to_id[idx_map] = torch.arange(idx_map.shape[0], device=freq.device)
+
+        cached_rows = mgr.cached_idx_map.to(freq.device)
+        slots = torch.nonzero(cached_rows >= 0).view(-1)
+        ids = self._cpu_row_to_id.index_select(0, cached_rows.index_select(0, slots))
+        counts = freq.index_select(0, ids).round_().to(mgr.freq_cnter.dtype)
+        mgr.freq_cnter.index_copy_(0, slots.to(mgr.freq_cnter.device), counts.to(mgr.freq_cnter.device))
+
+
+class ColossalAICachedEmbeddingBagTablewise(ParallelFreqAwareEmbeddingBagTablewise, CacheBackend):
+    """
+    ``ParallelFreqAwareEmbeddingBagTablewise`` of ColossalAI behind the :class:`CacheBackend` interface, every
+    table keeps its own cache manager.
+    """
+
+    feature_major_output = False
+
+    def _managers(self):
+        return [bag.cache_weight_mgr for bag in self.cached_embedding_bag_list]
+
+    def prepare_ids(self, ids: torch.Tensor, pin: bool = False) -> torch.Tensor:
+        raise NotImplementedError("The tablewise colossalai backend prepares the ids inside its forward pass")
+
+    def lookup(self,
+               ids: torch.Tensor,
+               offsets: torch.Tensor,
+               per_sample_weights: Optional[torch.Tensor] = None,
+               shape_hook: Optional[Callable] = None,
+               cache_op: bool = True) -> torch.Tensor:
+        self.set_cache_op(cache_op)
+        return self(ids, offsets, per_sample_weights, shape_hook=shape_hook)
+
+    def flush(self) -> None:
+        for mgr in self._managers():
+            mgr.flush()
+
+    def stats(self) -> Dict[str, float]:
+        managers = self._managers()
+        return _cache_stats([h for mgr in managers for h in mgr.num_hits_history],
+                            [m for mgr in managers for m in mgr.num_miss_history],
+                            sum(getattr(mgr, '_cpu_to_cuda_numel', 0) for mgr in managers),
+                            sum(getattr(mgr, '_cuda_to_cpu_numel', 0) for mgr in managers), self.embedding_dim,
+                            self.element_size())
+
+    def set_async_copy(self, enable: bool) -> None:
+        self.set_cache_mgr_async_copy(enable)
+
+
+def build_colossalai_backend(num_embeddings_per_feature,
+                             embedding_dim,
+                             sparse=False,
+                             mode='sum',
+                             cache_ratio=0.01,
+                             id_freq_map=None,
+                             warmup_ratio=0.7,
+                             buffer_size=50_000,
+                             evict_strategy='dataset',
+                             tablewise=False,
+                             dataset=None,
+                             device=None,
+                             admission=None,
+                             bypass_ratio=0.1,
+                             numa_policy='none',
+                             host_table_file=None,
+                             host_cache_bytes=1 << 30,
+                             cache_dtype=None,
+                             host_quantization=None,
+                             cache_budget_bytes=None,
+                             min_cache_rows=0):
+    if admission is not None and admission != 'none':
+        raise NotImplementedError("The colossalai cache backend does not support admission filters")
+    if numa_policy == 'shard':
+        # bind and interleave apply to the whole process, see recsys.utils.numa.set_process_numa_policy
+        raise NotImplementedError("The colossalai cache backend does not support sharding its table over NUMA nodes")
+    if host_table_file is not None:
+        raise NotImplementedError("The colossalai cache backend keeps its host table in memory")
+    if cache_dtype not in (None, 'fp32'):
+        raise NotImplementedError("The colossalai cache backend only caches fp32 rows")
+    if host_quantization not in (None, 'none'):
+        raise NotImplementedError("The colossalai cache backend does not quantize its host table")
+    if tablewise:
+        world_size = torch.distributed.get_world_size()
+        cuda_row_nums = None
+        if cache_budget_bytes is not None:
+            # every rank caches its own tables within the budget
+            rank_arrange = get_tablewise_rank_arrange(dataset, world_size)
+            offsets = [0, *itertools.accumulate(num_embeddings_per_feature)]
+            cuda_row_nums = [0] * len(num_embeddings_per_feature)
+            for rank in range(world_size):
+                tables = [t for t, r in enumerate(rank_arrange) if r == rank]
+                if not tables:
+                    continue
+                freq = None if id_freq_map is None else \
+                    torch.cat([id_freq_map[offsets[t]:offsets[t + 1]] for t in tables])
+                rows = cache_rows_for_budget([num_embeddings_per_feature[t] for t in tables], embedding_dim * 4,
+                                             cache_budget_bytes, freq, min_rows=min_cache_rows)
+                for t, r in zip(tables, rows):
+                    cuda_row_nums[t] = r
+        embedding_bag_config_list = prepare_tablewise_config(num_embeddings_per_feature, 0.01, id_freq_map, dataset,
+                                                             world_size, cuda_row_nums=cuda_row_nums)
+        return ColossalAICachedEmbeddingBagTablewise(
+            embedding_bag_config_list,
+            embedding_dim,
+            sparse=sparse,
+            mode=mode,
+            include_last_offset=True,
+            warmup_ratio=warmup_ratio,
+            buffer_size=buffer_size,
+            evict_strategy=_eviction_strategy(evict_strategy),
+        )
+    if cache_budget_bytes is not None:
+        # the columns of every row are split over the ranks, the budget holds as many rows as a single cache
+        row_bytes = -(-embedding_dim // torch.distributed.get_world_size()) * 4
+        cache_rows = cache_rows_for_budget(num_embeddings_per_feature, row_bytes, cache_budget_bytes, id_freq_map,
+                                           min_rows=min_cache_rows)
+        cache_ratio = sum(cache_rows) / sum(num_embeddings_per_feature)
+    return ColossalAICachedEmbeddingBag(
+        sum(num_embeddings_per_feature),
+        embedding_dim,
+        sparse=sparse,
+        mode=mode,
+        include_last_offset=True,
+        cache_ratio=cache_ratio,
+        ids_freq_mapping=id_freq_map,
+        warmup_ratio=warmup_ratio,
+        buffer_size=buffer_size,
+        evict_strategy=_eviction_strategy(evict_strategy),
+    )
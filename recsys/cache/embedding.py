@@ -0,0 +1,500 @@
+import itertools
+import math
+from typing import Callable, Dict, List, Optional, Union
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.profiler import record_function
+
+from .admission import build_admission_filter
+from .base import CacheBackend
+from .index import CacheIndex, SwapPlan
+from .policy import build_eviction_policy
+from .host_rows import HostRowEngine
+from .mmap_store import MmapRowStore, frequency_order
+from .quantized_store import QuantizedRowStore
+from .transfer import TransferMetrics, TransferWorker
+
+
+def _default_device():
+    return torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+
+
+def _per_table(value, num_tables, name):
+    if isinstance(value, (list, tuple)):
+        if len(value) != num_tables:
+            raise ValueError(f"{name} has {len(value)} entries, expected one per table ({num_tables})")
+        return list(value)
+    return [value] * num_tables
+
+
+class CachedEmbeddingBag(nn.Module, CacheBackend):
+    """
+    Pure PyTorch reference implementation of the software-cached embedding bag.
+
+    The full table ``weight`` stays in host memory and is not a parameter. Only ``cache_weight``, holding
+    ``cache_rows`` rows on ``device``, is trained. Rows are swapped in on demand by :meth:`prepare_ids`, and the
+    rows evicted by the policy are written back to the host table. With ``device`` set to cpu it runs without a
+    GPU, which makes it the baseline for experimenting with cache internals.
+
+    With ``table_rows`` the rows are split into tables, each owning a segment of the cache with its own size and
+    eviction policy (``cache_rows`` and ``evict_strategy`` are then given per table). Ids and slots stay global,
+    so lookups are still a single embedding bag over ``cache_weight``.
+
+    With an ``admission`` filter, missed rows estimated colder than the rows they would evict are not cached. They
+    are served from ``bypass_ratio * cache_rows`` scratch rows appended to every segment and written back to the
+    host table at the next step.
+
+    Prepared ids can be pinned so that several batches are prepared ahead of their lookup, see
+    ``recsys.cache.prefetch``. Pinned lookups do not use the scratch rows, their rejected rows are cached anyway.
+
+    With :meth:`set_async_copy` the row swaps run on a :class:`recsys.cache.transfer.TransferWorker`, so
+    :meth:`prepare_ids` returns once the slots are assigned and the next lookup waits for the rows.
+
+    With ``host_table_file`` the host table is a :class:`recsys.cache.mmap_store.MmapRowStore` instead, a file
+    cached in ``host_cache_bytes`` of host memory, and ``weight`` is None. With ``host_quantization`` it is a
+    row-wise int8 / int4 :class:`recsys.cache.quantized_store.QuantizedRowStore`, and ``weight`` is None as well.
+
+    Args:
+        num_embeddings (int): number of rows in the full table.
+        embedding_dim (int): embedding dimension.
+        cache_rows (Union[int, List[int]]): number of rows kept in the cache, per table with ``table_rows``.
+        mode (str): reduction of the bags, sum | mean | max.
+        include_last_offset (bool): see ``torch.nn.EmbeddingBag``.
+        sparse (bool): whether the gradient of ``cache_weight`` is sparse.
+        weight (Optional[torch.Tensor]): initial host table, uniformly initialized if not given.
+        ids_freq_mapping (Optional[torch.Tensor]): dataset count of every row, used for the warmup and the
+            dataset eviction policy.
+        warmup_ratio (float): fraction of the cache preloaded with the hottest rows before training.
+        evict_strategy (Union[str, List[str]]): eviction policy name, see ``recsys.cache.policy.EVICTION_POLICIES``,
+            a single name or one per table.
+        device (Optional[torch.device]): the cache device, the current cuda device if available.
+        pin_weight (bool): pin the host table for faster transfers.
+        table_rows (Optional[List[int]]): number of rows of every table, summing to ``num_embeddings``.
+        admission (Optional[str]): admission filter name, see ``recsys.cache.admission.ADMISSION_FILTERS``.
+        bypass_ratio (float): scratch rows serving the rejected rows, relative to the cache rows.
+        host_threads (int): threads of the host table row gather / scatter, see
+            ``recsys.cache.host_rows.HostRowEngine``.
+        transfer_queue_size (int): maximum number of queued asynchronous swaps.
+        numa_policy (str): NUMA placement of the host table, see ``recsys.utils.numa.NUMA_POLICIES``. The gather /
+            scatter threads are bound to the nodes holding the table and the staging buffers to the device's node.
+        host_table_file (Optional[str]): keep the host table in this file, created or overwritten.
+        host_cache_bytes (int): host memory caching blocks of ``host_table_file``.
+        cache_dtype (Optional[torch.dtype]): dtype of the cached rows and of the in-memory or file-backed host table,
+            the dtype of ``weight`` (fp32 if not given) by default. The lookups are still returned in the latter,
+            see ``recsys.cache.precision``.
+        host_quantization (Optional[str]): store the host table row-wise quantized, see
+            ``recsys.cache.quantized_store.HOST_QUANTIZATIONS``. The rows are swapped in and out quantized, and
+            converted on the device.
+    """
+
+    supports_pinning = True
+
+    def __init__(self,
+                 num_embeddings: int,
+                 embedding_dim: int,
+                 cache_rows: Union[int, List[int]],
+                 mode: str = 'sum',
+                 include_last_offset: bool = False,
+                 sparse: bool = False,
+                 weight: Optional[torch.Tensor] = None,
+                 ids_freq_mapping: Optional[torch.Tensor] = None,
+                 warmup_ratio: float = 0.7,
+                 evict_strategy: Union[str, List[str]] = 'dataset',
+                 device: Optional[torch.device] = None,
+                 pin_weight: bool = False,
+                 table_rows: Optional[List[int]] = None,
+                 admission: Optional[str] = None,
+                 bypass_ratio: float = 0.1,
+                 host_threads: int = 4,
+                 transfer_queue_size: int = 2,
+                 numa_policy: str = 'none',
+                 host_table_file: Optional[str] = None,
+                 host_cache_bytes: int = 1 << 30,
+                 cache_dtype: Optional[torch.dtype] = None,
+                 host_quantization: Optional[str] = None):
+        super(CachedEmbeddingBag, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.mode = mode
+        self.include_last_offset = include_last_offset
+        self.sparse = sparse
+        self.device = device if device is not None else _default_device()
+
+        table_rows = [num_embeddings] if table_rows is None else list(table_rows)
+        assert sum(table_rows) == num_embeddings, "table_rows must sum up to num_embeddings"
+        cache_rows = _per_table(cache_rows, len(table_rows), "cache_rows")
+        evict_strategy = _per_table(evict_strategy, len(table_rows), "evict_strategy")
+        cache_rows = [min(c, n) for c, n in zip(cache_rows, table_rows)]
+        bypass_rows = [max(1, int(bypass_ratio * c)) if admission is not None else 0 for c in cache_rows]
+        self.cache_rows = sum(cache_rows)
+        self._row_offsets = [0, *itertools.accumulate(table_rows)]
+        self._slot_offsets = [0, *itertools.accumulate(c + b for c, b in zip(cache_rows, bypass_rows))]
+        self._table_bounds = torch.tensor(self._row_offsets[1:-1], dtype=torch.long, device=self.device)
+        self._slot_bounds = torch.tensor(self._slot_offsets[1:-1], dtype=torch.long, device=self.device)
+
+        assert weight is None or weight.shape == (num_embeddings, embedding_dim), \
+            f"weight of shape {tuple(weight.shape)} does not match ({num_embeddings}, {embedding_dim})"
+        layout = None
+        self._host_store = None
+        # the dtype the lookups are returned in, the host table holds the rows in the cache dtype
+        self._output_dtype = weight.dtype if weight is not None else torch.float32
+        self._host_dtype = cache_dtype or self._output_dtype
+        if host_quantization == 'none':
+            host_quantization = None
+        if host_table_file is not None and host_quantization is not None:
+            raise ValueError("host_table_file and host_quantization are exclusive")
+        if (host_table_file is not None or host_quantization is not None) and numa_policy != 'none':
+            raise ValueError("numa_policy places an in-memory host table, not a file-backed or quantized one")
+        if host_table_file is not None:
+            self._host_store = MmapRowStore(host_table_file,
+                                            num_embeddings,
+                                            embedding_dim,
+                                            dtype=self._host_dtype,
+                                            cache_bytes=host_cache_bytes,
+                                            order=frequency_order(ids_freq_mapping, self._row_offsets),
+                                            num_threads=host_threads)
+            if weight is None:
+                bound = math.sqrt(1. / num_embeddings)
+                self._host_store.uniform_(-bound, bound)
+            else:
+                self._host_store.copy_(weight)
+            weight = None
+        elif host_quantization is not None:
+            self._host_dtype = torch.float32
+            self._host_store = QuantizedRowStore(num_embeddings,
+                                                 embedding_dim,
+                                                 quantization=host_quantization,
+                                                 num_threads=host_threads)
+            if weight is None:
+                bound = math.sqrt(1. / num_embeddings)
+                self._host_store.uniform_(-bound, bound)
+            else:
+                self._host_store.copy_(weight)
+            weight = None
+        elif numa_policy != 'none':
+            # imported here, recsys.utils pulls in colossalai
+            from ..utils.numa import numa_empty, local_numa_node
+            placed, layout = numa_empty(num_embeddings,
+                                        embedding_dim,
+                                        dtype=self._host_dtype,
+                                        policy=numa_policy,
+                                        local_node=local_numa_node(self.device))
+            if weight is None:
+                weight = placed.uniform_(-math.sqrt(1. / num_embeddings), math.sqrt(1. / num_embeddings))
+            else:
+                weight = placed.copy_(weight)
+        elif weight is None:
+            bound = math.sqrt(1. / num_embeddings)
+            weight = torch.empty(num_embeddings, embedding_dim, dtype=self._host_dtype).uniform_(-bound, bound)
+        if weight is not None:
+            weight = weight.cpu().to(self._host_dtype)
+            if pin_weight and torch.cuda.is_available():
+                if layout is not None:
+                    # pin in place, pin_memory() would copy the table out of its placement
+                    num_bytes = weight.numel() * weight.element_size()
+                    torch.cuda.cudart().cudaHostRegister(weight.data_ptr(), num_bytes, 0)
+                else:
+                    weight = weight.pin_memory()
+        # a plain attribute on purpose: module.to(device) must not move the host table
+        self.weight = weight
+        self._host_rows = self._host_store if self._host_store is not None else \
+            HostRowEngine(weight, host_threads, layout=layout)
+        # converts the quantized rows moved to and from the device
+        self._codec = self._host_store if isinstance(self._host_store, QuantizedRowStore) else None
+        self.cache_weight = nn.Parameter(
+            torch.zeros(self._slot_offsets[-1], embedding_dim, dtype=cache_dtype or self._host_dtype,
+                        device=self.device))
+
+        self.indices = []
+        for t, (rows, slots, strategy) in enumerate(zip(table_rows, cache_rows, evict_strategy)):
+            freq = self._table_slice(ids_freq_mapping, t)
+            policy = build_eviction_policy(strategy, slots, self.device, freq, num_embeddings=rows)
+            self.indices.append(
+                CacheIndex(rows, slots, policy, self.device, build_admission_filter(admission, slots, self.device),
+                           bypass_rows[t]))
+
+        self.num_hits_history = []
+        self.num_miss_history = []
+        self.num_write_back_history = []
+        self.num_admitted_history = []
+        self.num_rejected_history = []
+        self.num_bypassed_history = []
+        # (global rows, global slots) served from the scratch rows by the previous step
+        self._bypassed = []
+        self._swap_in_rows = 0
+        self._swap_out_rows = 0
+        self.transfer_queue_size = transfer_queue_size
+        self._transfer = None
+        self._transfer_metrics = TransferMetrics()
+        # pinned staging buffers of the synchronous swaps, used in turns, and the copies to the device out of them
+        self._staging = [None, None]
+        self._staging_events = [None, None]
+        self._next_staging = 0
+        for t in range(len(self.indices)):
+            self._warmup(t, self._table_slice(ids_freq_mapping, t), warmup_ratio)
+
+    def _table_slice(self, tensor: Optional[torch.Tensor], t: int) -> Optional[torch.Tensor]:
+        if tensor is None:
+            return None
+        return tensor[self._row_offsets[t]:self._row_offsets[t + 1]]
+
+    @torch.no_grad()
+    def _warmup(self, t: int, ids_freq_mapping: Optional[torch.Tensor], warmup_ratio: float):
+        index = self.indices[t]
+        preload_num = min(int(math.ceil(index.cache_rows * warmup_ratio)), index.num_embeddings)
+        if preload_num <= 0:
+            return
+        if ids_freq_mapping is not None:
+            rows = torch.topk(ids_freq_mapping.cpu(), preload_num, sorted=False).indices
+        else:
+            rows = torch.arange(preload_num)
+        slots = index.preload(rows) + self._slot_offsets[t]
+        rows = rows + self._row_offsets[t]
+        self.cache_weight.data.index_copy_(0, slots, self._decode(self._gather(rows).to(self.device)))
+
+    def _wire_row(self):
+        """
+        Width and dtype of the rows moved between the host and the device: packed quantized rows, else cache rows.
+        """
+        if self._codec is not None:
+            return self._codec.row_bytes, torch.uint8
+        return self.embedding_dim, self.cache_weight.dtype
+
+    def _decode(self, rows: torch.Tensor) -> torch.Tensor:
+        return rows if self._codec is None else self._codec.decode(rows, self.cache_weight.dtype)
+
+    def _encode(self, rows: torch.Tensor) -> torch.Tensor:
+        return rows if self._codec is None else self._codec.encode(rows)
+
+    def _gather(self, rows: torch.Tensor, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        The unique host ``rows`` as moved to the device, converted to the cache dtype on the host so that only its
+        bytes are transferred, or packed quantized rows.
+        """
+        if out is None:
+            width, dtype = self._wire_row()
+            out = torch.empty(rows.shape[0], width, dtype=dtype)
+        return self._host_rows.gather(rows, out, unique=True)
+
+    def _staging_buffer(self, rows: int) -> torch.Tensor:
+        """
+        ``rows`` rows of the next pinned staging buffer of the synchronous swaps, grown to the next power of two
+        when too small. The buffers are used in turns, so that filling one overlaps the copy out of the other.
+        """
+        b = self._next_staging
+        self._next_staging ^= 1
+        if self._staging_events[b] is not None:
+            # the previous copy out of this buffer must be over before it is refilled
+            self._staging_events[b].synchronize()
+            self._staging_events[b] = None
+        if self._staging[b] is None or self._staging[b].shape[0] < rows:
+            # pinned on the node local to the device, where the copies to it are the fastest
+            width, dtype = self._wire_row()
+            with self._host_rows.on_local_node():
+                self._staging[b] = torch.empty(1 << max(rows - 1, 0).bit_length(), width, dtype=dtype,
+                                               pin_memory=self.device.type == 'cuda')
+        return self._staging[b][:rows]
+
+    def _load(self, rows: torch.Tensor, slots: torch.Tensor) -> None:
+        """
+        Copy the host ``rows`` into the cache ``slots`` through a staging buffer.
+        """
+        b = self._next_staging
+        staging = self._gather(rows, self._staging_buffer(rows.shape[0]))
+        self.cache_weight.data.index_copy_(0, slots, self._decode(staging.to(self.device, non_blocking=True)))
+        if self.device.type == 'cuda':
+            self._staging_events[b] = torch.cuda.Event()
+            self._staging_events[b].record()
+
+    def _store(self, slots: torch.Tensor, rows: torch.Tensor) -> None:
+        """
+        Write the cache ``slots`` back to the host ``rows`` through a staging buffer.
+        """
+        staging = self._staging_buffer(slots.shape[0])
+        staging.copy_(self._encode(self.cache_weight.data.index_select(0, slots)))
+        self._host_rows.scatter(rows, staging)
+
+    @torch.no_grad()
+    def _swap(self, plan: SwapPlan, row_offset: int = 0, slot_offset: int = 0):
+        self._swap_in_rows += plan.load_rows.shape[0] + plan.bypass_rows.shape[0]
+        self._swap_out_rows += plan.evict_rows.shape[0]
+        if plan.bypass_slots.shape[0] > 0:
+            self._bypassed.append((plan.bypass_rows.cpu() + row_offset, plan.bypass_slots + slot_offset))
+        if self._transfer is not None:
+            self._transfer.submit(plan.evict_rows.cpu() + row_offset, plan.evict_slots + slot_offset,
+                                  torch.cat([plan.load_rows, plan.bypass_rows]).cpu() + row_offset,
+                                  torch.cat([plan.load_slots, plan.bypass_slots]) + slot_offset)
+            return
+        if plan.evict_slots.shape[0] > 0:
+            with record_function("(cache) swap out"):
+                self._store(plan.evict_slots + slot_offset, plan.evict_rows.cpu() + row_offset)
+        if plan.load_slots.shape[0] > 0:
+            with record_function("(cache) swap in"):
+                self._load(plan.load_rows.cpu() + row_offset, plan.load_slots + slot_offset)
+        if plan.bypass_slots.shape[0] > 0:
+            with record_function("(cache) bypass"):
+                self._load(*self._bypassed[-1])
+
+    def _wait_transfers(self):
+        if self._transfer is not None:
+            with record_function("(cache) wait transfers"):
+                self._transfer.wait()
+
+    def set_async_copy(self, enable: bool) -> None:
+        if enable and self._transfer is None:
+            self._transfer = TransferWorker(self._host_rows, self.cache_weight.data, self.transfer_queue_size,
+                                            metrics=self._transfer_metrics, codec=self._codec)
+        elif not enable and self._transfer is not None:
+            self._transfer.close()
+            self._transfer = None
+
+    @torch.no_grad()
+    def _write_back_bypassed(self, release: bool = True):
+        """
+        Write the scratch rows, possibly updated by the optimizer since, back to the host table. Unless
+        ``release`` is False the scratch rows are free afterwards.
+        """
+        if self._bypassed:
+            self._wait_transfers()
+        for rows, slots in self._bypassed:
+            self._store(slots, rows)
+        if release:
+            self._swap_out_rows += sum(rows.shape[0] for rows, _ in self._bypassed)
+            self._bypassed = []
+
+    @torch.no_grad()
+    def prepare_ids(self, ids: torch.Tensor, pin: bool = False) -> torch.Tensor:
+        ids = ids.to(self.device)
+        self._write_back_bypassed()
+        if len(self.indices) == 1:
+            with record_function("(cache) admit"):
+                plan = self.indices[0].admit(ids, allow_bypass=not pin)
+            self._swap(plan)
+            self._record([plan])
+            slots = self.indices[0].slots_of(ids)
+            if pin:
+                self._pin(slots)
+            return slots
+
+        table = torch.bucketize(ids, self._table_bounds, right=True)
+        slots = torch.empty_like(ids)
+        plans = []
+        for t, index in enumerate(self.indices):
+            mask = table == t
+            local_ids = ids[mask] - self._row_offsets[t]
+            if local_ids.shape[0] == 0:
+                continue
+            with record_function("(cache) admit"):
+                plan = index.admit(local_ids, allow_bypass=not pin)
+            self._swap(plan, self._row_offsets[t], self._slot_offsets[t])
+            slots[mask] = index.slots_of(local_ids) + self._slot_offsets[t]
+            plans.append(plan)
+        self._record(plans)
+        if pin:
+            self._pin(slots)
+        return slots
+
+    def _pin(self, slots: torch.Tensor, delta: int = 1):
+        slots = torch.unique(slots)
+        table = torch.bucketize(slots, self._slot_bounds, right=True)
+        for t, index in enumerate(self.indices):
+            index.pin(slots[table == t] - self._slot_offsets[t], delta)
+
+    @torch.no_grad()
+    def unpin(self, slots: torch.Tensor) -> None:
+        self._pin(slots.to(self.device), -1)
+
+    def _record(self, plans: List[SwapPlan]):
+        self.num_hits_history.append(sum(plan.num_hits for plan in plans))
+        self.num_miss_history.append(sum(plan.num_misses for plan in plans))
+        self.num_write_back_history.append(sum(plan.evict_rows.shape[0] for plan in plans))
+        self.num_admitted_history.append(sum(plan.load_rows.shape[0] for plan in plans))
+        self.num_rejected_history.append(sum(plan.num_rejected for plan in plans))
+        self.num_bypassed_history.append(sum(plan.bypass_rows.shape[0] for plan in plans))
+
+    def lookup(self,
+               ids: torch.Tensor,
+               offsets: torch.Tensor,
+               per_sample_weights: Optional[torch.Tensor] = None,
+               shape_hook: Optional[Callable] = None,
+               cache_op: bool = True) -> torch.Tensor:
+        slots = self.prepare_ids(ids) if cache_op else ids
+        self._wait_transfers()
+        if per_sample_weights is not None:
+            per_sample_weights = per_sample_weights.to(self.cache_weight.dtype)
+        embeddings = F.embedding_bag(slots,
+                                     self.cache_weight,
+                                     offsets,
+                                     mode=self.mode,
+                                     sparse=self.sparse,
+                                     per_sample_weights=per_sample_weights,
+                                     include_last_offset=self.include_last_offset)
+        # reduced-precision rows are summed in their dtype, the model above works in the dtype of the initial weight
+        embeddings = embeddings.to(self._output_dtype)
+        if shape_hook is not None:
+            embeddings = shape_hook(embeddings)
+        return embeddings
+
+    def forward(self, ids, offsets, per_sample_weights=None, shape_hook=None, cache_op=True):
+        return self.lookup(ids, offsets, per_sample_weights, shape_hook, cache_op)
+
+    def _cached(self, t: int):
+        """
+        The occupied global slots of table ``t`` and the global rows they hold.
+        """
+        index = self.indices[t]
+        slots = index.occupied()
+        rows = index.cached_rows.index_select(0, slots)
+        return slots + self._slot_offsets[t], rows + self._row_offsets[t]
+
+    @torch.no_grad()
+    def flush(self) -> None:
+        """
+        Write every cached row back to the host table, the rows stay cached.
+        """
+        self._wait_transfers()
+        self._write_back_bypassed(release=False)
+        for t in range(len(self.indices)):
+            slots, rows = self._cached(t)
+            self._host_rows.scatter(rows.cpu(), self._encode(self.cache_weight.data.index_select(0, slots)).cpu())
+        if self._host_store is not None:
+            self._host_store.flush()
+
+    def stats(self) -> Dict[str, float]:
+        hits, misses = sum(self.num_hits_history), sum(self.num_miss_history)
+        width, dtype = self._wire_row()
+        row_bytes = width * torch.empty(0, dtype=dtype).element_size()
+        stats = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1),
+            'swap_in_rows': self._swap_in_rows,
+            'swap_out_rows': self._swap_out_rows,
+            'swap_in_bytes': self._swap_in_rows * row_bytes,
+            'swap_out_bytes': self._swap_out_rows * row_bytes,
+            'admitted': sum(self.num_admitted_history),
+            'rejected': sum(self.num_rejected_history),
+            'bypassed': sum(self.num_bypassed_history),
+        }
+        if self._transfer_metrics.jobs > 0:
+            stats.update(self._transfer_metrics.as_dict())
+        if self._host_store is not None:
+            stats.update(self._host_store.stats())
+        return stats
+
+    def element_size(self) -> float:
+        if isinstance(self._host_store, QuantizedRowStore):
+            return self._host_store.row_bytes / self.embedding_dim
+        return torch.empty(0, dtype=self._host_dtype).element_size()
+
+    def readahead(self, ids: torch.Tensor) -> None:
+        if self._host_store is not None:
+            self._host_store.readahead(ids.cpu())
+
+    def refresh_eviction_ranking(self, freq: torch.Tensor) -> None:
+        for t, index in enumerate(self.indices):
+            slots = index.occupied()
+            rows = index.cached_rows.index_select(0, slots) + self._row_offsets[t]
+            index.policy.refresh(slots, freq.index_select(0, rows.to(freq.device)))
@@ -0,0 +1,144 @@
+"""
+Multithreaded row gather / scatter over the host-resident embedding table.
+
+Swapping rows in and out of the cache is dominated by random row accesses to the host table, which
+``index_select`` / ``index_copy_`` serve on a single thread for the index counts of a cache step. The engine splits
+them over a thread pool. With sorted row indices, as the cache passes them, every thread works on a contiguous row
+range with increasing addresses, and with a NUMA layout (``recsys.utils.numa``) the threads are bound to the node
+holding the rows they access.
+"""
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import torch
+
+
+class HostRowEngine:
+    """
+    Gathers rows of a host table into a (possibly pinned) buffer and scatters rows back into it.
+
+    Calls touching fewer than ``min_rows_per_thread`` rows per thread use fewer threads, down to a plain single
+    ``index_select`` / ``index_copy_``. Concurrent :meth:`gather` and :meth:`scatter` calls are safe as long as
+    they do not touch the same rows.
+
+    With a ``layout``, the threads are split over its nodes and bound to them. Sorted rows of a ``shard`` layout
+    are handled by the threads of the node owning them, other calls are spread evenly over the nodes.
+
+    Args:
+        weight (torch.Tensor): the host table, a 2D cpu tensor.
+        num_threads (int): total number of threads, at least one per node of the layout.
+        min_rows_per_thread (int): minimum number of rows handled by each thread.
+        layout (Optional[recsys.utils.numa.NumaLayout]): NUMA placement of ``weight``.
+    """
+
+    def __init__(self, weight: torch.Tensor, num_threads: int = 4, min_rows_per_thread: int = 2048, layout=None):
+        assert weight.device.type == 'cpu' and weight.dim() == 2, "HostRowEngine works on a 2D cpu table"
+        self.weight = weight
+        self.num_threads = max(num_threads, 1)
+        self.min_rows_per_thread = max(min_rows_per_thread, 1)
+        self.layout = layout
+
+        nodes = layout.nodes if layout is not None else [None]
+        self._pool_threads = [
+            max(self.num_threads * (i + 1) // len(nodes) - self.num_threads * i // len(nodes), 1)
+            for i in range(len(nodes))
+        ]
+        self._pools = []
+        if self.num_threads > 1 or layout is not None:
+            for node, threads in zip(nodes, self._pool_threads):
+                initializer = None if node is None else functools.partial(layout.bind, node)
+                self._pools.append(
+                    ThreadPoolExecutor(threads, thread_name_prefix="host-rows", initializer=initializer))
+        self._row_bounds = None
+        if layout is not None and layout.row_bounds is not None:
+            self._row_bounds = torch.tensor(layout.row_bounds, dtype=torch.long)
+
+    def _tasks(self, rows: torch.Tensor, by_row: bool) -> List[Tuple[int, int, int]]:
+        """
+        ``(pool, lo, hi)`` slices of ``rows``, by owning node when ``by_row`` (sorted rows) and the table is
+        sharded, else evenly over the pools.
+        """
+        num_rows = rows.shape[0]
+        num_pools = max(len(self._pools), 1)
+        if by_row and self._row_bounds is not None:
+            cuts = torch.searchsorted(rows, self._row_bounds).tolist()
+            cuts[0], cuts[-1] = 0, num_rows
+        else:
+            cuts = [num_rows * p // num_pools for p in range(num_pools + 1)]
+        tasks = []
+        for p, (lo, hi) in enumerate(zip(cuts[:-1], cuts[1:])):
+            n = hi - lo
+            if n == 0:
+                continue
+            k = min(self._pool_threads[p], max(n // self.min_rows_per_thread, 1))
+            tasks.extend((p, lo + n * i // k, lo + n * (i + 1) // k) for i in range(k))
+        return tasks
+
+    def _run(self, fn, rows: torch.Tensor, by_row: bool = False):
+        if not self._pools or rows.shape[0] < self.min_rows_per_thread:
+            fn(0, rows.shape[0])
+            return
+        futures = [self._pools[p].submit(fn, lo, hi) for p, lo, hi in self._tasks(rows, by_row)]
+        for future in futures:
+            future.result()
+
+    def on_local_node(self):
+        """
+        Context allocating on the node local to the cache device, if the table has a NUMA layout.
+        """
+        return self.layout.on_local_node() if self.layout is not None else contextlib.nullcontext()
+
+    @staticmethod
+    def is_sorted_unique(rows: torch.Tensor) -> bool:
+        return rows.shape[0] < 2 or bool((rows[1:] > rows[:-1]).all())
+
+    def gather(self, rows: torch.Tensor, out: Optional[torch.Tensor] = None, unique: bool = False) -> torch.Tensor:
+        """
+        ``out[i] = weight[rows[i]]``, ``out`` being allocated if not given, possibly of another dtype than the table.
+
+        Rows known to be ``unique`` are gathered straight into ``out``, in contiguous row ranges per thread when
+        they are sorted, so callers free to choose the row order should sort them. Other rows are deduplicated and
+        sorted, gathered once into a temporary buffer, and expanded from it into ``out``.
+        """
+        rows = rows.cpu()
+        if out is None:
+            out = torch.empty(rows.shape[0], self.weight.shape[1], dtype=self.weight.dtype)
+        by_row = self.is_sorted_unique(rows)
+        if unique or by_row:
+            unique_rows, inverse, buffer = rows, None, out
+        else:
+            by_row = True
+            unique_rows, inverse = torch.unique(rows, sorted=True, return_inverse=True)
+            buffer = torch.empty(unique_rows.shape[0], self.weight.shape[1], dtype=out.dtype)
+
+        def gather_range(lo, hi):
+            if buffer.dtype == self.weight.dtype:
+                torch.index_select(self.weight, 0, unique_rows[lo:hi], out=buffer[lo:hi])
+            else:
+                buffer[lo:hi].copy_(self.weight.index_select(0, unique_rows[lo:hi]))
+
+        def expand_range(lo, hi):
+            torch.index_select(buffer, 0, inverse[lo:hi], out=out[lo:hi])
+
+        self._run(gather_range, unique_rows, by_row)
+        if inverse is not None:
+            self._run(expand_range, rows)
+        return out
+
+    def scatter(self, rows: torch.Tensor, values: torch.Tensor) -> None:
+        """
+        ``weight[rows[i]] = values[i]``, ``rows`` must be unique, ``values`` are cast to the table dtype. Every
+        thread writes a contiguous slice of ``rows``, a contiguous row range when they are sorted.
+        """
+        rows, values = rows.cpu(), values.cpu()
+
+        def scatter_range(lo, hi):
+            self.weight.index_copy_(0, rows[lo:hi], values[lo:hi].to(self.weight.dtype))
+
+        self._run(scatter_range, rows, self._row_bounds is not None and self.is_sorted_unique(rows))
+
+    def close(self) -> None:
+        for pool in self._pools:
+            pool.shutdown()
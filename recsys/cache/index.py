@@ -0,0 +1,194 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+
+from .admission import AdmissionFilter
+from .policy import EvictionPolicy
+
+
+@dataclass
+class SwapPlan:
+    """
+    Row movements decided by :meth:`CacheIndex.admit`. ``load_slots`` starts with ``evict_slots`` followed by
+    free slots, so the evicted rows must be written back before ``load_rows`` are copied in. Rows rejected by the
+    admission filter are served for this step only from ``bypass_slots``, past the cache slots.
+    """
+    load_rows: torch.Tensor
+    load_slots: torch.Tensor
+    evict_rows: torch.Tensor
+    evict_slots: torch.Tensor
+    bypass_rows: torch.Tensor
+    bypass_slots: torch.Tensor
+    num_hits: int
+    num_misses: int
+    num_rejected: int
+
+
+class CacheIndex:
+    """
+    Slot bookkeeping of a row cache, without any embedding data.
+
+    It maps rows to cache slots, finds free slots and asks the eviction policy for victims. Data movement is left
+    to the caller, so the same index drives both :class:`recsys.cache.CachedEmbeddingBag` and the offline cache
+    simulator.
+
+    With an admission filter, a missed row only replaces a victim it is estimated to be more popular than. The
+    rejected rows get one of the ``bypass_rows`` slots numbered from ``cache_rows`` for the current step, and
+    are admitted anyway once those are exhausted.
+
+    Slots can be pinned, e.g. while a prefetched batch that already holds their slot numbers is in flight, and are
+    never evicted until unpinned.
+
+    Args:
+        num_embeddings (int): number of rows in the full table.
+        cache_rows (int): number of cache slots.
+        policy (EvictionPolicy): eviction policy over the slots.
+        device (torch.device): where the index tensors live, normally the cache device.
+        admission (Optional[AdmissionFilter]): admission filter, every missed row is admitted if not given.
+        bypass_rows (int): number of slots serving the rejected rows.
+    """
+
+    def __init__(self,
+                 num_embeddings: int,
+                 cache_rows: int,
+                 policy: EvictionPolicy,
+                 device: torch.device,
+                 admission: Optional[AdmissionFilter] = None,
+                 bypass_rows: int = 0):
+        self.num_embeddings = num_embeddings
+        self.cache_rows = cache_rows
+        self.policy = policy
+        self.device = device
+        self.admission = admission
+        self.bypass_rows = bypass_rows if admission is not None else 0
+        self._bypassed = torch.empty(0, dtype=torch.long, device=device)
+        # slot -> row, -1 marks an empty slot
+        self.cached_rows = torch.full((cache_rows,), -1, dtype=torch.long, device=device)
+        # row -> slot, -1 marks a row that is not cached
+        self.row_to_slot = torch.full((num_embeddings,), -1, dtype=torch.int32, device=device)
+        # number of in-flight batches using every slot
+        self.pin_count = torch.zeros(cache_rows, dtype=torch.int32, device=device)
+        self.step = 0
+
+    def slots_of(self, ids: torch.Tensor) -> torch.Tensor:
+        """
+        Translate cached ``ids`` into their slots.
+        """
+        return self.row_to_slot.index_select(0, ids.view(-1)).view_as(ids).long()
+
+    def preload(self, rows: torch.Tensor) -> torch.Tensor:
+        """
+        Fill the first ``len(rows)`` slots of an empty cache with ``rows``, returns those slots.
+        """
+        rows = rows.to(self.device)
+        slots = torch.arange(rows.shape[0], device=self.device)
+        self.cached_rows[slots] = rows
+        self.row_to_slot[rows] = slots.int()
+        self.policy.on_admit(slots, rows, self.step)
+        return slots
+
+    def _protected(self) -> torch.Tensor:
+        """
+        Slots that can not be chosen as victims.
+        """
+        return (self.cached_rows < 0) | (self.pin_count > 0)
+
+    def pin(self, slots: torch.Tensor, delta: int = 1) -> None:
+        """
+        Add ``delta`` to the pin count of the unique ``slots``, bypass slots are ignored.
+        """
+        slots = slots[slots < self.cache_rows]
+        self.pin_count[slots] += delta
+
+    def unpin(self, slots: torch.Tensor) -> None:
+        self.pin(slots, -1)
+
+    def _filter(self, load_rows, num_free, evict_slots, bypass_rows):
+        """
+        Keep the missed rows estimated more popular than the victims they replace, the hottest missed rows take
+        the free slots. Returns the admitted rows, the victims to evict, the bypassed rows and the number of
+        rejections.
+        """
+        estimate = self.admission.estimate(load_rows)
+        order = torch.argsort(estimate, descending=True)
+        load_rows, estimate = load_rows[order], estimate[order]
+        victim_estimate = self.admission.estimate(self.cached_rows.index_select(0, evict_slots))
+        order = torch.argsort(victim_estimate)
+        evict_slots, victim_estimate = evict_slots[order], victim_estimate[order]
+
+        # contenders sorted hottest first against victims coldest first: the winners form a prefix
+        num_contenders = evict_slots.shape[0]
+        num_rejected = num_contenders - int((estimate[num_free:] > victim_estimate).sum())
+        num_admitted = num_contenders - min(num_rejected, bypass_rows)
+        num_loads = num_free + num_admitted
+        return load_rows[:num_loads], evict_slots[:num_admitted], load_rows[num_loads:], num_rejected
+
+    def admit(self, ids: torch.Tensor, allow_bypass: bool = True) -> SwapPlan:
+        """
+        Make room for every row of ``ids`` and update the mapping, the caller then executes the returned plan.
+        Without ``allow_bypass`` the rows rejected by the admission filter are cached anyway, as the scratch rows
+        only live until the next step.
+        """
+        rows, counts = torch.unique(ids.to(self.device), return_counts=True)
+        return self.admit_unique(rows, counts, allow_bypass)
+
+    def admit_unique(self, rows: torch.Tensor, counts: torch.Tensor, allow_bypass: bool = True) -> SwapPlan:
+        """
+        :meth:`admit` for the unique ``rows`` of a batch, referenced ``counts`` times each.
+        """
+        rows, counts = rows.to(self.device), counts.to(self.device)
+        # rows bypassed by the previous step are not cached
+        self.row_to_slot[self._bypassed] = -1
+        if rows.shape[0] > self.cache_rows:
+            raise ValueError(f"A batch references {rows.shape[0]} unique rows, "
+                             f"more than the {self.cache_rows} rows of the cache")
+        if self.admission is not None:
+            self.admission.record(rows, counts)
+        hit = self.row_to_slot.index_select(0, rows) >= 0
+        load_rows = rows[~hit]
+        num_misses = load_rows.shape[0]
+
+        free_slots = torch.nonzero(self.cached_rows < 0).view(-1)[:num_misses]
+        num_evicts = num_misses - free_slots.shape[0]
+        bypass_rows = torch.empty(0, dtype=torch.long, device=self.device)
+        num_rejected = 0
+        if num_evicts > 0:
+            protected = self._protected()
+            protected[self.row_to_slot.index_select(0, rows[hit]).long()] = True
+            num_evictable = int((~protected).sum())
+            if num_evicts > num_evictable:
+                raise ValueError(f"A batch misses {num_evicts} rows but only {num_evictable} cached rows are neither "
+                                 f"referenced by it nor pinned")
+            evict_slots = self.policy.victims(num_evicts, protected)
+            if self.admission is not None:
+                load_rows, evict_slots, bypass_rows, num_rejected = self._filter(
+                    load_rows, free_slots.shape[0], evict_slots, self.bypass_rows if allow_bypass else 0)
+            evict_rows = self.cached_rows.index_select(0, evict_slots)
+            self.row_to_slot[evict_rows] = -1
+            self.policy.on_evict(evict_slots, evict_rows, self.step)
+        else:
+            evict_slots = torch.empty(0, dtype=torch.long, device=self.device)
+            evict_rows = torch.empty(0, dtype=torch.long, device=self.device)
+
+        load_slots = torch.cat([evict_slots, free_slots])
+        self.cached_rows[load_slots] = load_rows
+        self.row_to_slot[load_rows] = load_slots.int()
+        self.policy.on_admit(load_slots, load_rows, self.step)
+
+        bypass_slots = torch.arange(self.cache_rows, self.cache_rows + bypass_rows.shape[0], device=self.device)
+        self.row_to_slot[bypass_rows] = bypass_slots.int()
+        self._bypassed = bypass_rows
+
+        slots = self.row_to_slot.index_select(0, rows).long()
+        cached = slots < self.cache_rows
+        self.policy.on_access(slots[cached], counts[cached], self.step)
+        self.step += 1
+        return SwapPlan(load_rows, load_slots, evict_rows, evict_slots, bypass_rows, bypass_slots,
+                        rows.shape[0] - num_misses, num_misses, num_rejected)
+
+    def occupied(self) -> torch.Tensor:
+        """
+        The occupied slots.
+        """
+        return torch.nonzero(self.cached_rows >= 0).view(-1)
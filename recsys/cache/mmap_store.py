@@ -0,0 +1,267 @@
+"""
+File-backed host tier of :class:`recsys.cache.CachedEmbeddingBag`, for tables larger than host memory.
+
+The table lives in a memory-mapped file, typically on a local NVMe drive, in blocks of ``block_rows`` rows. Rows are
+laid out table by table, each table sorted by decreasing dataset frequency, so the hot rows of a table share a few
+blocks. A fixed budget of host memory caches the most recently used blocks, and the rows of upcoming batches can be
+read ahead with ``madvise(MADV_WILLNEED)``.
+"""
+import mmap
+import threading
+from typing import List, Optional
+
+import torch
+
+from .host_rows import HostRowEngine
+
+
+def frequency_order(ids_freq_mapping: Optional[torch.Tensor], row_offsets: List[int]) -> Optional[torch.Tensor]:
+    """
+    The ids in file order: table by table, by decreasing ``ids_freq_mapping``. None (identity) without counts.
+    """
+    if ids_freq_mapping is None:
+        return None
+    ids_freq_mapping = ids_freq_mapping.cpu()
+    order = [
+        torch.argsort(ids_freq_mapping[lo:hi], descending=True) + lo
+        for lo, hi in zip(row_offsets[:-1], row_offsets[1:])
+    ]
+    return torch.cat(order)
+
+
+class MmapRowStore:
+    """
+    A ``(num_rows, row_size)`` table in the file at ``path``, with the gather / scatter interface of
+    :class:`recsys.cache.host_rows.HostRowEngine`.
+
+    Calls are served from an LRU cache of ``cache_bytes`` worth of blocks, and a call touching more blocks than the
+    cache holds reads or writes the remaining rows straight from the mapping. Evicted dirty blocks are written back to
+    the file. The block transfers go through multithreaded engines, and calls are serialized by a lock.
+
+    The file is created or overwritten, the table starts zeroed, see :meth:`copy_` and :meth:`uniform_`.
+
+    Args:
+        path (str): table file.
+        num_rows (int): number of rows.
+        row_size (int): row size, the embedding dimension.
+        dtype (torch.dtype): row dtype.
+        cache_bytes (int): host memory caching blocks.
+        block_rows (int): rows per block, the unit of caching and readahead.
+        order (Optional[torch.Tensor]): the ids in file order, see :func:`frequency_order`.
+        num_threads (int): threads of the block transfers.
+    """
+
+    def __init__(self,
+                 path: str,
+                 num_rows: int,
+                 row_size: int,
+                 dtype: torch.dtype = torch.float32,
+                 cache_bytes: int = 1 << 30,
+                 block_rows: int = 256,
+                 order: Optional[torch.Tensor] = None,
+                 num_threads: int = 4):
+        self.path = path
+        self.num_rows = num_rows
+        self.block_rows = block_rows
+        self.num_blocks = -(-num_rows // block_rows)
+        element_size = torch.empty(0, dtype=dtype).element_size()
+        self.block_bytes = block_rows * row_size * element_size
+
+        with open(path, 'w+b') as f:
+            f.truncate(self.num_blocks * self.block_bytes)
+            self._mmap = mmap.mmap(f.fileno(), self.num_blocks * self.block_bytes)
+        # accesses are random, the kernel readahead would only waste the page cache
+        self._mmap.madvise(mmap.MADV_RANDOM)
+        # the rows in file order, for the rows overflowing the block cache
+        self.weight = torch.frombuffer(self._mmap, dtype=dtype).view(self.num_blocks * block_rows, row_size)
+        self._file_rows = HostRowEngine(self.weight, num_threads)
+        self._file_blocks = HostRowEngine(self.weight.view(self.num_blocks, block_rows * row_size), num_threads)
+
+        # file position of every id, int32 halves the footprint of this per-row map
+        position_dtype = torch.int32 if num_rows < 2**31 else torch.long
+        if order is None:
+            self.position = None
+        else:
+            assert order.shape == (num_rows,), "order must hold every row once"
+            self.position = torch.empty(num_rows, dtype=position_dtype)
+            self.position[order] = torch.arange(num_rows, dtype=position_dtype)
+
+        self.cache_blocks = min(cache_bytes // self.block_bytes, self.num_blocks)
+        self._buffer = torch.zeros(self.cache_blocks * block_rows, row_size, dtype=dtype)
+        self._buffer_rows = HostRowEngine(self._buffer, num_threads)
+        self._buffer_blocks = self._buffer.view(self.cache_blocks, block_rows * row_size)
+        # cache slot of every block (-1 when not cached), block of every slot (-1 when free)
+        self._block_slot = torch.full((self.num_blocks,), -1, dtype=torch.int32)
+        self._slot_block = torch.full((self.cache_blocks,), -1, dtype=torch.long)
+        self._slot_dirty = torch.zeros(self.cache_blocks, dtype=torch.bool)
+        self._slot_stamp = torch.full((self.cache_blocks,), -1, dtype=torch.long)
+        self._clock = 0
+        self._lock = threading.Lock()
+
+        self.block_hits = 0
+        self.block_misses = 0
+        self.direct_rows = 0
+
+    def _positions(self, rows: torch.Tensor) -> torch.Tensor:
+        rows = rows.cpu()
+        return rows if self.position is None else self.position.index_select(0, rows).long()
+
+    @torch.no_grad()
+    def copy_(self, weight: torch.Tensor, chunk_rows: int = 1 << 20) -> 'MmapRowStore':
+        """
+        Write ``weight``, indexed by id, into the file, ``chunk_rows`` rows at a time.
+        """
+        with self._lock:
+            self._drop_cache()
+            for lo in range(0, self.num_rows, chunk_rows):
+                ids = torch.arange(lo, min(lo + chunk_rows, self.num_rows))
+                self.weight.index_copy_(0, self._positions(ids), weight[lo:lo + chunk_rows].to(self.weight.dtype))
+        return self
+
+    @torch.no_grad()
+    def uniform_(self, low: float, high: float, chunk_rows: int = 1 << 20) -> 'MmapRowStore':
+        """
+        Fill the file with uniform values, ``chunk_rows`` rows at a time.
+        """
+        with self._lock:
+            self._drop_cache()
+            for lo in range(0, self.num_rows, chunk_rows):
+                self.weight[lo:min(lo + chunk_rows, self.num_rows)].uniform_(low, high)
+        return self
+
+    def _drop_cache(self):
+        self._block_slot.fill_(-1)
+        self._slot_block.fill_(-1)
+        self._slot_dirty.fill_(False)
+        self._slot_stamp.fill_(-1)
+
+    def _admit(self, blocks: torch.Tensor) -> torch.Tensor:
+        """
+        Cache as many of the sorted unique ``blocks`` as fit, lowest (hottest) first, and return their slots (-1 for
+        the blocks left out).
+        """
+        slots = self._block_slot.index_select(0, blocks).long()
+        resident = slots >= 0
+        self.block_hits += int(resident.sum())
+        missing = blocks[~resident]
+        self.block_misses += missing.shape[0]
+        self._clock += 1
+        missing = missing[:self.cache_blocks - int(resident.sum())]
+        if missing.shape[0] > 0:
+            stamps = self._slot_stamp.clone()
+            stamps[slots[resident]] = self._clock
+            victims = torch.topk(stamps, missing.shape[0], largest=False, sorted=False).indices
+            self._evict(victims)
+            self._buffer_blocks.index_copy_(0, victims, self._file_blocks.gather(missing, unique=True))
+            self._block_slot[missing] = victims.int()
+            self._slot_block[victims] = missing
+            slots = self._block_slot.index_select(0, blocks).long()
+        self._slot_stamp[slots[slots >= 0]] = self._clock
+        return slots
+
+    def _evict(self, victims: torch.Tensor):
+        blocks = self._slot_block.index_select(0, victims)
+        dirty = self._slot_dirty.index_select(0, victims) & (blocks >= 0)
+        if bool(dirty.any()):
+            blocks, order = torch.sort(blocks[dirty])
+            self._file_blocks.scatter(blocks, self._buffer_blocks.index_select(0, victims[dirty][order]))
+        self._block_slot[self._slot_block[victims][self._slot_block[victims] >= 0]] = -1
+        self._slot_block[victims] = -1
+        self._slot_dirty[victims] = False
+
+    def _locate(self, rows: torch.Tensor):
+        """
+        ``(positions, buffer rows)`` of ``rows``, the buffer row being -1 for the rows served from the file.
+        """
+        positions = self._positions(rows)
+        blocks = torch.div(positions, self.block_rows, rounding_mode='floor')
+        unique_blocks, inverse = torch.unique(blocks, sorted=True, return_inverse=True)
+        slots = self._admit(unique_blocks).index_select(0, inverse)
+        buffer_rows = torch.where(slots >= 0, slots * self.block_rows + positions % self.block_rows,
+                                  torch.full_like(slots, -1))
+        return positions, buffer_rows
+
+    @staticmethod
+    def is_sorted_unique(rows: torch.Tensor) -> bool:
+        return HostRowEngine.is_sorted_unique(rows)
+
+    @torch.no_grad()
+    def gather(self, rows: torch.Tensor, out: Optional[torch.Tensor] = None, unique: bool = False) -> torch.Tensor:
+        """
+        ``out[i] = table[rows[i]]``, ``out`` being allocated if not given and cast if of another dtype.
+        """
+        if out is None:
+            out = torch.empty(rows.shape[0], self.weight.shape[1], dtype=self.weight.dtype)
+        with self._lock:
+            positions, buffer_rows = self._locate(rows)
+            cached = buffer_rows >= 0
+            if bool(cached.all()):
+                return self._buffer_rows.gather(buffer_rows, out, unique=unique)
+            direct = (~cached).nonzero().squeeze(1)
+            self.direct_rows += direct.shape[0]
+            out[direct] = self._file_rows.gather(positions[direct], unique=unique).to(out.dtype)
+            cached = cached.nonzero().squeeze(1)
+            out[cached] = self._buffer_rows.gather(buffer_rows[cached], unique=unique).to(out.dtype)
+        return out
+
+    @torch.no_grad()
+    def scatter(self, rows: torch.Tensor, values: torch.Tensor) -> None:
+        """
+        ``table[rows[i]] = values[i]``, ``rows`` must be unique.
+        """
+        values = values.cpu()
+        with self._lock:
+            positions, buffer_rows = self._locate(rows)
+            cached = buffer_rows >= 0
+            self._slot_dirty[torch.div(buffer_rows[cached], self.block_rows, rounding_mode='floor')] = True
+            if bool(cached.all()):
+                self._buffer_rows.scatter(buffer_rows, values)
+                return
+            direct = ~cached
+            self.direct_rows += int(direct.sum())
+            self._file_rows.scatter(positions[direct], values[direct])
+            self._buffer_rows.scatter(buffer_rows[cached], values[cached])
+
+    def readahead(self, rows: torch.Tensor) -> None:
+        """
+        Ask the kernel to start reading the uncached blocks of ``rows``, e.g. those of a batch prepared a few
+        iterations later. Only a hint: it races harmlessly with concurrent calls.
+        """
+        blocks = torch.unique(torch.div(self._positions(rows), self.block_rows, rounding_mode='floor'))
+        blocks = blocks[self._block_slot.index_select(0, blocks) < 0]
+        if blocks.shape[0] == 0:
+            return
+        # coalesce consecutive blocks into a single madvise
+        starts = torch.ones(blocks.shape[0], dtype=torch.bool)
+        starts[1:] = blocks[1:] != blocks[:-1] + 1
+        first = blocks[starts]
+        last = blocks[torch.cat([starts[1:], torch.ones(1, dtype=torch.bool)])]
+        for lo, hi in zip(first.tolist(), last.tolist()):
+            start = lo * self.block_bytes // mmap.PAGESIZE * mmap.PAGESIZE
+            self._mmap.madvise(mmap.MADV_WILLNEED, start, (hi + 1) * self.block_bytes - start)
+
+    def on_local_node(self):
+        return self._file_rows.on_local_node()
+
+    def flush(self) -> None:
+        """
+        Write the dirty cached blocks back and flush the mapping to the file.
+        """
+        with self._lock:
+            slots = self._slot_dirty.nonzero().squeeze(1)
+            blocks, order = torch.sort(self._slot_block.index_select(0, slots))
+            self._file_blocks.scatter(blocks, self._buffer_blocks.index_select(0, slots[order]))
+            self._slot_dirty.fill_(False)
+            self._mmap.flush()
+
+    def stats(self):
+        return {
+            'host_block_hits': self.block_hits,
+            'host_block_misses': self.block_misses,
+            'host_direct_rows': self.direct_rows,
+        }
+
+    def close(self) -> None:
+        self.flush()
+        for engine in (self._file_rows, self._file_blocks, self._buffer_rows):
+            engine.close()
@@ -0,0 +1,293 @@
+import math
+from typing import Optional
+
+import torch
+
+
+class EvictionPolicy:
+    """
+    Decides which cache slots are evicted when missed rows need room.
+
+    Policies keep per-slot metadata on the cache device and are notified of every access, admission and eviction
+    by :class:`recsys.cache.index.CacheIndex`. The default implementation keeps one ``score`` per slot and evicts
+    the lowest scored unprotected slots.
+
+    Args:
+        cache_rows (int): number of cache slots.
+        device (torch.device): where the per-slot metadata lives.
+    """
+
+    def __init__(self, cache_rows: int, device: torch.device):
+        self.cache_rows = cache_rows
+        self.device = device
+        self.score = torch.zeros(cache_rows, dtype=torch.float64, device=device)
+
+    def on_access(self, slots: torch.Tensor, counts: torch.Tensor, step: int) -> None:
+        """
+        ``slots`` (unique) were referenced ``counts`` times by the batch ``step``.
+        """
+
+    def on_admit(self, slots: torch.Tensor, rows: torch.Tensor, step: int) -> None:
+        """
+        ``rows`` were just loaded into ``slots``.
+        """
+
+    def on_evict(self, slots: torch.Tensor, rows: torch.Tensor, step: int) -> None:
+        """
+        ``rows`` were just evicted from ``slots``.
+        """
+
+    def victims(self, num: int, protected: torch.Tensor) -> torch.Tensor:
+        """
+        Choose ``num`` occupied slots to evict, never one flagged in the boolean mask ``protected``.
+        """
+        score = self.score.masked_fill(protected, float('inf'))
+        return torch.topk(score, num, largest=False, sorted=False).indices
+
+    def refresh(self, slots: torch.Tensor, freq: torch.Tensor) -> None:
+        """
+        Re-rank the occupied ``slots`` with the externally tracked frequencies ``freq`` of their rows.
+        """
+        raise NotImplementedError(f"{type(self).__name__} can not be refreshed from id frequencies")
+
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Evict the slots referenced the least number of times since they were admitted.
+    """
+
+    def on_access(self, slots, counts, step):
+        self.score.index_add_(0, slots, counts.to(self.score.dtype))
+
+    def on_admit(self, slots, rows, step):
+        self.score.index_fill_(0, slots, 0)
+
+    def refresh(self, slots, freq):
+        self.score.index_copy_(0, slots, freq.to(device=self.device, dtype=self.score.dtype))
+
+
+class DatasetPolicy(EvictionPolicy):
+    """
+    Evict the rows that are the least frequent in the whole dataset, a static ranking given by the id-frequency
+    map. Without a map the rows with the largest ids are evicted first.
+
+    Args:
+        ids_freq_mapping (Optional[torch.Tensor]): count of every row, kept on the host.
+    """
+
+    def __init__(self, cache_rows, device, ids_freq_mapping: Optional[torch.Tensor] = None):
+        super().__init__(cache_rows, device)
+        self.ids_freq_mapping = ids_freq_mapping.cpu() if ids_freq_mapping is not None else None
+
+    def on_admit(self, slots, rows, step):
+        if self.ids_freq_mapping is not None:
+            freq = self.ids_freq_mapping.index_select(0, rows.cpu()).to(device=self.device, dtype=self.score.dtype)
+        else:
+            freq = -rows.to(self.score.dtype)
+        self.score.index_copy_(0, slots, freq)
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evict the slots whose last reference is the oldest.
+    """
+
+    def on_access(self, slots, counts, step):
+        self.score.index_fill_(0, slots, step)
+
+
+class DecayedLFUPolicy(EvictionPolicy):
+    """
+    LFU with aging: the count of a slot decays by ``decay`` every batch, so rows that were hot long ago are
+    eventually evicted when the working set drifts.
+
+    The decay is applied lazily, new references are scaled up by ``decay ** -step`` instead of multiplying every
+    score by ``decay``, and the scores are renormalized before the scale overflows.
+
+    Args:
+        decay (float): per-batch decay factor in (0, 1].
+    """
+
+    _MAX_SCALE = 1e30
+
+    def __init__(self, cache_rows, device, decay: float = 0.99):
+        super().__init__(cache_rows, device)
+        if not 0. < decay <= 1.:
+            raise ValueError(f"decay must be in (0, 1], got {decay}")
+        self.decay = decay
+        self._base_step = 0
+        self._scale = 1.
+
+    def _advance(self, step):
+        self._scale = self.decay**-(step - self._base_step)
+        if self._scale > self._MAX_SCALE:
+            self.score.div_(self._scale)
+            self._base_step = step
+            self._scale = 1.
+
+    def on_access(self, slots, counts, step):
+        self._advance(step)
+        self.score.index_add_(0, slots, counts.to(self.score.dtype) * self._scale)
+
+    def on_admit(self, slots, rows, step):
+        self.score.index_fill_(0, slots, 0)
+
+    def refresh(self, slots, freq):
+        self.score.index_copy_(0, slots, freq.to(device=self.device, dtype=self.score.dtype) * self._scale)
+
+
+class _TwoQueuePolicy(EvictionPolicy):
+    """
+    Base of the policies splitting the cache into a probation queue, for rows referenced once since admission,
+    and a main queue, for rows proven hot. ``score`` holds the recency key of each slot within its queue.
+
+    Recently evicted rows are remembered as ghosts: a per-row eviction sequence number (with the queue the row
+    was evicted from in the lowest bit) that stays valid for the next ``ghost_capacity`` evictions. A missed row
+    with a valid ghost is admitted straight into the main queue.
+
+    Args:
+        num_embeddings (int): number of rows of the table, the ghosts are indexed by row.
+        ghost_capacity (int): number of evictions a ghost is remembered for.
+    """
+
+    # whether rows evicted from the main queue leave a ghost
+    _ghost_main = True
+
+    def __init__(self, cache_rows, device, num_embeddings: int, ghost_capacity: int):
+        super().__init__(cache_rows, device)
+        self.occupied = torch.zeros(cache_rows, dtype=torch.bool, device=device)
+        self.in_main = torch.zeros(cache_rows, dtype=torch.bool, device=device)
+        self.ghost = torch.full((num_embeddings,), -1, dtype=torch.long, device=device)
+        self.ghost_capacity = ghost_capacity
+        self.num_ghosts = 0
+
+    def _probation_target(self) -> float:
+        """
+        Number of slots the probation queue may hold before it is evicted from first.
+        """
+        raise NotImplementedError()
+
+    def _on_ghost_hits(self, num_probation: int, num_main: int) -> None:
+        """
+        ``num_probation`` / ``num_main`` missed rows were remembered as ghosts of the respective queue.
+        """
+
+    def on_admit(self, slots, rows, step):
+        ghost = self.ghost.index_select(0, rows)
+        valid = (ghost >= 0) & (self.num_ghosts - (ghost >> 1) <= self.ghost_capacity)
+        from_main = valid & (ghost & 1).bool()
+        self._on_ghost_hits(int(valid.sum()) - int(from_main.sum()), int(from_main.sum()))
+        self.ghost[rows[valid]] = -1
+        self.occupied[slots] = True
+        self.in_main[slots] = valid
+        self.score.index_fill_(0, slots, step)
+
+    def on_evict(self, slots, rows, step):
+        in_main = self.in_main.index_select(0, slots)
+        if not self._ghost_main:
+            rows, in_main = rows[~in_main], in_main[~in_main]
+        seq = torch.arange(self.num_ghosts, self.num_ghosts + rows.shape[0], device=self.device)
+        self.ghost[rows] = seq * 2 + in_main.long()
+        self.num_ghosts += rows.shape[0]
+        self.occupied[slots] = False
+        self.in_main[slots] = False
+
+    def _lowest(self, num, candidates):
+        if num == 0:
+            return torch.empty(0, dtype=torch.long, device=self.device)
+        score = self.score.masked_fill(~candidates, float('inf'))
+        return torch.topk(score, num, largest=False, sorted=False).indices
+
+    def victims(self, num, protected):
+        probation = self.occupied & ~self.in_main
+        candidates = probation & ~protected
+        main_candidates = self.in_main & ~protected
+        excess = int(probation.sum()) - self._probation_target()
+        num_probation = min(max(int(math.ceil(excess)), 0), num)
+        num_probation = min(max(num_probation, num - int(main_candidates.sum())), int(candidates.sum()))
+        return torch.cat([self._lowest(num_probation, candidates), self._lowest(num - num_probation, main_candidates)])
+
+
+class ARCPolicy(_TwoQueuePolicy):
+    """
+    Adaptive Replacement Cache. Both queues are LRU, a probation row referenced again is promoted to the main
+    queue, and the probation target grows on ghost hits of probation rows and shrinks on ghost hits of main rows.
+    The target moves by one slot per ghost hit, the ghost lists share a capacity of ``cache_rows`` evictions.
+    """
+
+    def __init__(self, cache_rows, device, num_embeddings: int):
+        super().__init__(cache_rows, device, num_embeddings, ghost_capacity=cache_rows)
+        self.target = 0.
+
+    def _probation_target(self):
+        return self.target
+
+    def _on_ghost_hits(self, num_probation, num_main):
+        self.target = min(max(self.target + num_probation - num_main, 0.), float(self.cache_rows))
+
+    def on_access(self, slots, counts, step):
+        # slots admitted by this batch were stamped with the current step in on_admit
+        promote = self.score.index_select(0, slots) < step
+        self.in_main[slots[promote]] = True
+        self.score.index_fill_(0, slots, step)
+
+
+class TwoQPolicy(_TwoQueuePolicy):
+    """
+    Full 2Q: new rows enter a FIFO probation queue of ``probation_ratio * cache_rows`` slots, rows evicted from it
+    are remembered for ``ghost_ratio * cache_rows`` evictions and enter the LRU main queue when missed again.
+
+    Args:
+        probation_ratio (float): size of the probation queue relative to the cache (Kin).
+        ghost_ratio (float): ghost capacity relative to the cache (Kout).
+    """
+
+    _ghost_main = False
+
+    def __init__(self,
+                 cache_rows,
+                 device,
+                 num_embeddings: int,
+                 probation_ratio: float = 0.25,
+                 ghost_ratio: float = 0.5):
+        super().__init__(cache_rows, device, num_embeddings, ghost_capacity=int(ghost_ratio * cache_rows))
+        self.probation_rows = probation_ratio * cache_rows
+
+    def _probation_target(self):
+        return self.probation_rows
+
+    def on_access(self, slots, counts, step):
+        main = slots[self.in_main.index_select(0, slots)]
+        self.score.index_fill_(0, main, step)
+
+
+EVICTION_POLICIES = {
+    'lfu': LFUPolicy,
+    'dataset': DatasetPolicy,
+    'lru': LRUPolicy,
+    'decayed_lfu': DecayedLFUPolicy,
+    'arc': ARCPolicy,
+    '2q': TwoQPolicy,
+}
+
+
+def build_eviction_policy(name: str,
+                          cache_rows: int,
+                          device: torch.device,
+                          ids_freq_mapping: Optional[torch.Tensor] = None,
+                          num_embeddings: Optional[int] = None) -> EvictionPolicy:
+    """
+    Build the eviction policy ``name`` of :data:`EVICTION_POLICIES`. ``ids_freq_mapping`` is only used by the
+    dataset policy, ``num_embeddings`` is required by the policies keeping ghosts (arc, 2q).
+    """
+    name = name.lower()
+    if name not in EVICTION_POLICIES:
+        raise ValueError(f"Unsupported eviction policy {name}, must be one of {' | '.join(EVICTION_POLICIES)}")
+    policy_cls = EVICTION_POLICIES[name]
+    if policy_cls is DatasetPolicy:
+        return DatasetPolicy(cache_rows, device, ids_freq_mapping)
+    if issubclass(policy_cls, _TwoQueuePolicy):
+        if num_embeddings is None:
+            raise ValueError(f"The {name} eviction policy requires num_embeddings")
+        return policy_cls(cache_rows, device, num_embeddings)
+    return policy_cls(cache_rows, device)
@@ -0,0 +1,86 @@
+"""
+Reduced-precision storage of the cached rows.
+
+The cache of :class:`recsys.cache.CachedEmbeddingBag` can hold fp16 / bf16 rows. The cached row is the only copy
+updated, so there is no fp32 master: an in-memory or file-backed host table is stored in the cache dtype as well,
+rows being rounded to the nearest once when the table is initialized and swapped in and out exactly, which halves the
+host table, the cache footprint and the transfer volume. The lookups are widened back to fp32 for the model. Updates
+applied in the reduced precision lose every change smaller than half a unit in the last place, the cache rows are
+therefore updated with :class:`StochasticRoundingSGD`, which computes the update in fp32 and rounds it
+stochastically, unbiased on average.
+"""
+from typing import Optional
+
+import torch
+from torch.optim import Optimizer
+
+CACHE_DTYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def cache_dtype(name: Optional[str]) -> Optional[torch.dtype]:
+    if name is None:
+        return None
+    if name not in CACHE_DTYPES:
+        raise ValueError(f"Unsupported cache dtype {name}, must be one of {' | '.join(CACHE_DTYPES)}")
+    return CACHE_DTYPES[name]
+
+
+def stochastic_round(x: torch.Tensor, dtype: torch.dtype, generator: Optional[torch.Generator] = None) -> torch.Tensor:
+    """
+    Round ``x`` to ``dtype``, to either neighbour with a probability proportional to the distance to the other one.
+    """
+    x = x.float()
+    nearest = x.to(dtype)
+    residual = x - nearest.float()
+    direction = torch.where(residual >= 0, float('inf'), float('-inf')).to(dtype)
+    away = torch.nextafter(nearest, direction)
+    # nan for infinite values, which stay rounded to the nearest
+    p = residual / (away.float() - nearest.float())
+    take = torch.rand(x.shape, device=x.device, generator=generator) < p
+    return torch.where(take, away, nearest)
+
+
+class StochasticRoundingSGD(Optimizer):
+    """
+    Plain SGD, dense or sparse gradients, with the updates of reduced-precision parameters computed in fp32 and
+    stochastically rounded. fp32 parameters are updated as by ``torch.optim.SGD``.
+
+    Args:
+        params: parameters or parameter groups.
+        lr (float): learning rate.
+        stochastic_rounding (bool): round the reduced-precision updates to the nearest when False.
+    """
+
+    def __init__(self, params, lr: float, stochastic_rounding: bool = True):
+        super().__init__(params, dict(lr=lr, stochastic_rounding=stochastic_rounding))
+
+    @staticmethod
+    def _round(x: torch.Tensor, dtype: torch.dtype, stochastic: bool) -> torch.Tensor:
+        return stochastic_round(x, dtype) if stochastic else x.to(dtype)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            lr, stochastic = group['lr'], group['stochastic_rounding']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                if p.dtype == torch.float32 or p.dtype == torch.float64:
+                    p.add_(grad, alpha=-lr)
+                elif grad.is_sparse:
+                    grad = grad.coalesce()
+                    rows = grad.indices()[0]
+                    updated = p.index_select(0, rows).float().add_(grad.values().float(), alpha=-lr)
+                    p.index_copy_(0, rows, self._round(updated, p.dtype, stochastic))
+                else:
+                    p.copy_(self._round(p.float().add_(grad.float(), alpha=-lr), p.dtype, stochastic))
+        return loss
@@ -0,0 +1,157 @@
+"""
+Sliding-window prefetch of the software cache.
+
+Chunked prefetching prepares ``prefetch_num`` batches at once every ``prefetch_num`` iterations, so one iteration
+in N stalls on a large cache update. :class:`LookaheadPrefetcher` instead prepares one batch per iteration, a
+fixed number of batches ahead of the one being computed, on a worker thread. The rows of every prepared batch stay
+pinned in the cache until that batch is released, so preparing a later batch never evicts them. A preparation writes
+rows into the cache weight, so it is only started after the optimizer step of the batch before and the next step
+waits for it. With a slow host tier, the ids of a batch can also be handed to ``CacheBackend.readahead`` a few
+batches before its preparation.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import torch
+from torch.profiler import record_function
+
+from .base import CacheBackend
+
+
+class LookaheadPrefetcher:
+    """
+    Prepares the ids of upcoming batches while the current batch computes.
+
+    Every job (preparing a batch, releasing one, or :meth:`call`) runs in submission order on a single worker
+    thread, which is the only one touching the cache state. On cuda, the jobs run on a side stream: a job first
+    waits for the work the main stream had queued when it was submitted, and the main stream waits for a prepared
+    batch's swaps before using its slots.
+
+    Usage: :meth:`put` the ids of each upcoming batch, :meth:`get` the slots of the oldest one before its forward
+    pass, :meth:`wait_prepared` before its optimizer step and :meth:`release` it after. The preparations of the
+    batches put are submitted by :meth:`release`, after the step, or by :meth:`get` for the oldest one: they swap
+    rows into the cache weight, which a step with dense gradients reads and writes as a whole. With ``readahead``, a
+    batch is read ahead when put and prepared once ``readahead`` more batches are put.
+
+    Args:
+        backend (CacheBackend): the cache, it must support pinning.
+        use_thread (bool): prepare on the worker thread, otherwise inline in :meth:`put`.
+        readahead (int): number of put batches read ahead but not prepared yet.
+    """
+
+    def __init__(self, backend: CacheBackend, use_thread: bool = True, readahead: int = 0):
+        if not backend.supports_pinning:
+            raise NotImplementedError(f"{type(backend).__name__} does not support pinning cache rows, which the "
+                                      f"lookahead prefetch requires")
+        self.backend = backend
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-prefetch") \
+            if use_thread else None
+        device = getattr(backend, 'device', torch.device('cpu'))
+        self._stream = torch.cuda.Stream(device) if use_thread and device.type == 'cuda' else None
+        self.readahead = readahead
+        # ids of the batches read ahead and not prepared yet
+        self._reading = deque()
+        # futures of the prepared batches not handed out yet, and of the read aheads and releases not checked yet
+        self._prepared = deque()
+        self._releases = []
+        # slots of the batches handed out by get and not released yet
+        self._current = []
+
+    def __len__(self):
+        return len(self._reading) + len(self._prepared)
+
+    def _run(self, fn: Callable, event: Optional[torch.cuda.Event], *args):
+        if self._stream is None:
+            return fn(*args), None
+        with torch.cuda.stream(self._stream):
+            self._stream.wait_event(event)
+            result = fn(*args)
+            done = torch.cuda.Event()
+            done.record(self._stream)
+        return result, done
+
+    def _submit(self, fn: Callable, *args) -> Future:
+        event = None
+        if self._stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+        if self._executor is not None:
+            return self._executor.submit(self._run, fn, event, *args)
+        future = Future()
+        try:
+            future.set_result(self._run(fn, event, *args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def _prepare(self, ids: torch.Tensor) -> torch.Tensor:
+        with record_function("(cache) lookahead prepare"):
+            return self.backend.prepare_ids(ids, pin=True)
+
+    def put(self, ids: torch.Tensor) -> None:
+        """
+        Queue the next batch, ``ids`` being its sparse feature values, prepared from the next :meth:`release` on.
+        """
+        if self.readahead > 0:
+            self._releases.append(self._submit(self.backend.readahead, ids))
+        self._reading.append(ids)
+
+    def get(self) -> torch.Tensor:
+        """
+        The cache slots of the oldest queued batch, waiting for its preparation if needed.
+        """
+        for future in self._releases:
+            future.result()
+        self._releases = []
+        if not self._prepared:
+            self._prepared.append(self._submit(self._prepare, self._reading.popleft()))
+        with record_function("(cache) lookahead wait"):
+            slots, done = self._prepared.popleft().result()
+        if done is not None:
+            torch.cuda.current_stream().wait_event(done)
+            slots.record_stream(torch.cuda.current_stream())
+        self._current.append(slots)
+        return slots
+
+    def wait_prepared(self) -> None:
+        """
+        Wait for the preparations submitted so far, the current stream waiting for their swaps, before work writing
+        the whole cache weight such as an optimizer step with dense gradients.
+        """
+        with record_function("(cache) lookahead wait"):
+            for future in self._prepared:
+                _, done = future.result()
+                if done is not None:
+                    torch.cuda.current_stream().wait_event(done)
+
+    def release(self) -> None:
+        """
+        Unpin the batches handed out by :meth:`get`, once the work queued on the current stream is done, and
+        prepare the batches put beyond the ``readahead`` ones, after that work too.
+        """
+        for slots in self._current:
+            self._releases.append(self._submit(self.backend.unpin, slots))
+        self._current = []
+        while len(self._reading) > self.readahead:
+            self._prepared.append(self._submit(self._prepare, self._reading.popleft()))
+
+    def call(self, fn: Callable, *args) -> Any:
+        """
+        Run ``fn(*args)`` after the queued jobs, for anything else touching the cache state, e.g.
+        ``refresh_eviction_ranking``. Blocks until it returns.
+        """
+        return self._submit(fn, *args).result()[0]
+
+    def close(self) -> None:
+        """
+        Release every batch, including the ones queued but never handed out, and stop the worker.
+        """
+        while self._prepared or self._reading:
+            self.get()
+        self.release()
+        for future in self._releases:
+            future.result()
+        self._releases = []
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -0,0 +1,159 @@
+"""
+Row-wise quantized host tier of :class:`recsys.cache.CachedEmbeddingBag`.
+
+Every row of the host table is stored as int8 or int4 codes followed by its own fp16 scale and bias (the row
+minimum), as the row-wise quantized tables of FBGEMM, which shrinks an fp32 host table about 4x (int8) or 8x (int4).
+The rows move between the host and the device in this packed form, so the swap traffic shrinks as much: they are
+dequantized on the device when loaded into the cache, and quantized on the device when evicted.
+
+Quantizing an evicted row loses its updates smaller than half a quantization step, the evicted rows are therefore
+quantized stochastically: the small updates survive on average.
+"""
+from typing import Optional
+
+import torch
+
+from .host_rows import HostRowEngine
+
+HOST_QUANTIZATIONS = {
+    'int8': 8,
+    'int4': 4,
+}
+
+# bytes of the fp16 scale and bias closing every packed row
+_SCALE_BIAS_BYTES = 4
+
+
+class QuantizedRowStore:
+    """
+    A ``(num_rows, row_size)`` table stored row-wise quantized, as packed uint8 rows of :attr:`row_bytes` bytes: the
+    codes, then the fp16 scale and bias. :meth:`gather` and :meth:`scatter` move packed rows with the multithreaded
+    :class:`recsys.cache.host_rows.HostRowEngine`, :meth:`encode` and :meth:`decode` convert them from and to values
+    on the device of their input.
+
+    The table starts zeroed, see :meth:`copy_` and :meth:`uniform_`.
+
+    Args:
+        num_rows (int): number of rows.
+        row_size (int): row size, the embedding dimension.
+        quantization (str): ``int8`` or ``int4``, see :data:`HOST_QUANTIZATIONS`.
+        stochastic_rounding (bool): quantize the evicted rows stochastically, to the nearest when False.
+        num_threads (int): threads of the packed row gather / scatter.
+    """
+
+    def __init__(self,
+                 num_rows: int,
+                 row_size: int,
+                 quantization: str = 'int8',
+                 stochastic_rounding: bool = True,
+                 num_threads: int = 4):
+        if quantization not in HOST_QUANTIZATIONS:
+            raise ValueError(f"Unsupported host quantization {quantization}, "
+                             f"must be one of {' | '.join(HOST_QUANTIZATIONS)}")
+        self.num_rows = num_rows
+        self.row_size = row_size
+        self.bits = HOST_QUANTIZATIONS[quantization]
+        self.max_code = (1 << self.bits) - 1
+        self.stochastic_rounding = stochastic_rounding
+        # int4 codes are packed two per byte, the low nibble first
+        self.code_cols = row_size if self.bits == 8 else -(-row_size // 2)
+        self.packed = torch.zeros(num_rows, self.code_cols + _SCALE_BIAS_BYTES, dtype=torch.uint8)
+        self._rows = HostRowEngine(self.packed, num_threads)
+
+        self.quantized_rows = 0
+
+    @property
+    def row_bytes(self) -> int:
+        return self.packed.shape[1]
+
+    @torch.no_grad()
+    def encode(self, values: torch.Tensor, stochastic: Optional[bool] = None) -> torch.Tensor:
+        """
+        Quantize ``values`` into packed rows, stochastically unless ``stochastic`` or ``stochastic_rounding`` is
+        False.
+        """
+        stochastic = self.stochastic_rounding if stochastic is None else stochastic
+        values = values.float()
+        lo, hi = values.aminmax(dim=1, keepdim=True)
+        scale = ((hi - lo) / self.max_code).half()
+        # constant rows are all bias
+        scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+        bias = lo.half()
+        codes = (values - bias.float()) / scale.float()
+        if stochastic:
+            codes = codes.add_(torch.rand_like(codes)).floor_()
+        else:
+            codes = codes.round_()
+        codes = codes.clamp_(0, self.max_code).to(torch.uint8)
+        if self.bits == 4:
+            if self.row_size % 2:
+                codes = torch.nn.functional.pad(codes, (0, 1))
+            codes = codes[:, 0::2] | (codes[:, 1::2] << 4)
+        self.quantized_rows += values.shape[0]
+        return torch.cat([codes, torch.cat([scale, bias], dim=1).view(torch.uint8)], dim=1)
+
+    @torch.no_grad()
+    def decode(self, packed: torch.Tensor, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+        """
+        Dequantize packed rows into ``dtype`` values.
+        """
+        codes = packed[:, :self.code_cols]
+        if self.bits == 4:
+            codes = torch.stack([codes & 0xF, codes >> 4], dim=2).view(codes.shape[0], -1)[:, :self.row_size]
+        scale_bias = packed[:, self.code_cols:].contiguous().view(torch.float16).float()
+        return torch.addcmul(scale_bias[:, 1:], codes.float(), scale_bias[:, :1]).to(dtype)
+
+    @torch.no_grad()
+    def copy_(self, weight: torch.Tensor, chunk_rows: int = 1 << 20) -> 'QuantizedRowStore':
+        """
+        Quantize ``weight`` into the table, ``chunk_rows`` rows at a time, rounding to the nearest.
+        """
+        for lo in range(0, self.num_rows, chunk_rows):
+            self.packed[lo:lo + chunk_rows] = self.encode(weight[lo:lo + chunk_rows].cpu(), stochastic=False)
+        self.quantized_rows = 0
+        return self
+
+    @torch.no_grad()
+    def uniform_(self, a: float, b: float, chunk_rows: int = 1 << 20) -> 'QuantizedRowStore':
+        for lo in range(0, self.num_rows, chunk_rows):
+            hi = min(lo + chunk_rows, self.num_rows)
+            self.packed[lo:hi] = self.encode(torch.empty(hi - lo, self.row_size).uniform_(a, b), stochastic=False)
+        self.quantized_rows = 0
+        return self
+
+    def on_local_node(self):
+        return self._rows.on_local_node()
+
+    @staticmethod
+    def is_sorted_unique(rows: torch.Tensor) -> bool:
+        return HostRowEngine.is_sorted_unique(rows)
+
+    def gather(self, rows: torch.Tensor, out: Optional[torch.Tensor] = None, unique: bool = False) -> torch.Tensor:
+        """
+        ``out[i] = packed[rows[i]]``, ``out`` being allocated if not given.
+        """
+        return self._rows.gather(rows, out, unique=unique)
+
+    def scatter(self, rows: torch.Tensor, packed: torch.Tensor) -> None:
+        """
+        ``packed[rows[i]] = packed[i]``, ``rows`` must be unique.
+        """
+        self._rows.scatter(rows, packed)
+
+    def readahead(self, rows: torch.Tensor) -> None:
+        pass
+
+    def flush(self) -> None:
+        """
+        Nothing to do, the table is in memory.
+        """
+
+    def stats(self):
+        return {
+            'host_table_bytes': self.packed.numel(),
+            'host_fp32_table_bytes': self.num_rows * self.row_size * 4,
+            'host_quantized_rows': self.quantized_rows,
+        }
+
+    def close(self) -> None:
+        self._rows.close()
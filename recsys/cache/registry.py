@@ -0,0 +1,112 @@
+from typing import Callable, Dict
+
+import torch
+
+from .base import CacheBackend
+from . import precision
+from .embedding import CachedEmbeddingBag
+from .sizing import cache_rows_for_budget
+
+CACHE_BACKENDS: Dict[str, Callable[..., CacheBackend]] = {}
+
+
+def register_cache_backend(name: str):
+    """
+    Register a factory building a :class:`CacheBackend` from ``(num_embeddings_per_feature, embedding_dim,
+    **kwargs)``, the keyword arguments are those of :func:`build_cache_backend`.
+    """
+
+    def register(factory):
+        if name in CACHE_BACKENDS:
+            raise ValueError(f"Cache backend {name} is already registered")
+        CACHE_BACKENDS[name] = factory
+        return factory
+
+    return register
+
+
+def build_cache_backend(name: str, num_embeddings_per_feature, embedding_dim, **kwargs) -> CacheBackend:
+    """
+    Build the cache backend registered as ``name``.
+
+    Keyword arguments accepted by every backend: ``sparse``, ``mode``, ``cache_ratio``, ``id_freq_map``,
+    ``warmup_ratio``, ``buffer_size``, ``evict_strategy``, ``tablewise``, ``dataset``, ``device``, ``admission``,
+    ``bypass_ratio``, ``numa_policy``, ``host_table_file``, ``host_cache_bytes``, ``cache_dtype`` (a name of
+    ``recsys.cache.precision.CACHE_DTYPES``), ``host_quantization``, ``cache_budget_bytes`` and ``min_cache_rows``.
+    In tablewise mode ``evict_strategy`` may list one policy per table.
+
+    With ``cache_budget_bytes`` the cache holds that many bytes of rows instead of ``cache_ratio`` of the rows, split
+    over the tables by :func:`recsys.cache.sizing.cache_rows_for_budget`, each table getting at least
+    ``min_cache_rows`` rows.
+    """
+    if name not in CACHE_BACKENDS:
+        raise ValueError(f"Unsupported cache backend {name}, must be one of {' | '.join(CACHE_BACKENDS)}")
+    return CACHE_BACKENDS[name](num_embeddings_per_feature, embedding_dim, **kwargs)
+
+
+@register_cache_backend('colossalai')
+def _build_colossalai(num_embeddings_per_feature, embedding_dim, **kwargs):
+    # colossalai is only imported when selected, the reference backend runs without it
+    from .colossalai_backend import build_colossalai_backend
+    return build_colossalai_backend(num_embeddings_per_feature, embedding_dim, **kwargs)
+
+
+@register_cache_backend('reference')
+def _build_reference(num_embeddings_per_feature,
+                     embedding_dim,
+                     sparse=False,
+                     mode='sum',
+                     cache_ratio=0.01,
+                     id_freq_map=None,
+                     warmup_ratio=0.7,
+                     buffer_size=0,
+                     evict_strategy='dataset',
+                     tablewise=False,
+                     dataset=None,
+                     device=None,
+                     admission=None,
+                     bypass_ratio=0.1,
+                     numa_policy='none',
+                     host_table_file=None,
+                     host_cache_bytes=1 << 30,
+                     cache_dtype=None,
+                     host_quantization=None,
+                     cache_budget_bytes=None,
+                     min_cache_rows=0):
+    if torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1:
+        raise NotImplementedError("The reference cache backend only runs on a single process")
+    num_embeddings = sum(num_embeddings_per_feature)
+    cache_dtype = precision.cache_dtype(cache_dtype)
+    if cache_budget_bytes is not None:
+        # the scratch rows of the admission filter are part of the footprint
+        row_bytes = embedding_dim * torch.empty(0, dtype=cache_dtype or torch.float32).element_size()
+        if admission is not None and admission != 'none':
+            row_bytes *= 1 + bypass_ratio
+        cache_rows = cache_rows_for_budget(num_embeddings_per_feature, row_bytes, cache_budget_bytes, id_freq_map,
+                                           min_rows=min_cache_rows)
+        table_rows = num_embeddings_per_feature
+    elif tablewise:
+        # one cache segment per table, with the same headroom as prepare_tablewise_config
+        cache_rows = [min(n, int(cache_ratio * n) + 2000) for n in num_embeddings_per_feature]
+        table_rows = num_embeddings_per_feature
+    else:
+        cache_rows = max(1, int(cache_ratio * num_embeddings))
+        table_rows = None
+    return CachedEmbeddingBag(num_embeddings,
+                              embedding_dim,
+                              cache_rows=cache_rows,
+                              mode=mode,
+                              include_last_offset=True,
+                              sparse=sparse,
+                              ids_freq_mapping=id_freq_map,
+                              warmup_ratio=warmup_ratio,
+                              evict_strategy=evict_strategy,
+                              device=device,
+                              table_rows=table_rows,
+                              admission=admission,
+                              bypass_ratio=bypass_ratio,
+                              numa_policy=numa_policy,
+                              host_table_file=host_table_file,
+                              host_cache_bytes=host_cache_bytes,
+                              cache_dtype=cache_dtype,
+                              host_quantization=host_quantization)
@@ -0,0 +1,203 @@
+"""
+Fully resident small tables next to a software cache.
+
+Most tables of the Criteo datasets have a few thousand rows at most, they fit on the compute device as they are
+and can never miss, yet concatenated with the large tables every one of their ids goes through the cache index.
+:class:`ResidentSplitEmbeddingBag` keeps the tables under a row threshold in a plain embedding bag on the device,
+and only hands the ids of the other tables to the cache.
+
+On several processes the resident table is replicated as the dense modules: every rank computes the bags of its
+own shard of the batch, that the colossalai cache returns after its all-to-all, and the gradient of the resident table
+is summed over the ranks, as that of the colossalai table whose columns receive the gradient of every rank.
+"""
+import itertools
+import math
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .base import CacheBackend
+
+
+class ResidentSplitEmbeddingBag(nn.Module, CacheBackend):
+    """
+    A :class:`CacheBackend` over feature-major bags of one table per feature, serving the ``resident`` tables from
+    a device-resident embedding bag and the others from the ``cached`` backend, built over those tables only.
+
+    Ids are global, offset by table as by the dataloaders. :meth:`prepare_ids` translates the ids of cached tables
+    into slots of ``cached`` and encodes the ids of resident tables as negative rows of the resident bag, so that
+    prepared ids can be queued and pinned like those of any backend.
+
+    Args:
+        num_embeddings_per_feature (List[int]): number of rows of every table.
+        resident (List[bool]): whether every table is resident, some but not all of them.
+        cached (CacheBackend): feature-major cache over the cached tables, ids offset within them.
+        embedding_dim (int): embedding dimension.
+        mode (str): reduction of the bags, sum | mean | max.
+        sparse (bool): whether the gradient of the resident table is sparse, it is dense on several processes to be
+            all-reduced.
+        device (Optional[torch.device]): device of the resident table, that of ``cached`` if not given.
+    """
+
+    def __init__(self,
+                 num_embeddings_per_feature: List[int],
+                 resident: List[bool],
+                 cached: CacheBackend,
+                 embedding_dim: int,
+                 mode: str = 'sum',
+                 sparse: bool = False,
+                 device: Optional[torch.device] = None):
+        super(ResidentSplitEmbeddingBag, self).__init__()
+        if all(resident) or not any(resident) or not cached.feature_major_output:
+            raise ValueError("ResidentSplitEmbeddingBag requires both resident and cached tables, and a "
+                             "feature-major cache")
+        distributed = torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1
+        self.rank = torch.distributed.get_rank() if distributed else 0
+        self.cached = cached
+        self.mode = mode
+        self.sparse = sparse and not distributed
+        device = device if device is not None else getattr(cached, 'device', torch.device('cpu'))
+        self.supports_pinning = cached.supports_pinning
+        self.num_features = len(num_embeddings_per_feature)
+        self.resident_features = [t for t, r in enumerate(resident) if r]
+        self.cached_features = [t for t, r in enumerate(resident) if not r]
+
+        table_offsets = [0, *itertools.accumulate(num_embeddings_per_feature)]
+        self._cached_ranges = [(table_offsets[t], table_offsets[t + 1]) for t in self.cached_features]
+        # per table: whether resident, and the shift of its ids into the resident or cached rows
+        shift, resident_rows, cached_rows = [], 0, 0
+        for t, n in enumerate(num_embeddings_per_feature):
+            if resident[t]:
+                shift.append(resident_rows - table_offsets[t])
+                resident_rows += n
+            else:
+                shift.append(cached_rows - table_offsets[t])
+                cached_rows += n
+        order = self.resident_features + self.cached_features
+        # buffers, so that they follow the module to its device
+        for name, value in (('_table_bounds', table_offsets[1:-1]), ('_is_resident', resident), ('_shift', shift),
+                            ('_feature_order', [order.index(t) for t in range(self.num_features)]),
+                            ('_resident_index', self.resident_features), ('_cached_index', self.cached_features)):
+            self.register_buffer(name, torch.tensor(value, device=device), persistent=False)
+
+        weight = torch.empty(resident_rows, embedding_dim, device=device)
+        for t in self.resident_features:
+            bound = math.sqrt(1. / num_embeddings_per_feature[t])
+            lo = table_offsets[t] + shift[t]
+            weight[lo:lo + num_embeddings_per_feature[t]].uniform_(-bound, bound)
+        self.resident_weight = nn.Parameter(weight)
+        if distributed:
+            # every rank starts from the table of rank 0, and keeps it by summing the gradients over the ranks
+            torch.distributed.broadcast(self.resident_weight.data, 0)
+            self.resident_weight.register_hook(self._all_reduce_grad)
+
+    @staticmethod
+    def _all_reduce_grad(grad: torch.Tensor) -> torch.Tensor:
+        grad = grad.clone()
+        torch.distributed.all_reduce(grad)
+        return grad
+
+    @property
+    def device(self) -> torch.device:
+        return self.resident_weight.device
+
+    @torch.no_grad()
+    def _split(self, ids: torch.Tensor):
+        """
+        Whether every id is of a resident table, and its row in the resident or the cached rows.
+        """
+        table = torch.bucketize(ids, self._table_bounds, right=True)
+        return self._is_resident.index_select(0, table), ids + self._shift.index_select(0, table)
+
+    @torch.no_grad()
+    def prepare_ids(self, ids: torch.Tensor, pin: bool = False) -> torch.Tensor:
+        ids = ids.to(self.device)
+        is_resident, rows = self._split(ids)
+        slots = torch.empty_like(ids)
+        slots[is_resident] = -1 - rows[is_resident]
+        in_cache = ~is_resident
+        slots[in_cache] = self.cached.prepare_ids(rows[in_cache], pin=pin).to(slots.dtype)
+        return slots
+
+    def unpin(self, slots: torch.Tensor) -> None:
+        self.cached.unpin(slots[slots >= 0])
+
+    def readahead(self, ids: torch.Tensor) -> None:
+        is_resident, rows = self._split(ids.to(self.device))
+        self.cached.readahead(rows[~is_resident])
+
+    @staticmethod
+    def _group_offsets(lengths: torch.Tensor) -> torch.Tensor:
+        return F.pad(torch.cumsum(lengths.reshape(-1), 0), (1, 0))
+
+    def lookup(self,
+               ids: torch.Tensor,
+               offsets: torch.Tensor,
+               per_sample_weights: Optional[torch.Tensor] = None,
+               shape_hook: Optional[Callable] = None,
+               cache_op: bool = True) -> torch.Tensor:
+        slots = self.prepare_ids(ids) if cache_op else ids
+        # one table per feature, the bags of a feature are contiguous: so are its ids
+        offsets = offsets.to(slots)
+        batch_size = (offsets.shape[0] - 1) // self.num_features
+        lengths = (offsets[1:] - offsets[:-1]).view(self.num_features, batch_size)
+        is_resident = slots < 0
+        resident_weights, cached_weights = None, None
+        if per_sample_weights is not None:
+            resident_weights, cached_weights = per_sample_weights[is_resident], per_sample_weights[~is_resident]
+
+        # batch-major, the colossalai cache scatters the batch over the ranks
+        num_cached = len(self.cached_features)
+        cached = self.cached.lookup(slots[~is_resident],
+                                    self._group_offsets(lengths.index_select(0, self._cached_index)),
+                                    cached_weights,
+                                    shape_hook=lambda x: x.view(num_cached, batch_size, -1).transpose(0, 1),
+                                    cache_op=False)
+
+        # only the bags of the shard of the batch returned by the cache, colossalai splits the batch evenly
+        shard_size = cached.shape[0]
+        resident_slots = slots[is_resident]
+        resident_lengths = lengths.index_select(0, self._resident_index)
+        if shard_size != batch_size:
+            start = self.rank * shard_size
+            in_shard = torch.zeros_like(resident_lengths, dtype=torch.bool)
+            in_shard[:, start:start + shard_size] = True
+            in_shard = torch.repeat_interleave(in_shard.view(-1), resident_lengths.view(-1))
+            resident_slots = resident_slots[in_shard]
+            if resident_weights is not None:
+                resident_weights = resident_weights[in_shard]
+            resident_lengths = resident_lengths[:, start:start + shard_size]
+        resident = F.embedding_bag(-1 - resident_slots,
+                                   self.resident_weight,
+                                   self._group_offsets(resident_lengths),
+                                   mode=self.mode,
+                                   sparse=self.sparse,
+                                   per_sample_weights=resident_weights,
+                                   include_last_offset=True)
+        embeddings = torch.cat([
+            resident.view(len(self.resident_features), shard_size, -1),
+            cached.to(resident.dtype).transpose(0, 1)
+        ]).index_select(0, self._feature_order).view(self.num_features * shard_size, -1)
+        if shape_hook is not None:
+            embeddings = shape_hook(embeddings)
+        return embeddings
+
+    def forward(self, ids, offsets, per_sample_weights=None, shape_hook=None, cache_op=True):
+        return self.lookup(ids, offsets, per_sample_weights, shape_hook, cache_op)
+
+    def flush(self) -> None:
+        self.cached.flush()
+
+    def stats(self) -> Dict[str, float]:
+        return self.cached.stats()
+
+    def element_size(self) -> float:
+        return self.cached.element_size()
+
+    def set_async_copy(self, enable: bool) -> None:
+        self.cached.set_async_copy(enable)
+
+    def refresh_eviction_ranking(self, freq: torch.Tensor) -> None:
+        self.cached.refresh_eviction_ranking(torch.cat([freq[lo:hi] for lo, hi in self._cached_ranges]))
@@ -0,0 +1,169 @@
+"""
+Trace-driven model of the software cache: replays id batches through :class:`recsys.cache.index.CacheIndex`
+without embedding data, so hit rates and transfer volumes of many cache configurations are obtained on CPU in
+a single pass over the id stream.
+"""
+import math
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+import torch
+
+from .admission import build_admission_filter
+from .index import CacheIndex
+from .policy import build_eviction_policy
+
+
+@dataclass
+class SimulationResult:
+    policy: str
+    cache_rows: int
+    cache_ratio: float
+    num_steps: int
+    hits: int
+    misses: int
+    swap_in_rows: int
+    swap_out_rows: int
+    swap_in_bytes: int
+    swap_out_bytes: int
+    num_transfers: int
+    transfer_time: float
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __str__(self):
+        return f"{self.policy:>20} cache rows {self.cache_rows:>12,} ({self.cache_ratio * 100:6.2f}%): " \
+               f"hit rate {self.hit_rate * 100:6.2f}%, " \
+               f"swap in {self.swap_in_rows:,} rows / {self.swap_in_bytes / 1024**3:.2f} GB, " \
+               f"swap out {self.swap_out_rows:,} rows / {self.swap_out_bytes / 1024**3:.2f} GB, " \
+               f"projected transfer time {self.transfer_time:.2f}s"
+
+
+class CacheSimulator:
+    """
+    Model of one cache configuration.
+
+    Every :meth:`step` admits the ids of ``prefetch_num`` batches at once, as the prefetching training loop does.
+    Evicted rows are all written back, since every row referenced during training gets a gradient. The transfer
+    time is projected from the host <-> device bandwidth plus a fixed latency per transfer, a transfer moving at
+    most ``buffer_size`` rows when it is positive.
+
+    Args:
+        num_embeddings (int): number of rows in the full table.
+        cache_rows (int): number of cache slots.
+        policy (str): eviction policy name, see ``recsys.cache.policy.EVICTION_POLICIES``.
+        embedding_dim (int): embedding dimension, for the bytes moved.
+        element_size (int): bytes per element of the cache.
+        ids_freq_mapping (Optional[torch.Tensor]): dataset count of every row, for the warmup and the dataset
+            policy.
+        warmup_ratio (float): fraction of the cache preloaded with the hottest rows.
+        buffer_size (int): rows per transfer, 0 moves all the rows of a step in one transfer.
+        admission (Optional[str]): admission filter name, see ``recsys.cache.admission.ADMISSION_FILTERS``.
+        bypass_ratio (float): scratch rows serving the rejected rows, relative to the cache rows.
+        bandwidth (float): host <-> device bandwidth in bytes per second.
+        latency (float): fixed cost of a transfer in seconds.
+    """
+
+    def __init__(self,
+                 num_embeddings: int,
+                 cache_rows: int,
+                 policy: str = 'dataset',
+                 embedding_dim: int = 128,
+                 element_size: int = 4,
+                 ids_freq_mapping: Optional[torch.Tensor] = None,
+                 warmup_ratio: float = 0.7,
+                 buffer_size: int = 0,
+                 admission: Optional[str] = None,
+                 bypass_ratio: float = 0.1,
+                 bandwidth: float = 12e9,
+                 latency: float = 1e-5):
+        device = torch.device('cpu')
+        self.policy_name = policy if admission in (None, 'none') else f"{policy}+{admission}"
+        self.num_embeddings = num_embeddings
+        self.row_bytes = embedding_dim * element_size
+        self.buffer_size = buffer_size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        cache_rows = min(cache_rows, num_embeddings)
+        admission_filter = build_admission_filter(admission, cache_rows, device)
+        self.index = CacheIndex(num_embeddings, cache_rows,
+                                build_eviction_policy(policy, cache_rows, device, ids_freq_mapping, num_embeddings),
+                                device, admission_filter, max(1, int(bypass_ratio * cache_rows)))
+
+        self.num_steps = 0
+        self.hits = 0
+        self.misses = 0
+        self.swap_in_rows = 0
+        self.swap_out_rows = 0
+        self.num_transfers = 0
+        self._bypassed = 0
+
+        preload_num = min(int(math.ceil(cache_rows * warmup_ratio)), num_embeddings)
+        if preload_num > 0:
+            if ids_freq_mapping is not None:
+                rows = torch.topk(ids_freq_mapping.cpu(), preload_num, sorted=False).indices
+            else:
+                rows = torch.arange(preload_num)
+            self.index.preload(rows)
+
+    def _transfers(self, num_rows: int) -> int:
+        if num_rows == 0:
+            return 0
+        return math.ceil(num_rows / self.buffer_size) if self.buffer_size > 0 else 1
+
+    def step(self, ids: torch.Tensor, counts: Optional[torch.Tensor] = None):
+        """
+        Admit the ids of one cache step, or the unique ids and their ``counts`` if given.
+        """
+        if counts is None:
+            plan = self.index.admit(ids.cpu())
+        else:
+            plan = self.index.admit_unique(ids.cpu(), counts.cpu())
+        # the scratch rows of the previous step are written back before this step's loads
+        swap_out = plan.evict_rows.shape[0] + self._bypassed
+        swap_in = plan.load_rows.shape[0] + plan.bypass_rows.shape[0]
+        self._bypassed = plan.bypass_rows.shape[0]
+
+        self.num_steps += 1
+        self.hits += plan.num_hits
+        self.misses += plan.num_misses
+        self.swap_in_rows += swap_in
+        self.swap_out_rows += swap_out
+        self.num_transfers += self._transfers(swap_in) + self._transfers(swap_out)
+
+    def result(self) -> SimulationResult:
+        swap_in_bytes = self.swap_in_rows * self.row_bytes
+        swap_out_bytes = self.swap_out_rows * self.row_bytes
+        transfer_time = (swap_in_bytes + swap_out_bytes) / self.bandwidth + self.num_transfers * self.latency
+        return SimulationResult(self.policy_name, self.index.cache_rows, self.index.cache_rows / self.num_embeddings,
+                                self.num_steps, self.hits, self.misses, self.swap_in_rows, self.swap_out_rows,
+                                swap_in_bytes, swap_out_bytes, self.num_transfers, transfer_time)
+
+
+def simulate(id_batches: Iterable[torch.Tensor],
+             simulators: List[CacheSimulator],
+             prefetch_num: int = 1,
+             num_batches: Optional[int] = None) -> List[SimulationResult]:
+    """
+    Replay ``id_batches`` once through every simulator, ``prefetch_num`` batches per cache step.
+    """
+
+    def step(group):
+        # deduplicated once for all the simulators
+        rows, counts = torch.unique(torch.cat(group).cpu(), return_counts=True)
+        for simulator in simulators:
+            simulator.step(rows, counts)
+
+    group = []
+    for i, ids in enumerate(id_batches):
+        if num_batches is not None and i >= num_batches:
+            break
+        group.append(ids)
+        if len(group) == prefetch_num:
+            step(group)
+            group = []
+    if group:
+        step(group)
+    return [simulator.result() for simulator in simulators]
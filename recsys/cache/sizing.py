@@ -0,0 +1,79 @@
+"""
+Cache sizing from a byte budget.
+
+A cache ratio sizes every table's share of the cache by its row count, so the memory used depends on the embedding
+dimension and the hot rows of small tables compete with the cold tail of huge ones. Given a byte budget instead, the
+rows are split over the tables to maximize the expected hits: with the dataset counts, a cache of ``c`` rows of a
+table serves the ``c`` most frequent ids of that table at best, so the best split over tables of equally sized rows
+caches the globally most frequent ids.
+"""
+import itertools
+from typing import List, Optional, Sequence
+
+import torch
+
+
+def cache_rows_for_budget(num_embeddings_per_feature: Sequence[int],
+                          row_bytes: float,
+                          budget_bytes: int,
+                          id_freq_map: Optional[torch.Tensor] = None,
+                          resident_rows: int = 1024,
+                          min_rows: int = 0) -> List[int]:
+    """
+    Cache rows of every table fitting ``budget_bytes`` of ``row_bytes`` rows.
+
+    Tables of at most ``resident_rows`` rows are fully cached, the other tables share the remaining rows: those of the
+    ids with the highest ``id_freq_map`` counts, ties going to the first tables, or proportionally to their sizes
+    without counts. Every table gets at least ``min_rows`` rows, e.g. the unique ids of a table in a batch.
+    """
+    num_embeddings_per_feature = [int(n) for n in num_embeddings_per_feature]
+    budget_rows = int(budget_bytes // row_bytes)
+    cache_rows = [n if n <= resident_rows else min(n, min_rows) for n in num_embeddings_per_feature]
+    if budget_rows < sum(cache_rows):
+        raise ValueError(f"A cache budget of {budget_bytes:,} bytes holds {budget_rows:,} rows, the resident tables "
+                         f"and the minimum rows per table need {sum(cache_rows):,}")
+    if budget_rows >= sum(num_embeddings_per_feature):
+        return num_embeddings_per_feature
+    shared = [t for t, n in enumerate(num_embeddings_per_feature) if n > resident_rows]
+    spare = budget_rows - sum(n for n in num_embeddings_per_feature if n <= resident_rows)
+
+    if id_freq_map is None:
+        total = sum(num_embeddings_per_feature[t] for t in shared)
+        for t in shared:
+            n = num_embeddings_per_feature[t]
+            cache_rows[t] = max(cache_rows[t], min(n, int(spare * n / total)))
+        return _trim(cache_rows, budget_rows, shared, min_rows)
+
+    offsets = [0, *itertools.accumulate(num_embeddings_per_feature)]
+    counts = [id_freq_map[offsets[t]:offsets[t + 1]].cpu() for t in shared]
+    # the count threshold of the spare rows, by bisection: the tables are too large to sort together
+    lo, hi = 0, max(int(c.max()) for c in counts) + 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if sum(int((c >= mid).sum()) for c in counts) > spare:
+            lo = mid
+        else:
+            hi = mid
+    threshold = hi
+    above = [int((c >= threshold).sum()) for c in counts]
+    ties = spare - sum(above)
+    for t, c, a in zip(shared, counts, above):
+        tied = min(ties, int((c == threshold - 1).sum()))
+        ties -= tied
+        cache_rows[t] = max(cache_rows[t], a + tied)
+    return _trim(cache_rows, budget_rows, shared, min_rows)
+
+
+def _trim(cache_rows: List[int], budget_rows: int, shared: List[int], min_rows: int) -> List[int]:
+    """
+    Take back the rows the ``min_rows`` floors added beyond the budget, from the largest shares.
+    """
+    excess = sum(cache_rows) - budget_rows
+    for t in sorted(shared, key=lambda t: -cache_rows[t]):
+        if excess <= 0:
+            break
+        taken = min(excess, cache_rows[t] - min_rows)
+        if taken > 0:
+            cache_rows[t] -= taken
+            excess -= taken
+    return cache_rows
@@ -0,0 +1,237 @@
+"""
+Background row transfers between the host table and the cache of :class:`recsys.cache.CachedEmbeddingBag`.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import torch
+
+from .host_rows import HostRowEngine
+
+
+@dataclass
+class TransferMetrics:
+    """
+    Cumulative counters of a :class:`TransferWorker`, times in seconds. ``wait_time`` is the time the training
+    thread spent blocked on transfers, so ``1 - wait_time / busy_time`` is the fraction of the transfers
+    overlapped with compute. On cuda, ``copy_time`` only covers the host side of the asynchronous copies.
+    """
+    jobs: int = 0
+    queue_depth_sum: int = 0
+    max_queue_depth: int = 0
+    load_rows: int = 0
+    write_back_rows: int = 0
+    gather_time: float = 0.
+    copy_time: float = 0.
+    write_back_time: float = 0.
+    busy_time: float = 0.
+    wait_time: float = 0.
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'transfer_jobs': self.jobs,
+            'transfer_mean_queue_depth': self.queue_depth_sum / max(self.jobs, 1),
+            'transfer_max_queue_depth': self.max_queue_depth,
+            'transfer_load_rows': self.load_rows,
+            'transfer_write_back_rows': self.write_back_rows,
+            'transfer_gather_time': self.gather_time,
+            'transfer_copy_time': self.copy_time,
+            'transfer_write_back_time': self.write_back_time,
+            'transfer_busy_time': self.busy_time,
+            'transfer_wait_time': self.wait_time,
+        }
+
+
+class TransferWorker:
+    """
+    Executes cache swaps on a dedicated thread, fed by a bounded job queue.
+
+    A job first snapshots the evicted rows from the cache and writes them back to the host table from a second
+    thread, while the loaded rows, sorted, are gathered from the host table into a staging buffer and copied into
+    the cache slots. Both host sides go through the multithreaded :class:`recsys.cache.host_rows.HostRowEngine`.
+    Two staging buffers of ``staging_rows`` rows alternate, in the cache dtype and pinned when the cache is on cuda,
+    on the local NUMA node of the engine's layout if any. Jobs run one after another, so a row evicted by a job is
+    written back before a later job loads it again.
+
+    With a ``codec`` (a :class:`recsys.cache.quantized_store.QuantizedRowStore`), the engine holds packed quantized
+    rows: they are staged and copied packed, decoded into the cache after the copy and encoded out of it before the
+    write back, on the device.
+
+    On cuda the worker uses its own streams: a job waits for the work queued on the submitting stream, and
+    :meth:`wait` makes the current stream wait for the last job. On cpu the same threads and queue are used, with
+    plain host copies.
+
+    Args:
+        engine (HostRowEngine): gather / scatter engine over the host table.
+        cache_weight (torch.Tensor): cache rows, not a parameter (e.g. ``param.data``).
+        queue_size (int): maximum number of queued jobs, :meth:`submit` blocks beyond.
+        staging_rows (int): rows of each staging buffer, larger loads are split.
+        metrics (Optional[TransferMetrics]): counters to accumulate into, e.g. those of a previous worker.
+        codec (Optional[QuantizedRowStore]): converts the packed rows of a quantized engine.
+    """
+
+    def __init__(self,
+                 engine: HostRowEngine,
+                 cache_weight: torch.Tensor,
+                 queue_size: int = 2,
+                 staging_rows: int = 65536,
+                 metrics: Optional[TransferMetrics] = None,
+                 codec=None):
+        self.engine = engine
+        self.codec = codec
+        self.cache_weight = cache_weight
+        self.metrics = metrics if metrics is not None else TransferMetrics()
+        self.staging_rows = staging_rows
+        self._cuda = cache_weight.device.type == 'cuda'
+        if self._cuda:
+            self._stream = torch.cuda.Stream(cache_weight.device)
+            self._write_back_stream = torch.cuda.Stream(cache_weight.device)
+        self._staging = [None, None]
+        self._staging_events = [None, None]
+
+        self._write_back_pool = ThreadPoolExecutor(1, thread_name_prefix="cache-write-back")
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._last = None
+        self._error = None
+        self._thread = threading.Thread(target=self._loop, name="cache-transfer", daemon=True)
+        self._thread.start()
+
+    def _staging_buffer(self, b: int, rows: int) -> torch.Tensor:
+        if self._staging[b] is None:
+            # pinned on the node local to the device, where the copies to it are the fastest
+            width, dtype = (self.cache_weight.shape[1], self.cache_weight.dtype) if self.codec is None else \
+                (self.codec.row_bytes, torch.uint8)
+            with self.engine.on_local_node():
+                self._staging[b] = torch.empty(self.staging_rows, width, dtype=dtype, pin_memory=self._cuda)
+        elif self._staging_events[b] is not None:
+            # the previous copy out of this buffer must be over before it is refilled
+            self._staging_events[b].synchronize()
+        return self._staging[b][:rows]
+
+    def submit(self, evict_rows: torch.Tensor, evict_slots: torch.Tensor, load_rows: torch.Tensor,
+               load_slots: torch.Tensor) -> Future:
+        """
+        Queue a swap: write the cache ``evict_slots`` back to the host ``evict_rows``, then load the host
+        ``load_rows`` into the cache ``load_slots``. Rows are host tensors, slots live with the cache.
+        """
+        if self._error is not None:
+            raise self._error
+        event = None
+        if self._cuda:
+            event = torch.cuda.Event()
+            event.record()
+        depth = self._jobs.qsize()
+        self.metrics.jobs += 1
+        self.metrics.queue_depth_sum += depth
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, depth)
+        future = Future()
+        start = time.perf_counter()
+        self._jobs.put((future, event, evict_rows, evict_slots, load_rows, load_slots))
+        self.metrics.wait_time += time.perf_counter() - start
+        self._last = future
+        return future
+
+    def wait(self) -> None:
+        """
+        Block until every submitted job is done.
+        """
+        future = self._last
+        if future is None:
+            return
+        start = time.perf_counter()
+        done = future.result()
+        self.metrics.wait_time += time.perf_counter() - start
+        if self._error is not None:
+            raise self._error
+        if done is not None:
+            torch.cuda.current_stream(self.cache_weight.device).wait_event(done)
+
+    def _loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, event, *args = job
+            start = time.perf_counter()
+            try:
+                done = None
+                if self._cuda:
+                    with torch.cuda.stream(self._stream):
+                        self._stream.wait_event(event)
+                        self._transfer(*args)
+                        done = torch.cuda.Event()
+                        done.record(self._stream)
+                else:
+                    self._transfer(*args)
+                future.set_result(done)
+            except BaseException as e:
+                self._error = e
+                future.set_exception(e)
+            self.metrics.busy_time += time.perf_counter() - start
+
+    def _transfer(self, evict_rows, evict_slots, load_rows, load_slots):
+        write_back = None
+        if evict_slots.shape[0] > 0:
+            # snapshot the victims before the loads overwrite their slots
+            evicted = self.cache_weight.index_select(0, evict_slots)
+            if self.codec is not None:
+                evicted = self.codec.encode(evicted)
+            ready = None
+            if self._cuda:
+                ready = torch.cuda.Event()
+                ready.record(self._stream)
+            write_back = self._write_back_pool.submit(self._write_back, evict_rows, evicted, ready)
+        if not self.engine.is_sorted_unique(load_rows):
+            load_rows, order = torch.sort(load_rows)
+            load_slots = load_slots.index_select(0, order.to(load_slots.device))
+        for b, start in enumerate(range(0, load_rows.shape[0], self.staging_rows)):
+            end = start + self.staging_rows
+            self._load(load_rows[start:end], load_slots[start:end], b % 2)
+        if write_back is not None:
+            write_back.result()
+        self.metrics.load_rows += load_rows.shape[0]
+        self.metrics.write_back_rows += evict_rows.shape[0]
+
+    def _write_back(self, rows, evicted, ready):
+        start = time.perf_counter()
+        if self._cuda:
+            host = torch.empty(evicted.shape, dtype=evicted.dtype, pin_memory=True)
+            with torch.cuda.stream(self._write_back_stream):
+                self._write_back_stream.wait_event(ready)
+                evicted.record_stream(self._write_back_stream)
+                host.copy_(evicted, non_blocking=True)
+            self._write_back_stream.synchronize()
+            evicted = host
+        self.engine.scatter(rows, evicted)
+        self.metrics.write_back_time += time.perf_counter() - start
+
+    def _load(self, rows, slots, b):
+        staging = self._staging_buffer(b, rows.shape[0])
+        start = time.perf_counter()
+        self.engine.gather(rows, staging, unique=True)
+        self.metrics.gather_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = staging.to(self.cache_weight.device, non_blocking=True) if self._cuda else staging
+        if self.codec is not None:
+            rows = self.codec.decode(rows, self.cache_weight.dtype)
+        self.cache_weight.index_copy_(0, slots, rows)
+        if self._cuda:
+            self._staging_events[b] = torch.cuda.Event()
+            self._staging_events[b].record(self._stream)
+        self.metrics.copy_time += time.perf_counter() - start
+
+    def close(self) -> None:
+        """
+        Finish the queued jobs and stop the threads.
+        """
+        try:
+            self.wait()
+        finally:
+            self._jobs.put(None)
+            self._thread.join()
+            self._write_back_pool.shutdown()
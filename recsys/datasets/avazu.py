@@ -9,7 +9,10 @@ from torchrec.sparse.jagged_tensor import KeyedJaggedTensor
 from torchrec.datasets.utils import LoadFiles, ReadLinesFromCSV, PATH_MANAGER_KEY, Batch
 from torchrec.datasets.criteo import BinaryCriteoUtils
 
-from .feature_counter import GlobalFeatureCounter
+from .feature_counter import build_feature_counter
+from .freq_map import save_id_freq_map, load_id_freq_map_tensor
+from .utils import BatchAssembler, ShuffleBuffer, batch_buffers, batch_row_ranges, block_shuffle, worker_shard, \
+    mmap_advise, read_ahead
 
 CAT_FEATURE_COUNT = 13
 INT_FEATURE_COUNT = 8
@@ -79,7 +82,12 @@ class InMemoryAvazuIterDataPipe(IterableDataset):
                  mmap_mode=False,
                  hashes=None,
                  path_manager_key=PATH_MANAGER_KEY,
-                 assigned_tables = None):
+                 assigned_tables = None,
+                 pin_memory=False,
+                 num_buffers=4,
+                 shuffle_block_rows=0,
+                 shuffle_buffer_rows=1 << 20,
+                 seed=0):
         if assigned_tables is not None:
             # tablewise mode
             self.assigned_tables = np.array(assigned_tables)
@@ -95,6 +103,13 @@ class InMemoryAvazuIterDataPipe(IterableDataset):
         self.world_size = world_size
         self.shuffle_batches = shuffle_batches
         self.mmap_mode = mmap_mode
+        self.pin_memory = pin_memory
+        self.num_buffers = num_buffers
+        # see InMemoryBinaryCriteoIterDataPipe
+        self.shuffle_block_rows = shuffle_block_rows
+        self.shuffle_buffer_rows = shuffle_buffer_rows
+        self.seed = seed
+        self.epoch = 0
         if hashes is not None:
             self.hashes = []
             for i, length in enumerate(hashes):
@@ -133,12 +148,17 @@ class InMemoryAvazuIterDataPipe(IterableDataset):
                                        [self.dense_arrs, self.sparse_arrs, self.labels_arrs],
                                        [self.dense_paths, self.sparse_paths, self.label_paths]):
             for idx, (range_left, range_right) in file_idx_to_row_range.items():
-                arrs.append(
-                    BinaryCriteoUtils.load_npy_range(paths[idx],
-                                                     range_left,
-                                                     range_right - range_left + 1,
-                                                     path_manager_key=self.path_manager_key,
-                                                     mmap_mode=self.mmap_mode).astype(_dtype))
+                arr = BinaryCriteoUtils.load_npy_range(paths[idx],
+                                                       range_left,
+                                                       range_right - range_left + 1,
+                                                       path_manager_key=self.path_manager_key,
+                                                       mmap_mode=self.mmap_mode)
+                # memory-mapped ranges keep their stored dtype, converted batch by batch
+                if self.mmap_mode:
+                    mmap_advise(arr, 'SEQUENTIAL')
+                    arrs.append(arr)
+                else:
+                    arrs.append(arr.astype(_dtype))
         expand_hashes = np.ones(CAT_FEATURE_COUNT, dtype=np.int64).reshape(1, -1)
         expand_sparse_offsets = np.ones(CAT_FEATURE_COUNT, dtype=np.int64).reshape(1, -1)
         for i, table in enumerate(self.assigned_tables):
@@ -150,68 +170,46 @@ class InMemoryAvazuIterDataPipe(IterableDataset):
                 sparse_arr += expand_sparse_offsets
 
     def __iter__(self):
-        buffer = None
-
-        def append_to_buffer(dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> None:
-            nonlocal buffer
-            if buffer is None:
-                buffer = [dense, sparse, labels]
-            else:
-                for idx, arr in enumerate([dense, sparse, labels]):
-                    buffer[idx] = np.concatenate((buffer[idx], arr))
-
-        # Maintain a buffer that can contain up to batch_size rows. Fill buffer as
-        # much as possible on each iteration. Only return a new batch when batch_size
-        # rows are filled.
-        file_idx = 0
-        row_idx = 0
-        batch_idx = 0
-        while batch_idx < self.num_batches:
-            buffer_row_count = 0 if buffer is None else buffer[0].shape[0]
-            if buffer_row_count == self.batch_size:
-                yield self._np_arrays_to_batch(*buffer)
-                batch_idx += 1
-                buffer = None
-            else:
-                rows_to_get = min(
-                    self.batch_size - buffer_row_count,
-                    self.num_rows_per_file[file_idx] - row_idx,
-                )
-                slice_ = slice(row_idx, row_idx + rows_to_get)
-
-                dense_inputs = self.dense_arrs[file_idx][slice_, :]
-                sparse_inputs = self.sparse_arrs[file_idx][slice_, :].take(self.assigned_tables, -1)
-                target_labels = self.labels_arrs[file_idx][slice_, :]
-
-                if self.mmap_mode and self.hashes is not None:
-                    sparse_inputs %= self.hashes
-                    sparse_inputs += self.sparse_offsets
-
-                append_to_buffer(
-                    dense_inputs,
-                    sparse_inputs,
-                    target_labels,
-                )
-                row_idx += rows_to_get
-
-                if row_idx >= self.num_rows_per_file[file_idx]:
-                    file_idx += 1
-                    row_idx = 0
-
-    def _np_arrays_to_batch(self, dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> Batch:
-        if self.shuffle_batches:
-            # Shuffle all 3 in unison
-            shuffler = np.random.permutation(sparse.shape[0])
-            dense = dense[shuffler]
-            sparse = sparse[shuffler]
-            labels = labels[shuffler]
-
+        # the rows are gathered once, shuffled and transposed, into a ring of reused batch buffers
+        hash_in_iter = self.mmap_mode and self.hashes is not None
+        assembler = BatchAssembler(self.batch_size,
+                                   self.dense_arrs[0].shape[1],
+                                   self.assigned_tables,
+                                   shuffle=self.shuffle_batches and not self.shuffle_block_rows,
+                                   num_buffers=self.num_buffers,
+                                   pin_memory=self.pin_memory,
+                                   hashes=self.hashes if hash_in_iter else None,
+                                   sparse_offsets=self.sparse_offsets if hash_in_iter else None)
+        arrays = (self.dense_arrs, self.sparse_arrs, self.labels_arrs)
+
+        if self.shuffle_block_rows:
+            blocks, rng = block_shuffle(self.num_rows_per_file, self.shuffle_block_rows, self.seed, self.epoch,
+                                        self.rank)
+            self.epoch += 1
+            if self.mmap_mode:
+                blocks = read_ahead(blocks, arrays)
+            for dense, sparse, labels in ShuffleBuffer(self.shuffle_buffer_rows, self.batch_size, rng).stream(
+                    blocks, arrays):
+                assembler.append(dense, sparse, labels)
+                yield self._tensors_to_batch(*assembler.pop())
+            return
+
+        # every DataLoader worker produces its own share of the batches
+        batches = batch_row_ranges(self.num_rows_per_file, self.batch_size, worker_shard(self.num_batches))
+        if self.mmap_mode:
+            batches = read_ahead(batches, arrays)
+        for pieces in batches:
+            for file_idx, rows in pieces:
+                assembler.append(self.dense_arrs[file_idx][rows], self.sparse_arrs[file_idx][rows],
+                                 self.labels_arrs[file_idx][rows])
+            yield self._tensors_to_batch(*assembler.pop())
+
+    def _tensors_to_batch(self, dense: torch.Tensor, values: torch.Tensor, labels: torch.Tensor) -> Batch:
         return Batch(
-            dense_features=torch.from_numpy(dense),
+            dense_features=dense,
             sparse_features=KeyedJaggedTensor(
                 keys=self.keys,
-        # transpose + reshape(-1) incurs an additional copy.
-                values=torch.from_numpy(sparse.transpose(1, 0).reshape(-1)),
+                values=values,
                 lengths=self.lengths,
                 offsets=self.offsets,
                 stride=self.stride,
@@ -219,9 +217,12 @@ class InMemoryAvazuIterDataPipe(IterableDataset):
                 offset_per_key=self.offset_per_key,
                 index_per_key=self.index_per_key,
             ),
-            labels=torch.from_numpy(labels.reshape(-1)),
+            labels=labels,
         )
 
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
     def __len__(self) -> int:
         return self.num_batches
 
@@ -251,21 +252,46 @@ def get_dataloader(args, stage, rank, world_size,  assigned_tables = None):
                                   rank=rank,
                                   world_size=world_size,
                                   shuffle_batches=args.shuffle_batches,
+                                  mmap_mode=args.mmap_mode,
                                   hashes=args.num_embeddings_per_feature,
-                                  assigned_tables=assigned_tables),
+                                  assigned_tables=assigned_tables,
+                                  pin_memory=args.pin_memory,
+                                  num_buffers=batch_buffers(args),
+                                  shuffle_block_rows=args.shuffle_block_rows if stage == "train" else 0,
+                                  shuffle_buffer_rows=args.shuffle_buffer_rows,
+                                  seed=args.seed),
         batch_size=None,
         pin_memory=args.pin_memory,
         collate_fn=lambda x: x,
+        num_workers=args.num_workers,
     )
 
     return dataloader
 
 
-def get_id_freq_map(path):
+def get_id_freq_map(path, num_workers=None, topk=None, counter='exact', sketch_capacity=1_000_000):
+    hash_sizes = list(map(int, NUM_EMBEDDINGS_PER_FEATURE.split(',')))
+    checkpoint_path = os.path.join(path, "id_freq_map.bin" if counter == 'exact' else f"id_freq_map_{counter}.bin")
+    # rank 0 counts and writes the checkpoint, the incremental counter revalidating its per-file partials on every
+    # call, then every rank maps it
+    if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+        if counter == 'incremental' or not os.path.exists(checkpoint_path):
+            _count_id_freq_map(path, hash_sizes, checkpoint_path, num_workers, topk, counter, sketch_capacity)
+    if torch.distributed.is_initialized():
+        torch.distributed.barrier()
+    return load_id_freq_map_tensor(checkpoint_path)
+
+
+def _count_id_freq_map(path, hash_sizes, checkpoint_path, num_workers, topk, counter, sketch_capacity):
     files = os.listdir(path)
     files = list(filter(lambda s: "sparse" in s, files))
     files = [os.path.join(path, _f) for _f in files]
 
-    feature_count = GlobalFeatureCounter(files, list(map(int, NUM_EMBEDDINGS_PER_FEATURE.split(','))))
-    id_freq_map = torch.from_numpy(feature_count.compute())
-    return id_freq_map
+    feature_count = build_feature_counter(files,
+                                          hash_sizes,
+                                          counter=counter,
+                                          num_workers=num_workers,
+                                          sketch_capacity=sketch_capacity,
+                                          cache_dir=os.path.join(path, "id_freq_cache"))
+    id_freq_map = feature_count.compute()
+    save_id_freq_map(checkpoint_path, id_freq_map, hash_sizes, topk=topk)
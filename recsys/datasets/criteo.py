@@ -16,15 +16,19 @@ from torchrec.datasets.criteo import (CAT_FEATURE_COUNT, DEFAULT_CAT_NAMES, DEFA
 from torchrec.datasets.utils import PATH_MANAGER_KEY, Batch
 from torchrec.sparse.jagged_tensor import KeyedJaggedTensor
 from iopath.common.file_io import PathManager, PathManagerFactory
-from pyre_extensions import none_throws
 import torch
 from torch.utils.data import DataLoader, IterableDataset
 from petastorm import make_batch_reader
 from pyarrow.parquet import ParquetDataset
 
-from .feature_counter import GlobalFeatureCounter, PetastormCounter
+from .feature_counter import build_feature_counter
+from .freq_map import save_id_freq_map, load_id_freq_map_tensor
+from .utils import BatchAssembler, FeatureMajorBatchAssembler, ShuffleBuffer, batch_buffers, batch_row_ranges, \
+    block_shuffle, worker_shard, mmap_advise, read_ahead
 
 STAGES = ["train", "val", "test"]
+# file name suffix of the feature-major sparse ids, see FeatureMajorCriteoIterDataPipe
+FEATURE_MAJOR_SPARSE_SUFFIX = "_sparse_feature_major.npy"
 
 # 177,944,275 in total
 NUM_EMBEDDINGS_PER_FEATURE = "45833188,36746,17245,7413,20243,3,7114,1441,62,29275261,1572176,345138,10,2209,11267," \
@@ -59,6 +63,15 @@ class InMemoryBinaryCriteoIterDataPipe(IterableDataset):
         assigned_tables (Optional[List[int]]): For tablewise mode. sparse features(tables) are numbered as 0, 1, 2, ..., n. 
                         appending a number to assigned_tables means the coresponding table is assinged to this loader.
                         iff a table is assigned to this loader should it be loaded into the batch.
+        pin_memory (bool): assemble the batches in pinned memory.
+        num_buffers (int): batch buffers reused in turn, the batches yielded are overwritten ``num_buffers``
+            batches later, see :class:`recsys.datasets.utils.BatchAssembler`.
+        shuffle_block_rows (int): if not 0, the rows are read by blocks of ``shuffle_block_rows`` rows in a random
+            order, streamed through a shuffle buffer of ``shuffle_buffer_rows`` rows, instead of shuffling the
+            batches, see :func:`recsys.datasets.utils.block_shuffle`. The order is drawn for every epoch, see
+            :meth:`set_epoch`. With DataLoader workers, every worker drops the rows short of its last batch.
+        shuffle_buffer_rows (int): rows of the shuffle buffer.
+        seed (int): seed of the block shuffle.
 
     Example::
 
@@ -86,7 +99,12 @@ class InMemoryBinaryCriteoIterDataPipe(IterableDataset):
         mmap_mode: bool = False,
         hashes: Optional[List[int]] = None,
         path_manager_key: str = PATH_MANAGER_KEY, 
-        assigned_tables: Optional[List[int]] = None
+        assigned_tables: Optional[List[int]] = None,
+        pin_memory: bool = False,
+        num_buffers: int = 4,
+        shuffle_block_rows: int = 0,
+        shuffle_buffer_rows: int = 1 << 20,
+        seed: int = 0,
     ) -> None:
         if assigned_tables is not None:
             # tablewise mode
@@ -102,6 +120,12 @@ class InMemoryBinaryCriteoIterDataPipe(IterableDataset):
         self.world_size = world_size
         self.shuffle_batches = shuffle_batches
         self.mmap_mode = mmap_mode
+        self.pin_memory = pin_memory
+        self.num_buffers = num_buffers
+        self.shuffle_block_rows = shuffle_block_rows
+        self.shuffle_buffer_rows = shuffle_buffer_rows
+        self.seed = seed
+        self.epoch = 0
         # self.hashes = np.array(hashes).reshape((1, CAT_FEATURE_COUNT)) if hashes is not None else None
         if hashes is not None:
             self.hashes = []
@@ -149,14 +173,19 @@ class InMemoryBinaryCriteoIterDataPipe(IterableDataset):
             [self.dense_paths, self.sparse_paths, self.labels_paths],
         ):
             for idx, (range_left, range_right) in file_idx_to_row_range.items():
-                arrs.append(
-                    BinaryCriteoUtils.load_npy_range(
-                        paths[idx],
-                        range_left,
-                        range_right - range_left + 1,
-                        path_manager_key=self.path_manager_key,
-                        mmap_mode=self.mmap_mode,
-                    ).astype(_dtype))
+                arr = BinaryCriteoUtils.load_npy_range(
+                    paths[idx],
+                    range_left,
+                    range_right - range_left + 1,
+                    path_manager_key=self.path_manager_key,
+                    mmap_mode=self.mmap_mode,
+                )
+                # memory-mapped ranges keep their stored dtype, converted batch by batch
+                if self.mmap_mode:
+                    mmap_advise(arr, 'SEQUENTIAL')
+                    arrs.append(arr)
+                else:
+                    arrs.append(arr.astype(_dtype))
 
         # When mmap_mode is enabled, the hash is applied in def __iter__, which is
         # where samples are batched during training.
@@ -172,19 +201,12 @@ class InMemoryBinaryCriteoIterDataPipe(IterableDataset):
                 sparse_arr %= expand_hashes
                 sparse_arr += expand_sparse_offsets
 
-    def _np_arrays_to_batch(self, dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> Batch:
-        if self.shuffle_batches:
-            # Shuffle all 3 in unison
-            shuffler = np.random.permutation(len(dense))
-            dense = dense[shuffler]
-            sparse = sparse[shuffler]
-            labels = labels[shuffler]
+    def _tensors_to_batch(self, dense: torch.Tensor, values: torch.Tensor, labels: torch.Tensor) -> Batch:
         return Batch(
-            dense_features=torch.from_numpy(dense),
+            dense_features=dense,
             sparse_features=KeyedJaggedTensor(
                 keys=self.keys,
-        # transpose + reshape(-1) incurs an additional copy.
-                values=torch.from_numpy(sparse.transpose(1, 0).reshape(-1)),
+                values=values,
                 lengths=self.lengths,
                 offsets=self.offsets,
                 stride=self.stride,
@@ -192,64 +214,235 @@ class InMemoryBinaryCriteoIterDataPipe(IterableDataset):
                 offset_per_key=self.offset_per_key,
                 index_per_key=self.index_per_key,
             ),
-            labels=torch.from_numpy(labels.reshape(-1)),
+            labels=labels,
         )
 
     def __iter__(self) -> Iterator[Batch]:
-        # Invariant: buffer never contains more than batch_size rows.
-        buffer: Optional[List[np.ndarray]] = None
+        # the rows are gathered once, shuffled and transposed, into a ring of reused batch buffers
+        hash_in_iter = self.mmap_mode and self.hashes is not None
+        assembler = BatchAssembler(self.batch_size,
+                                   self.dense_arrs[0].shape[1],
+                                   self.assigned_tables,
+                                   shuffle=self.shuffle_batches and not self.shuffle_block_rows,
+                                   num_buffers=self.num_buffers,
+                                   pin_memory=self.pin_memory,
+                                   hashes=self.hashes if hash_in_iter else None,
+                                   sparse_offsets=self.sparse_offsets if hash_in_iter else None)
+        arrays = (self.dense_arrs, self.sparse_arrs, self.labels_arrs)
+
+        if self.shuffle_block_rows:
+            blocks, rng = block_shuffle(self.num_rows_per_file, self.shuffle_block_rows, self.seed, self.epoch,
+                                        self.rank)
+            self.epoch += 1
+            if self.mmap_mode:
+                blocks = read_ahead(blocks, arrays)
+            for dense, sparse, labels in ShuffleBuffer(self.shuffle_buffer_rows, self.batch_size, rng).stream(
+                    blocks, arrays):
+                assembler.append(dense, sparse, labels)
+                yield self._tensors_to_batch(*assembler.pop())
+            return
+
+        # every DataLoader worker produces its own share of the batches
+        batches = batch_row_ranges(self.num_rows_per_file, self.batch_size, worker_shard(self.num_batches))
+        if self.mmap_mode:
+            batches = read_ahead(batches, arrays)
+        for pieces in batches:
+            for file_idx, rows in pieces:
+                assembler.append(self.dense_arrs[file_idx][rows], self.sparse_arrs[file_idx][rows],
+                                 self.labels_arrs[file_idx][rows])
+            yield self._tensors_to_batch(*assembler.pop())
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch the block shuffle order is drawn for, counted by the iterations otherwise. DataLoader workers
+        iterate copies of the datapipe, their count is lost.
+        """
+        self.epoch = epoch
 
-        def append_to_buffer(dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> None:
-            nonlocal buffer
-            if buffer is None:
-                buffer = [dense, sparse, labels]
-            else:
-                for idx, arr in enumerate([dense, sparse, labels]):
-                    buffer[idx] = np.concatenate((buffer[idx], arr))
-
-        # Maintain a buffer that can contain up to batch_size rows. Fill buffer as
-        # much as possible on each iteration. Only return a new batch when batch_size
-        # rows are filled.
-        file_idx = 0
-        row_idx = 0
-        batch_idx = 0
-        while batch_idx < self.num_batches:
-            buffer_row_count = 0 if buffer is None else none_throws(buffer)[0].shape[0]
-            if buffer_row_count == self.batch_size:
-                yield self._np_arrays_to_batch(*none_throws(buffer))
-                batch_idx += 1
-                buffer = None
-            else:
-                rows_to_get = min(
-                    self.batch_size - buffer_row_count,
-                    self.num_rows_per_file[file_idx] - row_idx,
-                )
-                slice_ = slice(row_idx, row_idx + rows_to_get)
+    def __len__(self) -> int:
+        return self.num_batches
 
-                dense_inputs = self.dense_arrs[file_idx][slice_, :]
-                sparse_inputs = self.sparse_arrs[file_idx][slice_, :].take(self.assigned_tables, -1)
-                target_labels = self.labels_arrs[file_idx][slice_, :]
 
-                if self.mmap_mode and self.hashes is not None:
-                    sparse_inputs %= self.hashes
-                    sparse_inputs += self.sparse_offsets
+class FeatureMajorCriteoIterDataPipe(IterableDataset):
+    """
+    Datapipe over binary (npy) Criteo files whose sparse ids are stored feature-major, as written by
+    scripts/preprocess/feature_major_criteo.py: ``[CAT_FEATURE_COUNT, num_rows]`` int64 arrays of ids hashed into the
+    tables and offset by table, named ``*_sparse_feature_major.npy``. The dense features and labels are the
+    row-major files of :class:`InMemoryBinaryCriteoIterDataPipe`.
 
-                append_to_buffer(
-                    dense_inputs,
-                    sparse_inputs,
-                    target_labels,
-                )
-                row_idx += rows_to_get
+    All the files are memory-mapped. The ids of every feature being contiguous, a batch copies them once into the
+    KeyedJaggedTensor values, by a single ``take`` per feature when shuffled, and its dense features and labels are
+    views of the files unless shuffled, pinned or straddling two files, see
+    :class:`recsys.datasets.utils.FeatureMajorBatchAssembler`.
 
-                if row_idx >= self.num_rows_per_file[file_idx]:
-                    file_idx += 1
-                    row_idx = 0
+    Args:
+        dense_paths (List[str]): List of path strings to dense npy files.
+        sparse_paths (List[str]): List of path strings to feature-major sparse npy files.
+        labels_paths (List[str]): List of path strings to labels npy files.
+        batch_size (int): batch size.
+        rank (int): rank.
+        world_size (int): world size.
+        shuffle_batches (bool): Whether to shuffle batches
+        hashes (Optional[List[int]]): the table sizes the ids were hashed and offset with, required in tablewise
+            mode to offset the ids over the assigned tables only.
+        path_manager_key (str): Path manager key used to load from different filesystems.
+        assigned_tables (Optional[List[int]]): For tablewise mode, the tables loaded into the batches.
+        pin_memory (bool): assemble the batches in pinned memory.
+        num_buffers (int): batch buffers reused in turn, the batches yielded are overwritten ``num_buffers``
+            batches later.
+        shuffle_block_rows (int): if not 0, the block shuffle of :class:`InMemoryBinaryCriteoIterDataPipe`.
+        shuffle_buffer_rows (int): rows of the shuffle buffer.
+        seed (int): seed of the block shuffle.
+    """
+
+    def __init__(
+        self,
+        dense_paths: List[str],
+        sparse_paths: List[str],
+        labels_paths: List[str],
+        batch_size: int,
+        rank: int,
+        world_size: int,
+        shuffle_batches: bool = False,
+        hashes: Optional[List[int]] = None,
+        path_manager_key: str = PATH_MANAGER_KEY,
+        assigned_tables: Optional[List[int]] = None,
+        pin_memory: bool = False,
+        num_buffers: int = 4,
+        shuffle_block_rows: int = 0,
+        shuffle_buffer_rows: int = 1 << 20,
+        seed: int = 0,
+    ) -> None:
+        self.assigned_tables = np.arange(CAT_FEATURE_COUNT) if assigned_tables is None else np.array(assigned_tables)
+        self.dense_paths = dense_paths
+        self.sparse_paths = sparse_paths
+        self.labels_paths = labels_paths
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle_batches = shuffle_batches
+        self.pin_memory = pin_memory
+        self.num_buffers = num_buffers
+        self.shuffle_block_rows = shuffle_block_rows
+        self.shuffle_buffer_rows = shuffle_buffer_rows
+        self.seed = seed
+        self.epoch = 0
+        self.path_manager_key = path_manager_key
+        self.path_manager: PathManager = PathManagerFactory().get(path_manager_key)
+
+        # the ids are offset over all the tables, shift them to the offsets over the assigned tables
+        self.sparse_shift = None
+        if assigned_tables is not None:
+            if hashes is None:
+                raise ValueError("The tablewise mode of feature-major datasets requires the table sizes")
+            global_offsets = np.array([0, *np.cumsum(hashes)[:-1]], dtype=np.int64)
+            assigned_hashes = np.array(hashes, dtype=np.int64)[self.assigned_tables]
+            local_offsets = np.array([0, *np.cumsum(assigned_hashes)[:-1]], dtype=np.int64)
+            self.sparse_shift = local_offsets - global_offsets[self.assigned_tables]
+
+        self._load_data_for_rank()
+        self.num_rows_per_file: List[int] = [a.shape[0] for a in self.dense_arrs]
+        self.num_batches: int = sum(self.num_rows_per_file) // batch_size
+
+        self._num_ids_in_batch: int = len(self.assigned_tables) * batch_size
+        self.keys: List[str] = [DEFAULT_CAT_NAMES[i] for i in self.assigned_tables]
+        self.lengths: torch.Tensor = torch.ones((self._num_ids_in_batch,), dtype=torch.int32)
+        self.offsets: torch.Tensor = torch.arange(0, self._num_ids_in_batch + 1, dtype=torch.int32)
+        self.stride = batch_size
+        self.length_per_key: List[int] = len(self.assigned_tables) * [batch_size]
+        self.offset_per_key: List[int] = [batch_size * i for i in range(len(self.assigned_tables) + 1)]
+        self.index_per_key: Dict[str, int] = {key: i for (i, key) in enumerate(self.keys)}
+
+    def _load(self, path: str) -> np.ndarray:
+        # copy-on-write, for the views of the files to be writable tensors
+        return np.load(self.path_manager.get_local_path(path), mmap_mode='c')
+
+    def _load_data_for_rank(self) -> None:
+        file_idx_to_row_range = BinaryCriteoUtils.get_file_idx_to_row_range(
+            lengths=[
+                BinaryCriteoUtils.get_shape_from_npy(path, path_manager_key=self.path_manager_key)[0]
+                for path in self.dense_paths
+            ],
+            rank=self.rank,
+            world_size=self.world_size,
+        )
+
+        self.dense_arrs, self.sparse_arrs, self.labels_arrs = [], [], []
+        for idx, (range_left, range_right) in file_idx_to_row_range.items():
+            rows = slice(range_left, range_right + 1)
+            dense, sparse, labels = (self._load(paths[idx])
+                                     for paths in (self.dense_paths, self.sparse_paths, self.labels_paths))
+            if dense.dtype != np.float32 or sparse.dtype != np.int64 or labels.dtype != np.int32 or \
+                    sparse.shape[0] != CAT_FEATURE_COUNT:
+                raise ValueError(f"{self.sparse_paths[idx]} is not a feature-major dataset file")
+            self.dense_arrs.append(dense[rows])
+            self.sparse_arrs.append(sparse[:, rows])
+            self.labels_arrs.append(labels[rows])
+        for arr in (*self.dense_arrs, *self.sparse_arrs, *self.labels_arrs):
+            mmap_advise(arr, 'SEQUENTIAL')
+
+    def _tensors_to_batch(self, dense: torch.Tensor, values: torch.Tensor, labels: torch.Tensor) -> Batch:
+        return Batch(
+            dense_features=dense,
+            sparse_features=KeyedJaggedTensor(
+                keys=self.keys,
+                values=values,
+                lengths=self.lengths,
+                offsets=self.offsets,
+                stride=self.stride,
+                length_per_key=self.length_per_key,
+                offset_per_key=self.offset_per_key,
+                index_per_key=self.index_per_key,
+            ),
+            labels=labels,
+        )
+
+    def __iter__(self) -> Iterator[Batch]:
+        assembler = FeatureMajorBatchAssembler(self.batch_size,
+                                               self.dense_arrs[0].shape[1],
+                                               self.assigned_tables,
+                                               shuffle=self.shuffle_batches and not self.shuffle_block_rows,
+                                               num_buffers=self.num_buffers,
+                                               pin_memory=self.pin_memory,
+                                               sparse_offsets=self.sparse_shift)
+        arrays = (self.dense_arrs, self.sparse_arrs, self.labels_arrs)
+
+        if self.shuffle_block_rows:
+            blocks, rng = block_shuffle(self.num_rows_per_file, self.shuffle_block_rows, self.seed, self.epoch,
+                                        self.rank)
+            self.epoch += 1
+            blocks = read_ahead(blocks, arrays, feature_major=True)
+            for dense, sparse, labels in ShuffleBuffer(self.shuffle_buffer_rows, self.batch_size, rng).stream(
+                    blocks, arrays, feature_major=True):
+                assembler.append(dense, sparse.T, labels)
+                yield self._tensors_to_batch(*assembler.pop())
+            return
+
+        # every DataLoader worker produces its own share of the batches, read ahead from the files
+        batches = batch_row_ranges(self.num_rows_per_file, self.batch_size, worker_shard(self.num_batches))
+        for pieces in read_ahead(batches, arrays, feature_major=True):
+            for file_idx, rows in pieces:
+                assembler.append(self.dense_arrs[file_idx][rows], self.sparse_arrs[file_idx][:, rows],
+                                 self.labels_arrs[file_idx][rows])
+            yield self._tensors_to_batch(*assembler.pop())
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch the block shuffle order is drawn for, counted by the iterations otherwise. DataLoader workers
+        iterate copies of the datapipe, their count is lost.
+        """
+        self.epoch = epoch
 
     def __len__(self) -> int:
         return self.num_batches
 
 
 class PetastormDataReader(IterableDataset):
+    """
+    Reads the Criteo Terabyte parquet files with petastorm, whose reader goes through the row groups in a random
+    order. If ``shuffle_buffer_rows``, the rows are streamed through a shuffle buffer of as many rows, see
+    :class:`recsys.datasets.utils.ShuffleBuffer`, mixing the row groups, instead of shuffling the batches.
+    """
 
     def __init__(self,
                  paths,
@@ -260,8 +453,9 @@ class PetastormDataReader(IterableDataset):
                  hashes=None,
                  seed=1024,
                  drop_last=True,
-                 assigned_tables=None):
-        
+                 assigned_tables=None,
+                 shuffle_buffer_rows=0):
+
         if assigned_tables is not None:
             # tablewise mode
             self.assigned_tables = np.array(assigned_tables)
@@ -294,6 +488,7 @@ class PetastormDataReader(IterableDataset):
         self.index_per_key: Dict[str, int] = {key: i for (i, key) in enumerate(self.keys)}
         self.seed = seed
         self.epoch = 0
+        self.shuffle_buffer_rows = shuffle_buffer_rows
 
         self.drop_last = drop_last
         if drop_last:
@@ -316,6 +511,9 @@ class PetastormDataReader(IterableDataset):
                 buffer[2] = np.concatenate([buffer[2], _labels], axis=0)
 
         random.seed(self.seed + self.epoch)    # for sync RNG inside the petastorm reader
+        shuffle_buffer = ShuffleBuffer(self.shuffle_buffer_rows, self.batch_size,
+                                       np.random.default_rng([self.seed, self.epoch, self.rank or 0])) \
+            if self.shuffle_buffer_rows else None
         self.epoch += 1
         with make_batch_reader(
                 list(map(lambda x: "file://" + x, self.dataset.files)),
@@ -331,6 +529,10 @@ class PetastormDataReader(IterableDataset):
                     sparse = sparse + self.sparse_offsets
                 dense = np.concatenate([getattr(batch, col_name).reshape(-1, 1) for col_name in DEFAULT_INT_NAMES],
                                        axis=1)
+                if shuffle_buffer is not None:
+                    for _dense, _sparse, _labels in shuffle_buffer.push(dense, sparse.T, labels):
+                        yield self._batch_ndarray(_dense, _sparse.T, _labels)
+                    continue
                 start_idx = 0
                 while start_idx < dense.shape[0]:
                     buffer_size = 0 if buffer is None else buffer[0].shape[0]
@@ -346,9 +548,12 @@ class PetastormDataReader(IterableDataset):
                         start_idx += rows_to_get
         if buffer is not None and not self.drop_last:
             yield self._batch_ndarray(*buffer)
+        if shuffle_buffer is not None:
+            for _dense, _sparse, _labels in shuffle_buffer.drain(self.drop_last):
+                yield self._batch_ndarray(_dense, _sparse.T, _labels)
 
     def _batch_ndarray(self, dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray):
-        if self.shuffle_batches:
+        if self.shuffle_batches and not self.shuffle_buffer_rows:
             # Shuffle all 3 in unison
             shuffler = np.random.permutation(len(dense))
             dense = dense[shuffler]
@@ -390,25 +595,37 @@ def _get_kaggle_dataloader(args, stage, rank, world_size, assigned_tables=None):
         rank = rank if stage == "val" else (rank + world_size)
         world_size = world_size * 2
 
+    # datasets converted by scripts/preprocess/feature_major_criteo.py
+    feature_major = any(f.endswith(FEATURE_MAJOR_SPARSE_SUFFIX) for f in files)
     stage_files = [
         sorted(map(
             lambda x: os.path.join(args.dataset_dir, x),
             filter(lambda s: kind in s, files),
-        )) for kind in ["dense", "sparse", "labels"]
+        )) for kind in ["dense", FEATURE_MAJOR_SPARSE_SUFFIX if feature_major else "sparse", "labels"]
     ]
 
+    # the feature-major files are always memory-mapped
+    datapipe_cls = FeatureMajorCriteoIterDataPipe if feature_major else InMemoryBinaryCriteoIterDataPipe
+    datapipe_kwargs = {} if feature_major else {'mmap_mode': args.mmap_mode}
     dataloader = DataLoader(
-        InMemoryBinaryCriteoIterDataPipe(
+        datapipe_cls(
             *stage_files,    # pyre-ignore[6]
             batch_size=args.batch_size,
             rank=rank,
             world_size=world_size,
             shuffle_batches=args.shuffle_batches,
             hashes=args.num_embeddings_per_feature,
-            assigned_tables=assigned_tables),
+            assigned_tables=assigned_tables,
+            pin_memory=args.pin_memory,
+            num_buffers=batch_buffers(args),
+            shuffle_block_rows=args.shuffle_block_rows if stage == "train" else 0,
+            shuffle_buffer_rows=args.shuffle_buffer_rows,
+            seed=args.seed,
+            **datapipe_kwargs),
         batch_size=None,
         pin_memory=args.pin_memory,
         collate_fn=lambda x: x,
+        num_workers=args.num_workers,
     )
     return dataloader
 
@@ -435,7 +652,9 @@ def _get_terabyte_dataloader(args, stage, rank, world_size, assigned_tables=None
                                                 shuffle_batches=stage == "train",
                                                 hashes=args.num_embeddings_per_feature,
                                                 seed=args.seed,
-                                                assigned_tables=assigned_tables),
+                                                assigned_tables=assigned_tables,
+                                                shuffle_buffer_rows=args.shuffle_buffer_rows
+                                                if stage == "train" and args.shuffle_block_rows else 0),
                             batch_size=None,
                             pin_memory=False,
                             collate_fn=lambda x: x,
@@ -458,29 +677,53 @@ def get_dataloader(args, stage, rank, world_size, assigned_tables = None):
         return _get_terabyte_dataloader(args, stage, rank, world_size, assigned_tables)
 
 
-def get_id_freq_map(path):
-    checkpoint_path = os.path.join(path, "id_freq_map.pt")
-    if os.path.exists(checkpoint_path):
-        id_freq_map = torch.load(checkpoint_path)
-        return id_freq_map
-
-    if 'kaggle' not in path:
+def get_id_freq_map(path, num_workers=None, topk=None, counter='exact', sketch_capacity=1_000_000):
+    """
+    The id-frequency map is cached as ``id_freq_map.bin`` (see ``recsys.datasets.freq_map``) in the dataset dir,
+    a legacy ``id_freq_map.pt`` is converted on first use. ``topk`` only applies when the cache is written.
+    ``counter`` selects the exact histogram, the approximate sketch or the incremental per-file partials
+    under ``id_freq_cache``, see ``build_feature_counter``. Only rank 0 counts, the other ranks wait for the cache
+    to be written, and every rank memory-maps it.
+    """
+    hash_sizes = list(
+        map(int, (KAGGLE_NUM_EMBEDDINGS_PER_FEATURE if 'kaggle' in path else NUM_EMBEDDINGS_PER_FEATURE).split(',')))
+    checkpoint_path = os.path.join(path, "id_freq_map.bin" if counter == 'exact' else f"id_freq_map_{counter}.bin")
+    # rank 0 counts and writes the checkpoint, the incremental counter revalidating its per-file partials on every
+    # call, then every rank maps it
+    if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+        if counter == 'incremental' or not os.path.exists(checkpoint_path):
+            _count_id_freq_map(path, hash_sizes, checkpoint_path, num_workers, topk, counter, sketch_capacity)
+    if torch.distributed.is_initialized():
+        torch.distributed.barrier()
+    return load_id_freq_map_tensor(checkpoint_path)
+
+
+def _count_id_freq_map(path, hash_sizes, checkpoint_path, num_workers, topk, counter, sketch_capacity):
+    legacy_checkpoint_path = os.path.join(path, "id_freq_map.pt")
+    if counter == 'exact' and os.path.exists(legacy_checkpoint_path):
+        id_freq_map = torch.load(legacy_checkpoint_path).numpy()
+    elif 'kaggle' not in path:
         file_num = len(glob.glob(os.path.join(path, "train", "*.parquet")))
         files = [os.path.join(path, "train", f"part_{i}.parquet") for i in range(file_num)]
-        feature_count = PetastormCounter(files,
-                                         list(map(int, NUM_EMBEDDINGS_PER_FEATURE.split(','))),
-                                         subsample_fraction=0.1)
+        feature_count = build_feature_counter(files,
+                                              hash_sizes,
+                                              counter=counter,
+                                              file_format='parquet',
+                                              num_workers=num_workers,
+                                              sketch_capacity=sketch_capacity,
+                                              cache_dir=os.path.join(path, "id_freq_cache"))
         id_freq_map = feature_count.compute()
     else:
         files = os.listdir(path)
-        sparse_files = list(filter(lambda s: 'sparse' in s, files))
+        sparse_files = list(filter(lambda s: 'sparse' in s and not s.endswith(FEATURE_MAJOR_SPARSE_SUFFIX), files))
         sparse_files = [os.path.join(path, _f) for _f in sparse_files]
 
-        feature_count = GlobalFeatureCounter(sparse_files, list(map(int, KAGGLE_NUM_EMBEDDINGS_PER_FEATURE.split(','))))
+        feature_count = build_feature_counter(sparse_files,
+                                              hash_sizes,
+                                              counter=counter,
+                                              num_workers=num_workers,
+                                              sketch_capacity=sketch_capacity,
+                                              cache_dir=os.path.join(path, "id_freq_cache"))
         id_freq_map = feature_count.compute()
 
-    id_freq_map = torch.from_numpy(id_freq_map)
-    if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
-        torch.save(id_freq_map, checkpoint_path)
-
-    return id_freq_map
+    save_id_freq_map(checkpoint_path, id_freq_map, hash_sizes, topk=topk)
@@ -1,37 +1,89 @@
 import abc
+import os
+import json
+import heapq
+import hashlib
 import random
+import shutil
+import tempfile
+import multiprocessing
+import psutil
 from tqdm import tqdm
 
 import numpy as np
 from .criteo import DEFAULT_CAT_NAMES
+from .sketch import CountMinSketch, SpaceSaving
+from .freq_map import save_id_freq_map, load_id_freq_map
 from petastorm import make_batch_reader
-from pyarrow.parquet import ParquetDataset
+from pyarrow.parquet import ParquetDataset, ParquetFile
+
+# tables whose hash size is within this multiple of the chunk length are counted with a dense bincount,
+# larger ones with a sort-based unique so that the temporary never scales with the hash size
+_BINCOUNT_FACTOR = 8
+
+
+def _table_views(id_freq_map, hash_sizes):
+    """
+    split the flat id-frequency map into per-table histogram views
+    """
+    offsets = np.cumsum([0, *hash_sizes])
+    return [id_freq_map[offsets[i]:offsets[i + 1]] for i in range(len(hash_sizes))]
+
+
+def _accumulate(table_hists, hashed):
+    """
+    accumulate a hashed [rows, tables] chunk into the per-table histograms
+    """
+    num_rows = hashed.shape[0]
+    for i, hist in enumerate(table_hists):
+        column = hashed[:, i]
+        if hist.shape[0] <= _BINCOUNT_FACTOR * num_rows:
+            hist += np.bincount(column, minlength=hist.shape[0])
+        else:
+            uniq, counts = np.unique(column, return_counts=True)
+            hist[uniq] += counts
+
+
+def _count_npy_rows(table_hists, hash_sizes, arr, start, stop, scratch):
+    """
+    hash rows [start, stop) of a sparse array chunk by chunk through ``scratch`` and accumulate them
+    """
+    for begin in range(start, stop, scratch.shape[0]):
+        chunk = arr[begin:min(begin + scratch.shape[0], stop)]
+        hashed = scratch[:chunk.shape[0]]
+        np.remainder(chunk, hash_sizes, out=hashed)
+        _accumulate(table_hists, hashed)
 
 
 class GlobalFeatureCounter:
     """
     compute the global statistics of the whole training set
+
+    The sparse files are memory-mapped and consumed ``chunk_size`` rows at a time, so the peak memory is the
+    histogram itself plus one reusable [chunk_size, num_tables] scratch buffer, regardless of the file sizes.
     """
 
-    def __init__(self, datafiles, hash_sizes):
+    def __init__(self, datafiles, hash_sizes, chunk_size=1_000_000):
         self.datafiles = datafiles
         self.hash_sizes = np.array(hash_sizes).reshape(1, -1)
         self.offsets = np.array([0, *np.cumsum(hash_sizes)[:-1]]).reshape(1, -1)
+        self.chunk_size = chunk_size
 
     def compute(self):
         id_freq_map = np.zeros(self.hash_sizes.sum(), dtype=np.int64)
+        table_hists = _table_views(id_freq_map, self.hash_sizes.reshape(-1))
+        scratch = np.empty((self.chunk_size, self.hash_sizes.shape[1]), dtype=np.int64)
         for _f in self.datafiles:
-            arr = np.load(_f)
-            arr %= self.hash_sizes
-            arr += self.offsets
-            flattened = arr.reshape(-1)
-            id_freq_map += np.bincount(flattened, minlength=self.hash_sizes.sum())
+            arr = np.load(_f, mmap_mode='r')
+            _count_npy_rows(table_hists, self.hash_sizes, arr, 0, arr.shape[0], scratch)
         return id_freq_map
 
+
 class PetastormCounter:
 
     def __init__(self, datafiles, hash_sizes, subsample_fraction=0.2, seed=1024):
         self.datafiles = datafiles
+        self.hash_sizes = list(hash_sizes)
         self.total_features = sum(hash_sizes)
 
         self.offsets = np.array([0, *np.cumsum(hash_sizes)[:-1]]).reshape(1, -1)
@@ -40,6 +92,7 @@ class PetastormCounter:
 
     def compute(self):
         _id_freq_map = np.zeros(self.total_features, dtype=np.int64)
+        table_hists = _table_views(_id_freq_map, self.hash_sizes)
 
         files = self.datafiles
         random.seed(self.seed)
@@ -55,6 +108,364 @@ class PetastormCounter:
                               total=sum([fragment.metadata.num_row_groups for fragment in dataset.fragments])):
                 sparse = np.concatenate([getattr(batch, col_name).reshape(-1, 1) for col_name in DEFAULT_CAT_NAMES],
                                         axis=1)
-                sparse = (sparse + self.offsets).reshape(-1)
-                _id_freq_map += np.bincount(sparse, minlength=self.total_features)
+                _accumulate(table_hists, sparse)
         return _id_freq_map
+
+
+class SketchFeatureCounter:
+    """
+    approximate the global statistics of the whole training set with bounded memory
+
+    Instead of an exact histogram over every id, a Count-Min sketch estimates the counts and a Space-Saving
+    summary tracks the ``capacity`` hottest ids, which is all the cache needs to rank rows for warmup and the
+    DATASET eviction strategy. The memory is ``O(depth / eps + capacity)`` independent of the hash sizes,
+    and every reported count over-estimates the truth by at most ``eps * N`` with probability ``1 - delta``.
+
+    Args:
+        datafiles (List[str]): the sparse npy files, or the parquet files when ``file_format='parquet'``.
+        hash_sizes (List[int]): number of embeddings per table.
+        capacity (int): number of heavy-hitter ids reported.
+        eps (float): relative error of the Count-Min sketch.
+        delta (float): failure probability of the Count-Min sketch.
+        file_format (str): npy | parquet.
+        chunk_size (int): rows absorbed by the sketches at a time.
+    """
+
+    def __init__(self, datafiles, hash_sizes, capacity=1_000_000, eps=1e-5, delta=0.01, file_format='npy',
+                 chunk_size=1_000_000, seed=1024):
+        if file_format not in ('npy', 'parquet'):
+            raise ValueError(f"Unsupported file format {file_format}, must be one of npy | parquet")
+        self.datafiles = datafiles
+        self.hash_sizes = np.array(hash_sizes).reshape(1, -1)
+        self.offsets = np.array([0, *np.cumsum(hash_sizes)[:-1]]).reshape(1, -1)
+        self.total_features = int(self.hash_sizes.sum())
+        self.capacity = capacity
+        self.eps = eps
+        self.delta = delta
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.cms = None
+        self.heavy_hitters = None
+
+    def _chunks(self):
+        if self.file_format == 'npy':
+            scratch = np.empty((self.chunk_size, self.hash_sizes.shape[1]), dtype=np.int64)
+            for _f in self.datafiles:
+                arr = np.load(_f, mmap_mode='r')
+                for start in range(0, arr.shape[0], self.chunk_size):
+                    chunk = arr[start:start + self.chunk_size]
+                    hashed = scratch[:chunk.shape[0]]
+                    np.remainder(chunk, self.hash_sizes, out=hashed)
+                    hashed += self.offsets
+                    yield hashed
+        else:
+            for _f in self.datafiles:
+                parquet_file = ParquetFile(_f)
+                for row_group in range(parquet_file.metadata.num_row_groups):
+                    table = parquet_file.read_row_group(row_group, columns=DEFAULT_CAT_NAMES)
+                    yield np.stack([table.column(col_name).to_numpy() for col_name in DEFAULT_CAT_NAMES],
+                                   axis=1) + self.offsets
+
+    def sketch(self):
+        self.cms = CountMinSketch(self.eps, self.delta, seed=self.seed)
+        self.heavy_hitters = SpaceSaving(self.capacity)
+        for chunk in self._chunks():
+            ids, counts = np.unique(chunk, return_counts=True)
+            self.cms.update(ids, counts)
+            self.heavy_hitters.update(ids, counts)
+        return self.cms, self.heavy_hitters
+
+    def top_ids(self, n=None):
+        """
+        the heavy-hitter ids, hottest first, with their counts bounded by both sketches
+        """
+        if self.heavy_hitters is None:
+            self.sketch()
+        ids, counts = self.heavy_hitters.top()
+        counts = np.minimum(counts, self.cms.estimate(ids))
+        order = np.argsort(counts, kind='stable')[::-1][:n]
+        return ids[order], counts[order]
+
+    def compute(self):
+        """
+        a dense id-frequency map compatible with the exact counters, zero outside the heavy hitters
+        """
+        ids, counts = self.top_ids()
+        id_freq_map = np.zeros(self.total_features, dtype=np.int64)
+        id_freq_map[ids] = counts
+        return id_freq_map
+
+
+def _open_partial(path, total_features):
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.int64, shape=(total_features,))
+
+
+def _count_npy_shard(shard, hash_sizes, chunk_size, out_path):
+    """
+    worker: count the (file, start, stop) row ranges of ``shard`` into a memory-mapped partial histogram
+    """
+    id_freq_map = _open_partial(out_path, sum(hash_sizes))
+    table_hists = _table_views(id_freq_map, hash_sizes)
+    hash_sizes = np.array(hash_sizes).reshape(1, -1)
+    scratch = np.empty((chunk_size, hash_sizes.shape[1]), dtype=np.int64)
+    for _f, start, stop in shard:
+        _count_npy_rows(table_hists, hash_sizes, np.load(_f, mmap_mode='r'), start, stop, scratch)
+    id_freq_map.flush()
+    return out_path
+
+
+def _count_parquet_shard(shard, hash_sizes, out_path):
+    """
+    worker: count the (file, row group) pieces of ``shard`` into a memory-mapped partial histogram
+    """
+    id_freq_map = _open_partial(out_path, sum(hash_sizes))
+    table_hists = _table_views(id_freq_map, hash_sizes)
+    for _f, row_group in shard:
+        table = ParquetFile(_f).read_row_group(row_group, columns=DEFAULT_CAT_NAMES)
+        sparse = np.stack([table.column(col_name).to_numpy() for col_name in DEFAULT_CAT_NAMES], axis=1)
+        _accumulate(table_hists, sparse)
+    id_freq_map.flush()
+    return out_path
+
+
+def _merge_partials(dst_path, src_path, chunk_size):
+    """
+    worker: add the partial histogram at ``src_path`` into the one at ``dst_path`` and drop the former
+    """
+    dst = np.load(dst_path, mmap_mode='r+')
+    src = np.load(src_path, mmap_mode='r')
+    for start in range(0, dst.shape[0], chunk_size):
+        dst[start:start + chunk_size] += src[start:start + chunk_size]
+    dst.flush()
+    del src
+    os.remove(src_path)
+    return dst_path
+
+
+class ParallelFeatureCounter:
+    """
+    count the id frequencies of the whole training set with a pool of worker processes
+
+    The npy row ranges (or parquet row groups) are split evenly across ``num_workers`` shards, every worker
+    counts its shard into a memory-mapped partial histogram under ``tmp_dir``, and the partials are reduced
+    pairwise in a tree of ``ceil(log2(num_workers))`` parallel merge rounds.
+
+    Args:
+        datafiles (List[str]): the sparse npy files, or the parquet files when ``file_format='parquet'``.
+        hash_sizes (List[int]): number of embeddings per table.
+        num_workers (Optional[int]): number of processes, defaults to ``os.cpu_count()``.
+        file_format (str): ``npy`` for hashed on load sparse arrays, ``parquet`` for preprocessed Criteo 1TB.
+        chunk_size (int): rows hashed at a time inside a worker, bounds the per-worker scratch memory.
+        tmp_dir (Optional[str]): where the partial histograms live, e.g. ``/dev/shm``.
+    """
+
+    def __init__(self, datafiles, hash_sizes, num_workers=None, file_format='npy', chunk_size=1_000_000,
+                 tmp_dir=None):
+        if file_format not in ('npy', 'parquet'):
+            raise ValueError(f"Unsupported file format {file_format}, must be one of npy | parquet")
+        self.datafiles = datafiles
+        self.hash_sizes = list(hash_sizes)
+        self.num_workers = num_workers or os.cpu_count()
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+        self.tmp_dir = tmp_dir
+
+    def _npy_shards(self):
+        lengths = [np.load(_f, mmap_mode='r').shape[0] for _f in self.datafiles]
+        rows_per_shard = max(1, int(np.ceil(sum(lengths) / self.num_workers)))
+        shards, current, filled = [], [], 0
+        for _f, length in zip(self.datafiles, lengths):
+            start = 0
+            while start < length:
+                stop = min(length, start + rows_per_shard - filled)
+                current.append((_f, start, stop))
+                filled += stop - start
+                start = stop
+                if filled == rows_per_shard:
+                    shards.append(current)
+                    current, filled = [], 0
+        if current:
+            shards.append(current)
+        return shards
+
+    def _parquet_shards(self):
+        pieces = []
+        for _f in self.datafiles:
+            metadata = ParquetFile(_f).metadata
+            pieces.extend((metadata.row_group(i).num_rows, _f, i) for i in range(metadata.num_row_groups))
+        # greedily hand the largest remaining row group to the least loaded shard
+        heap = [(0, i) for i in range(min(self.num_workers, len(pieces)))]
+        shards = [[] for _ in heap]
+        for num_rows, _f, row_group in sorted(pieces, reverse=True):
+            load, i = heapq.heappop(heap)
+            shards[i].append((_f, row_group))
+            heapq.heappush(heap, (load + num_rows, i))
+        return shards
+
+    def compute(self):
+        tmp_dir = tempfile.mkdtemp(prefix="id_freq_map_", dir=self.tmp_dir)
+        try:
+            with multiprocessing.Pool(self.num_workers) as pool:
+                if self.file_format == 'npy':
+                    shards = self._npy_shards()
+                    jobs = [(shard, self.hash_sizes, self.chunk_size, os.path.join(tmp_dir, f"partial_{i}.npy"))
+                            for i, shard in enumerate(shards)]
+                    partials = pool.starmap(_count_npy_shard, jobs)
+                else:
+                    shards = self._parquet_shards()
+                    jobs = [(shard, self.hash_sizes, os.path.join(tmp_dir, f"partial_{i}.npy"))
+                            for i, shard in enumerate(shards)]
+                    partials = pool.starmap(_count_parquet_shard, jobs)
+
+                # tree reduction, every round halves the number of partials
+                while len(partials) > 1:
+                    pairs = [(partials[i], partials[i + 1], self.chunk_size) for i in range(0, len(partials) - 1, 2)]
+                    carry = partials[-1:] if len(partials) % 2 else []
+                    partials = pool.starmap(_merge_partials, pairs) + carry
+
+            if not partials:
+                return np.zeros(sum(self.hash_sizes), dtype=np.int64)
+            return np.load(partials[0])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _count_file(path, hash_sizes, file_format, chunk_size, out_path):
+    """
+    worker: count a single file and store its partial histogram in the compact id-frequency map format
+
+    A table counts at most one id per row, so the histogram is int32 unless the file has more than 2**31 - 1 rows,
+    half the memory of an int64 one, and is stored without conversion.
+    """
+    if file_format == 'npy':
+        arr = np.load(path, mmap_mode='r')
+        num_rows = arr.shape[0]
+    else:
+        parquet_file = ParquetFile(path)
+        num_rows = parquet_file.metadata.num_rows
+    id_freq_map = np.zeros(sum(hash_sizes), dtype=np.int32 if num_rows <= np.iinfo(np.int32).max else np.int64)
+    table_hists = _table_views(id_freq_map, hash_sizes)
+    if file_format == 'npy':
+        hash_sizes_ = np.array(hash_sizes).reshape(1, -1)
+        scratch = np.empty((chunk_size, hash_sizes_.shape[1]), dtype=np.int64)
+        _count_npy_rows(table_hists, hash_sizes_, arr, 0, arr.shape[0], scratch)
+    else:
+        for row_group in range(parquet_file.metadata.num_row_groups):
+            table = parquet_file.read_row_group(row_group, columns=DEFAULT_CAT_NAMES)
+            _accumulate(table_hists,
+                        np.stack([table.column(col_name).to_numpy() for col_name in DEFAULT_CAT_NAMES], axis=1))
+    save_id_freq_map(out_path, id_freq_map, hash_sizes)
+    return out_path
+
+
+class IncrementalFeatureCounter:
+    """
+    compute the global statistics from per-file partial histograms cached in ``cache_dir``
+
+    Every partial is keyed by the absolute file path, its size and its mtime in ``manifest.json``, so only the
+    files that are new or changed since the last run are counted (in parallel, one file per worker), e.g.
+    adding ``day_24`` only counts ``day_24``. The partials are stored in the compact id-frequency map format.
+
+    Every worker holds the int32 histogram of all the tables, so the pool is capped by the available host memory.
+    A single process must update a ``cache_dir`` at a time, e.g. rank 0 behind a barrier.
+
+    Args:
+        datafiles (List[str]): the sparse npy files, or the parquet files when ``file_format='parquet'``.
+        hash_sizes (List[int]): number of embeddings per table.
+        cache_dir (str): where the manifest and the partial histograms are kept.
+        num_workers (Optional[int]): number of processes counting the missing files.
+        file_format (str): npy | parquet.
+        chunk_size (int): rows hashed at a time while counting a npy file.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, datafiles, hash_sizes, cache_dir, num_workers=None, file_format='npy',
+                 chunk_size=1_000_000):
+        if file_format not in ('npy', 'parquet'):
+            raise ValueError(f"Unsupported file format {file_format}, must be one of npy | parquet")
+        self.datafiles = [os.path.abspath(_f) for _f in datafiles]
+        self.hash_sizes = list(hash_sizes)
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers or os.cpu_count()
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _load_manifest(self):
+        manifest_path = os.path.join(self.cache_dir, self.MANIFEST)
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path) as fin:
+            manifest = json.load(fin)
+        if manifest.get("hash_sizes") != self.hash_sizes:
+            # partials counted under other hash sizes can not be reused
+            return {}
+        return manifest["files"]
+
+    def _save_manifest(self, files):
+        manifest_path = os.path.join(self.cache_dir, self.MANIFEST)
+        tmp_path = f"{manifest_path}.tmp.{os.getpid()}"
+        with open(tmp_path, "w") as fout:
+            json.dump({"hash_sizes": self.hash_sizes, "files": files}, fout, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    def update(self):
+        """
+        count the new or changed files, returns the paths of the partial histograms of all ``datafiles``
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = self._load_manifest()
+        stale = []
+        for _f in self.datafiles:
+            entry = files.get(_f)
+            if entry is None or entry["key"] != self._file_key(_f) \
+                    or not os.path.exists(os.path.join(self.cache_dir, entry["partial"])):
+                partial = f"partial_{hashlib.sha1(_f.encode()).hexdigest()}.bin"
+                files[_f] = {"key": self._file_key(_f), "partial": partial}
+                stale.append((_f, self.hash_sizes, self.file_format, self.chunk_size,
+                              os.path.join(self.cache_dir, partial)))
+        if stale:
+            worker_bytes = sum(self.hash_sizes) * 4 + self.chunk_size * len(self.hash_sizes) * 8
+            num_workers = max(1, min(self.num_workers, len(stale), psutil.virtual_memory().available // worker_bytes))
+            with multiprocessing.Pool(num_workers) as pool:
+                pool.starmap(_count_file, stale)
+            self._save_manifest(files)
+        return [os.path.join(self.cache_dir, files[_f]["partial"]) for _f in self.datafiles]
+
+    def compute(self):
+        id_freq_map = np.zeros(sum(self.hash_sizes), dtype=np.int64)
+        table_hists = _table_views(id_freq_map, self.hash_sizes)
+        for partial in self.update():
+            for hist, counts in zip(table_hists, load_id_freq_map(partial)):
+                hist += counts
+        return id_freq_map
+
+
+def build_feature_counter(datafiles,
+                          hash_sizes,
+                          counter='exact',
+                          file_format='npy',
+                          num_workers=None,
+                          sketch_capacity=1_000_000,
+                          cache_dir=None):
+    """
+    select the id-frequency counter by name, ``exact`` for the parallel histogram, ``sketch`` for the
+    bounded-memory heavy hitters or ``incremental`` for the per-file partials kept in ``cache_dir``
+    """
+    if counter == 'incremental':
+        return IncrementalFeatureCounter(datafiles,
+                                         hash_sizes,
+                                         cache_dir,
+                                         num_workers=num_workers,
+                                         file_format=file_format)
+    elif counter == 'exact':
+        return ParallelFeatureCounter(datafiles, hash_sizes, num_workers=num_workers, file_format=file_format)
+    elif counter == 'sketch':
+        return SketchFeatureCounter(datafiles, hash_sizes, capacity=sketch_capacity, file_format=file_format)
+    raise ValueError(f"Unsupported feature counter {counter}, must be one of exact | sketch | incremental")
@@ -0,0 +1,205 @@
+"""
+Compact on-disk format of the id-frequency map.
+
+Layout (little endian)::
+
+    header       magic "IDFQ", version, number of tables, top-k (0 without top-k)
+    table entry  x num_tables, see ``_TABLE_ENTRY``
+    payload      dense layout: the counts of all the tables, concatenated
+                 top-k layout: per table, aligned to ``_ALIGNMENT`` bytes, ``num_stored`` ids followed by their
+                 ``num_stored`` counts, hottest first, or ``num_embeddings`` counts for the tables not truncated
+
+The dense layout stores the counts of every table as int32, or int64 if they do not fit, instead of downcasting each
+table to the smallest unsigned dtype holding its maximum: a uniform signed dtype lets :func:`load_id_freq_map_tensor`
+memory-map the whole map as a single tensor, shared through the page cache by all ranks on a node, at the cost of up
+to 4x the size of the smaller tables. The top-k layout does downcast the counts per table to the smallest unsigned
+dtype, and only keeps the ``topk`` hottest ids of every table, the remaining ids are summarized by their total count
+and number, and are filled with the mean tail count when densified. Only files of ``FREQ_MAP_VERSION`` are read.
+"""
+import os
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+
+FREQ_MAP_MAGIC = b"IDFQ"
+FREQ_MAP_VERSION = 2
+
+_ALIGNMENT = 64
+# the unsigned dtypes of the top-k layout, then those of the dense layout
+_DTYPES = [np.uint8, np.uint16, np.uint32, np.uint64, np.int32, np.int64]
+_NUM_UNSIGNED = 4
+_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('num_tables', '<u4'), ('topk', '<u4')])
+_TABLE_ENTRY = np.dtype([
+    ('num_embeddings', '<u8'),
+    ('table_offset', '<u8'),
+    ('data_offset', '<u8'),
+    ('num_stored', '<u8'),
+    ('tail_count', '<u8'),
+    ('tail_num_ids', '<u8'),
+    ('count_dtype', 'u1'),
+    ('id_dtype', 'u1'),
+    ('padding', 'u1', (6,)),
+])
+
+
+def _smallest_dtype(max_value) -> int:
+    for code, dtype in enumerate(_DTYPES[:_NUM_UNSIGNED]):
+        if max_value <= np.iinfo(dtype).max:
+            return code
+    raise OverflowError(f"{max_value} does not fit in 64 bits")
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def save_id_freq_map(path: str,
+                     id_freq_map: Union[np.ndarray, torch.Tensor],
+                     num_embeddings_per_feature: Sequence[int],
+                     topk: Optional[int] = None) -> None:
+    """
+    Write the flat id-frequency map in the compact format.
+
+    Args:
+        path (str): destination file, written to a temporary file first and renamed atomically.
+        id_freq_map (Union[np.ndarray, torch.Tensor]): the flat count of every id, tables concatenated.
+        num_embeddings_per_feature (Sequence[int]): table sizes, must sum to ``len(id_freq_map)``.
+        topk (Optional[int]): if set, only store the ``topk`` hottest ids of each table plus a tail summary.
+    """
+    if topk is not None and topk <= 0:
+        raise ValueError(f"topk must be None or positive, got {topk}")
+    if isinstance(id_freq_map, torch.Tensor):
+        id_freq_map = id_freq_map.numpy()
+    num_embeddings_per_feature = [int(n) for n in num_embeddings_per_feature]
+    if sum(num_embeddings_per_feature) != id_freq_map.shape[0]:
+        raise ValueError(f"id_freq_map has {id_freq_map.shape[0]} entries, "
+                         f"but the tables hold {sum(num_embeddings_per_feature)} rows")
+
+    table_offsets = np.cumsum([0, *num_embeddings_per_feature])
+    entries = np.zeros(len(num_embeddings_per_feature), dtype=_TABLE_ENTRY)
+    payloads = []
+    data_offset = _align(_HEADER.itemsize + entries.nbytes)
+    if topk is None or topk >= max(num_embeddings_per_feature, default=0):
+        # dense layout, a single flat payload
+        code = _DTYPES.index(np.int32) if id_freq_map.max(initial=0) <= np.iinfo(np.int32).max \
+            else _DTYPES.index(np.int64)
+        flat = id_freq_map.astype(_DTYPES[code], copy=False)
+        entries['num_embeddings'] = entries['num_stored'] = num_embeddings_per_feature
+        entries['table_offset'] = table_offsets[:-1]
+        entries['data_offset'] = data_offset + table_offsets[:-1] * flat.itemsize
+        entries['count_dtype'] = code
+        payloads.append((data_offset, flat))
+        data_offset += flat.nbytes
+    else:
+        for i, num_embeddings in enumerate(num_embeddings_per_feature):
+            counts = id_freq_map[table_offsets[i]:table_offsets[i + 1]]
+            entry = entries[i]
+            entry['num_embeddings'] = num_embeddings
+            entry['table_offset'] = table_offsets[i]
+            entry['data_offset'] = data_offset
+            if topk < num_embeddings:
+                hot_ids = np.argpartition(counts, num_embeddings - topk)[num_embeddings - topk:]
+                hot_ids = hot_ids[np.argsort(counts[hot_ids], kind='stable')[::-1]]
+                hot_counts = counts[hot_ids]
+                entry['tail_count'] = counts.sum() - hot_counts.sum()
+                entry['tail_num_ids'] = num_embeddings - topk
+                entry['id_dtype'] = _smallest_dtype(num_embeddings - 1)
+                table_payload = [hot_ids.astype(_DTYPES[entry['id_dtype']])]
+            else:
+                hot_counts = counts
+                table_payload = []
+            entry['num_stored'] = hot_counts.shape[0]
+            entry['count_dtype'] = _smallest_dtype(hot_counts.max(initial=0))
+            table_payload.append(hot_counts.astype(_DTYPES[entry['count_dtype']]))
+            for arr in table_payload:
+                payloads.append((data_offset, arr))
+                data_offset = _align(data_offset + arr.nbytes)
+
+    header = np.array((FREQ_MAP_MAGIC, FREQ_MAP_VERSION, len(num_embeddings_per_feature), topk or 0), dtype=_HEADER)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as fout:
+        fout.write(header.tobytes())
+        fout.write(entries.tobytes())
+        for offset, arr in payloads:
+            fout.seek(offset)
+            np.ascontiguousarray(arr).tofile(fout)
+        fout.truncate(data_offset)
+    os.replace(tmp_path, path)
+
+
+def _load_entries(path: str) -> np.ndarray:
+    header = np.fromfile(path, dtype=_HEADER, count=1)
+    if header.shape[0] != 1 or header['magic'][0] != FREQ_MAP_MAGIC:
+        raise ValueError(f"{path} is not an id-frequency map file")
+    if header['version'][0] != FREQ_MAP_VERSION:
+        raise ValueError(f"Unsupported id-frequency map version {header['version'][0]} in {path}, "
+                         f"expected {FREQ_MAP_VERSION}")
+    num_tables = int(header['num_tables'][0])
+    return np.fromfile(path, dtype=_TABLE_ENTRY, count=num_tables, offset=_HEADER.itemsize)
+
+
+def load_id_freq_map(path: str) -> List[np.ndarray]:
+    """
+    Load the per-table counts of a compact id-frequency map.
+
+    Dense tables are returned as read-only ``np.memmap`` views in their stored dtype without copying,
+    top-k tables are densified with the mean tail count.
+    """
+    entries = _load_entries(path)
+
+    tables = []
+    for entry in entries:
+        num_embeddings, num_stored = int(entry['num_embeddings']), int(entry['num_stored'])
+        count_dtype = _DTYPES[entry['count_dtype']]
+        offset = int(entry['data_offset'])
+        if num_stored == num_embeddings:
+            tables.append(np.memmap(path, dtype=count_dtype, mode='r', offset=offset, shape=(num_embeddings,)))
+            continue
+        id_dtype = _DTYPES[entry['id_dtype']]
+        hot_ids = np.memmap(path, dtype=id_dtype, mode='r', offset=offset, shape=(num_stored,))
+        offset = _align(offset + hot_ids.nbytes)
+        hot_counts = np.memmap(path, dtype=count_dtype, mode='r', offset=offset, shape=(num_stored,))
+        tail_fill = int(entry['tail_count']) // max(int(entry['tail_num_ids']), 1)
+        fill_dtype = np.promote_types(_DTYPES[_smallest_dtype(tail_fill)], count_dtype)
+        counts = np.full(num_embeddings, tail_fill, dtype=fill_dtype)
+        counts[hot_ids] = hot_counts
+        tables.append(counts)
+    return tables
+
+
+def id_freq_map_to_tensor(tables: Sequence[np.ndarray]) -> torch.Tensor:
+    """
+    Concatenate per-table counts into the flat tensor consumed by the cached embeddings.
+
+    The result uses int32 whenever the counts allow it, which halves the resident size of the legacy int64 map
+    while keeping a dtype that ``torch.argsort`` / ``torch.topk`` support.
+    """
+    max_count = max((int(t.max(initial=0)) for t in tables), default=0)
+    dtype = np.int32 if max_count <= np.iinfo(np.int32).max else np.int64
+    flat = np.empty(sum(t.shape[0] for t in tables), dtype=dtype)
+    offset = 0
+    for t in tables:
+        flat[offset:offset + t.shape[0]] = t
+        offset += t.shape[0]
+    return torch.from_numpy(flat)
+
+
+def load_id_freq_map_tensor(path: str) -> torch.Tensor:
+    """
+    Load a compact id-frequency map as the flat tensor consumed by the cached embeddings.
+
+    The dense layout is returned without copying, as a view of a copy-on-write ``np.memmap`` of the file: the ranks
+    of a node share its pages through the page cache, and the consumers materialize only the slices they need. The
+    top-k layout is densified by :func:`id_freq_map_to_tensor`.
+    """
+    entries = _load_entries(path)
+    num_rows = int(entries['num_embeddings'].sum())
+    if num_rows > 0 and len(set(entries['count_dtype'].tolist())) == 1 and \
+            _DTYPES[entries['count_dtype'][0]] in (np.int32, np.int64) and \
+            (entries['num_stored'] == entries['num_embeddings']).all():
+        dtype = np.dtype(_DTYPES[entries['count_dtype'][0]])
+        start = int(entries['data_offset'][0])
+        if (entries['data_offset'] == start + entries['table_offset'] * dtype.itemsize).all():
+            return torch.from_numpy(np.memmap(path, dtype=dtype, mode='c', offset=start, shape=(num_rows,)))
+    return id_freq_map_to_tensor(load_id_freq_map(path))
@@ -0,0 +1,126 @@
+"""
+Frequency-ranked id space.
+
+Renumbering the ids of every table by decreasing dataset frequency (rank 0 being the hottest id of its table) makes
+the hot rows of a table physically contiguous in the host table, so cache misses touch fewer pages. The permutation
+is computed once by ``scripts/preprocess/remap_by_frequency.py``, which rewrites the sparse ids of a dataset into
+rank space and stores the inverse permutation as ``id_remap.npz`` next to them, to map trained tables back to the
+original ids for export.
+
+In rank space the frequency order is the id order: the dataset eviction policy evicts the largest ids first without
+an id-frequency map, and the cache no longer reorders its rows at startup.
+"""
+import os
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+
+ID_REMAP_FILE = "id_remap.npz"
+
+
+def frequency_ranks(id_freq_map: Union[np.ndarray, torch.Tensor],
+                    num_embeddings_per_feature: Sequence[int]) -> List[np.ndarray]:
+    """
+    The inverse permutation of every table: the original id holding every rank, hottest first. Ties keep the id
+    order.
+    """
+    if isinstance(id_freq_map, torch.Tensor):
+        id_freq_map = id_freq_map.numpy()
+    table_offsets = np.cumsum([0, *num_embeddings_per_feature])
+    if table_offsets[-1] != id_freq_map.shape[0]:
+        raise ValueError(f"id_freq_map has {id_freq_map.shape[0]} entries, "
+                         f"but the tables hold {table_offsets[-1]} rows")
+    inverse = []
+    for lo, hi in zip(table_offsets[:-1], table_offsets[1:]):
+        counts = id_freq_map[lo:hi].astype(np.int64)
+        inverse.append(np.argsort(-counts, kind='stable').astype(np.int32))
+    return inverse
+
+
+def rank_lookup(inverse: Sequence[np.ndarray]) -> List[np.ndarray]:
+    """
+    The forward permutation of every table: the rank of every original id.
+    """
+    forward = []
+    for table in inverse:
+        ranks = np.empty_like(table)
+        ranks[table] = np.arange(table.shape[0], dtype=table.dtype)
+        forward.append(ranks)
+    return forward
+
+
+def ranked_id_freq_map(id_freq_map: Union[np.ndarray, torch.Tensor], inverse: Sequence[np.ndarray]) -> np.ndarray:
+    """
+    The flat id-frequency map in rank space, decreasing within every table.
+    """
+    if isinstance(id_freq_map, torch.Tensor):
+        id_freq_map = id_freq_map.numpy()
+    table_offsets = np.cumsum([0, *(t.shape[0] for t in inverse)])
+    return np.concatenate([id_freq_map[lo + table] for lo, table in zip(table_offsets[:-1], inverse)])
+
+
+def remap_sparse(sparse: np.ndarray,
+                 forward: Sequence[np.ndarray],
+                 hash_sizes: Optional[Sequence[int]] = None,
+                 out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Rewrite a ``(num_samples, num_tables)`` array of per-table ids into rank space, hashing the raw ids first with
+    ``hash_sizes`` like the dataloaders do.
+    """
+    if out is None:
+        out = np.empty(sparse.shape, dtype=np.int32)
+    for t, ranks in enumerate(forward):
+        ids = sparse[:, t]
+        if hash_sizes is not None:
+            ids = np.remainder(ids, hash_sizes[t])
+        np.take(ranks, ids, out=out[:, t])
+    return out
+
+
+def save_id_remap(path: str, inverse: Sequence[np.ndarray]) -> None:
+    """
+    Write the inverse permutations, to a temporary file first renamed atomically.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 num_embeddings_per_feature=np.array([t.shape[0] for t in inverse], dtype=np.int64),
+                 **{f"table_{i}": table for i, table in enumerate(inverse)})
+    os.replace(tmp_path, path)
+
+
+def load_id_remap(path: str) -> List[np.ndarray]:
+    """
+    The inverse permutations written by :func:`save_id_remap`.
+    """
+    with np.load(path) as f:
+        return [f[f"table_{i}"] for i in range(f['num_embeddings_per_feature'].shape[0])]
+
+
+def is_rank_space(dataset_dir: Optional[str], num_embeddings_per_feature: Optional[Sequence[int]] = None) -> bool:
+    """
+    Whether the ids of ``dataset_dir`` were rewritten into rank space. Raises if its tables do not have
+    ``num_embeddings_per_feature`` rows: hashing rank-space ids into other table sizes would mix hot and cold ids.
+    """
+    if dataset_dir is None or not os.path.exists(os.path.join(dataset_dir, ID_REMAP_FILE)):
+        return False
+    if num_embeddings_per_feature is not None:
+        with np.load(os.path.join(dataset_dir, ID_REMAP_FILE)) as f:
+            sizes = f['num_embeddings_per_feature'].tolist()
+        if sizes != [int(n) for n in num_embeddings_per_feature]:
+            raise ValueError(f"The ids of {dataset_dir} are ranked for the table sizes {sizes}, "
+                             f"got {list(num_embeddings_per_feature)}")
+    return True
+
+
+def to_original_order(weight: torch.Tensor, inverse: Sequence[np.ndarray]) -> torch.Tensor:
+    """
+    Reorder the rows of a table trained in rank space (tables concatenated) back to the original ids.
+    """
+    table_offsets = np.cumsum([0, *(t.shape[0] for t in inverse)])
+    positions = torch.from_numpy(np.concatenate([table.astype(np.int64) + lo
+                                                 for lo, table in zip(table_offsets[:-1], inverse)]))
+    out = torch.empty_like(weight)
+    out.index_copy_(0, positions.to(weight.device), weight)
+    return out
@@ -0,0 +1,210 @@
+"""
+Compact on-disk format of sparse id traces, the ids and offsets of every batch looked up by the embedding.
+
+Layout (little endian)::
+
+    header       magic "IDTR", version
+    chunk        x num_batches, see ``_CHUNK``, followed by the encoded ids then the encoded offsets
+    index        byte position of every chunk (uint64), only present when the writer was closed
+    trailer      see ``_TRAILER``
+
+Ids and offsets are delta encoded, zigzag mapped and stored as LEB128 varints, which shrinks the offsets to
+a byte per bag and the ids to their significant bits. A trace whose writer did not close is still readable:
+the reader rebuilds the chunk index by walking the chunk headers.
+"""
+import os
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+
+ID_TRACE_MAGIC = b"IDTR"
+ID_TRACE_VERSION = 1
+
+_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4')])
+_CHUNK = np.dtype([
+    ('num_ids', '<u8'),
+    ('num_offsets', '<u8'),
+    ('ids_nbytes', '<u8'),
+    ('offsets_nbytes', '<u8'),
+    ('batch_size', '<u4'),
+    ('padding', '<u4'),
+])
+_TRAILER = np.dtype([('index_offset', '<u8'), ('num_batches', '<u8'), ('magic', 'S4'), ('padding', '<u4')])
+_MAX_VARINT_BYTES = 10
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """
+    Delta, zigzag and LEB128 varint encode a sequence of int64.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    deltas = np.diff(values, prepend=np.int64(0))
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).view(np.uint64)
+    # 7-bit groups of every value, low first, with the continuation bit set on all but the last used group
+    nbytes = np.ones(zigzag.shape[0], dtype=np.int64)
+    encoded = np.empty((zigzag.shape[0], _MAX_VARINT_BYTES), dtype=np.uint8)
+    for k in range(_MAX_VARINT_BYTES):
+        rest = zigzag >> np.uint64(7 * k)
+        encoded[:, k] = (rest & np.uint64(0x7f)).astype(np.uint8)
+        if k > 0:
+            nbytes += rest > 0
+    groups = np.arange(_MAX_VARINT_BYTES)[None, :]
+    encoded |= (groups < (nbytes - 1)[:, None]).astype(np.uint8) << 7
+    used = groups < nbytes[:, None]
+    return encoded[used]
+
+
+def decode_varints(data: np.ndarray, count: int) -> np.ndarray:
+    """
+    Inverse of :func:`encode_varints`, ``data`` holds exactly ``count`` varints.
+    """
+    if count == 0:
+        return np.empty(0, dtype=np.int64)
+    data = np.asarray(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    assert ends.shape[0] == count, f"expected {count} varints, found {ends.shape[0]}"
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    position = np.arange(data.shape[0]) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7f).astype(np.uint64) << (position.astype(np.uint64) * np.uint64(7))
+    zigzag = np.add.reduceat(parts, starts)
+    deltas = (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64)
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+class IdTraceWriter:
+    """
+    Appends batches to an id trace, see the module docstring for the layout.
+
+    Args:
+        path (str): destination file, truncated.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'wb')
+        header = np.zeros(1, dtype=_HEADER)
+        header['magic'] = ID_TRACE_MAGIC
+        header['version'] = ID_TRACE_VERSION
+        self._file.write(header.tobytes())
+        self._chunk_offsets = []
+
+    def append(self, ids, offsets, batch_size: Optional[int] = None) -> None:
+        """
+        Append the flat ``ids`` and the ``offsets`` of their bags, tensors or arrays, with the batch size of the
+        batch (the stride of a ``KeyedJaggedTensor``) if known.
+        """
+        if isinstance(ids, torch.Tensor):
+            ids = ids.cpu().numpy()
+        if isinstance(offsets, torch.Tensor):
+            offsets = offsets.cpu().numpy()
+        encoded_ids = encode_varints(ids)
+        encoded_offsets = encode_varints(offsets)
+        chunk = np.zeros(1, dtype=_CHUNK)
+        chunk['num_ids'] = ids.shape[0]
+        chunk['num_offsets'] = offsets.shape[0]
+        chunk['ids_nbytes'] = encoded_ids.shape[0]
+        chunk['offsets_nbytes'] = encoded_offsets.shape[0]
+        chunk['batch_size'] = batch_size or 0
+        self._chunk_offsets.append(self._file.tell())
+        self._file.write(chunk.tobytes())
+        self._file.write(encoded_ids.tobytes())
+        self._file.write(encoded_offsets.tobytes())
+
+    def __len__(self):
+        return len(self._chunk_offsets)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        trailer = np.zeros(1, dtype=_TRAILER)
+        trailer['index_offset'] = self._file.tell()
+        trailer['num_batches'] = len(self._chunk_offsets)
+        trailer['magic'] = ID_TRACE_MAGIC
+        self._file.write(np.asarray(self._chunk_offsets, dtype='<u8').tobytes())
+        self._file.write(trailer.tobytes())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class IdTraceReader:
+    """
+    Random access to the batches of an id trace, memory-mapped so only the replayed chunks are read.
+
+    Args:
+        path (str): trace file written by :class:`IdTraceWriter`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        header = self._data[:_HEADER.itemsize].view(_HEADER)[0]
+        if header['magic'] != ID_TRACE_MAGIC:
+            raise ValueError(f"{path} is not an id trace")
+        if header['version'] != ID_TRACE_VERSION:
+            raise ValueError(f"Unsupported id trace version {header['version']} in {path}")
+        self._chunk_offsets = self._read_index()
+
+    def _read_index(self) -> np.ndarray:
+        size = self._data.shape[0]
+        if size >= _HEADER.itemsize + _TRAILER.itemsize:
+            trailer = self._data[size - _TRAILER.itemsize:].view(_TRAILER)[0]
+            index_end = int(trailer['index_offset']) + 8 * int(trailer['num_batches'])
+            if trailer['magic'] == ID_TRACE_MAGIC and index_end == size - _TRAILER.itemsize:
+                return self._data[int(trailer['index_offset']):index_end].view('<u8')
+        # unclosed trace: walk the chunk headers, ignoring a truncated last chunk
+        chunk_offsets = []
+        position = _HEADER.itemsize
+        while position + _CHUNK.itemsize <= size:
+            chunk = self._data[position:position + _CHUNK.itemsize].view(_CHUNK)[0]
+            end = position + _CHUNK.itemsize + int(chunk['ids_nbytes']) + int(chunk['offsets_nbytes'])
+            if end > size:
+                break
+            chunk_offsets.append(position)
+            position = end
+        return np.asarray(chunk_offsets, dtype=np.uint64)
+
+    def __len__(self):
+        return self._chunk_offsets.shape[0]
+
+    def read(self, idx: int) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        The ids, offsets and batch size (0 if unknown) of batch ``idx``.
+        """
+        position = int(self._chunk_offsets[idx])
+        chunk = self._data[position:position + _CHUNK.itemsize].view(_CHUNK)[0]
+        position += _CHUNK.itemsize
+        ids_end = position + int(chunk['ids_nbytes'])
+        ids = decode_varints(self._data[position:ids_end], int(chunk['num_ids']))
+        offsets = decode_varints(self._data[ids_end:ids_end + int(chunk['offsets_nbytes'])],
+                                 int(chunk['num_offsets']))
+        return ids, offsets, int(chunk['batch_size'])
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray, int]:
+        return self.read(idx)
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, np.ndarray, int]]:
+        for idx in range(len(self)):
+            yield self.read(idx)
+
+    def batches(self, device: Optional[torch.device] = None) -> Iterator[Tuple[torch.Tensor, torch.Tensor, int]]:
+        """
+        Replay the trace as ``(ids, offsets, batch_size)`` long tensors on ``device``.
+        """
+        for ids, offsets, batch_size in self:
+            yield torch.from_numpy(ids).to(device), torch.from_numpy(offsets).to(device), batch_size
+
+    def id_batches(self) -> Iterator[torch.Tensor]:
+        """
+        Replay only the ids, e.g. for ``recsys.cache.simulate``.
+        """
+        for ids, _, _ in self:
+            yield torch.from_numpy(ids)
+
+    def nbytes(self) -> int:
+        return os.path.getsize(self.path)
@@ -0,0 +1,103 @@
+"""
+Bounded-memory frequency sketches over integer ids.
+
+Both structures are updated with batches of ``(unique ids, counts)`` so that a whole chunk of the dataset is
+absorbed with a handful of vectorized numpy calls.
+"""
+import math
+
+import numpy as np
+
+# odd multipliers of the multiply-shift hash family are drawn from this generator seed unless given
+_DEFAULT_SEED = 1024
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch: with probability ``1 - delta`` every estimate over-counts by at most ``eps * N``,
+    where ``N`` is the total count inserted so far.
+
+    Args:
+        eps (float): relative error, the width is ``e / eps`` rounded up to a power of two.
+        delta (float): failure probability, the depth is ``ln(1 / delta)`` rounded up.
+        seed (int): seed of the hash functions.
+    """
+
+    def __init__(self, eps=1e-5, delta=0.01, seed=_DEFAULT_SEED):
+        self.log_width = max(1, math.ceil(math.log2(math.e / eps)))
+        self.width = 1 << self.log_width
+        self.depth = max(1, math.ceil(math.log(1. / delta)))
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2**63, size=(self.depth, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=(self.depth, 1), dtype=np.uint64)
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+        self.total = 0
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    def _hash(self, ids):
+        ids = np.asarray(ids).astype(np.uint64, copy=False).reshape(1, -1)
+        with np.errstate(over='ignore'):
+            return ((self._a * ids + self._b) >> np.uint64(64 - self.log_width)).astype(np.int64)
+
+    def update(self, ids, counts):
+        for row, idx in zip(self.table, self._hash(ids)):
+            row += np.bincount(idx, weights=counts, minlength=self.width).astype(np.int64)
+        self.total += int(np.sum(counts))
+
+    def estimate(self, ids):
+        hashed = self._hash(ids)
+        return np.min(np.take_along_axis(self.table, hashed, axis=1), axis=0)
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters summary of at most ``capacity`` ids.
+
+    Batches are merged as mergeable summaries: ids already tracked add their count, new ids start from the
+    current minimum tracked count (their maximal undercount), and the summary is pruned back to the
+    ``capacity`` largest counts. Every id whose true count exceeds ``N / capacity`` is kept, and a tracked
+    count over-estimates the truth by at most its recorded ``errors`` entry.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ids = np.empty(0, dtype=np.int64)    # kept sorted for the merges
+        self.counts = np.empty(0, dtype=np.int64)
+        self.errors = np.empty(0, dtype=np.int64)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.counts.nbytes + self.errors.nbytes
+
+    def update(self, ids, counts):
+        """
+        ``ids`` must be unique within the batch, as returned by ``np.unique(..., return_counts=True)``.
+        """
+        floor = self.counts.min() if self.counts.shape[0] >= self.capacity else 0
+        pos = np.searchsorted(self.ids, ids)
+        tracked = pos < self.ids.shape[0]
+        tracked[tracked] = self.ids[pos[tracked]] == ids[tracked]
+
+        self.counts[pos[tracked]] += counts[tracked]
+        new_ids = ids[~tracked]
+        all_ids = np.concatenate([self.ids, new_ids])
+        all_counts = np.concatenate([self.counts, counts[~tracked] + floor])
+        all_errors = np.concatenate([self.errors, np.full(new_ids.shape[0], floor, dtype=np.int64)])
+
+        if all_ids.shape[0] > self.capacity:
+            keep = np.argpartition(all_counts, all_ids.shape[0] - self.capacity)[-self.capacity:]
+        else:
+            keep = np.arange(all_ids.shape[0])
+        order = np.argsort(all_ids[keep])
+        keep = keep[order]
+        self.ids, self.counts, self.errors = all_ids[keep], all_counts[keep], all_errors[keep]
+
+    def top(self, n=None):
+        """
+        the tracked ids and counts, hottest first
+        """
+        order = np.argsort(self.counts, kind='stable')[::-1][:n]
+        return self.ids[order], self.counts[order]
@@ -1,6 +1,11 @@
+import mmap
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Tuple
+
 import numpy as np
 import torch
 import torch.distributed as dist
+from torch.utils.data import get_worker_info
 from torchrec.sparse.jagged_tensor import KeyedJaggedTensor
 from torchrec.datasets.utils import Batch
 
@@ -97,3 +102,386 @@ class KJTTransform:
             ),
             labels=batch[1],
         )
+
+
+def batch_buffers(args) -> int:
+    """
+    Batch buffers of a :class:`BatchAssembler` feeding the training loops: the batches they hold at once, queued for
+    --prefetch_num or --lookahead (+ --readahead), one more preloaded by the stream dataloader and one in flight on a
+    copy stream, plus the batch in assembly. With --num_workers, every worker has its own buffers, it also holds
+    the batches it queued ahead, 2 by default, and the one in the pin memory thread.
+    """
+    held = max(getattr(args, 'prefetch_num', 1),
+               getattr(args, 'lookahead', 0) + getattr(args, 'readahead', 0) + 1)
+    if getattr(args, 'num_workers', 0) > 0:
+        held += 3
+    return held + 3
+
+
+def worker_shard(num_batches: int) -> range:
+    """
+    The batches produced by the current DataLoader worker, all of them out of a worker.
+
+    Every worker produces every ``num_workers``-th batch from its id, so that the DataLoader, which takes a batch from
+    every worker in turn, yields them in order. The numpy RNG of a worker is seeded from its torch seed, the workers
+    inherit the same state and would shuffle alike otherwise.
+    """
+    worker = get_worker_info()
+    if worker is None:
+        return range(num_batches)
+    np.random.seed(worker.seed % (1 << 32))
+    return range(worker.id, num_batches, worker.num_workers)
+
+
+def batch_row_ranges(num_rows_per_file: List[int], batch_size: int, batches: Iterable[int]):
+    """
+    The rows of every batch of ``batches``, ``batch_size`` consecutive rows of files of ``num_rows_per_file`` rows,
+    as a list of (file index, row slice) pieces.
+    """
+    file_starts = np.cumsum([0, *num_rows_per_file])
+    for batch_idx in batches:
+        lo, hi = batch_idx * batch_size, (batch_idx + 1) * batch_size
+        file_idx = int(np.searchsorted(file_starts, lo, side='right')) - 1
+        pieces = []
+        while lo < hi:
+            end = min(hi, int(file_starts[file_idx + 1]))
+            if end > lo:
+                pieces.append((file_idx, slice(lo - int(file_starts[file_idx]), end - int(file_starts[file_idx]))))
+            lo = end
+            file_idx += 1
+        yield pieces
+
+
+def block_shuffle(num_rows_per_file: List[int], block_rows: int, seed: int, epoch: int,
+                  rank: int) -> Tuple[List[List[Tuple[int, slice]]], np.random.Generator]:
+    """
+    The rows of files of ``num_rows_per_file`` rows split in blocks of ``block_rows`` rows, the last block of a file
+    shorter, as single-piece lists of :func:`batch_row_ranges`, in a random order drawn from ``seed``, ``epoch`` and
+    ``rank``, and the generator of the :class:`ShuffleBuffer` the rows of the blocks are streamed through.
+
+    The order is the same in every DataLoader worker, which takes every ``num_workers``-th block from its id, and the
+    generator is drawn from its id too. Datapipes whose ranks read the same rows, split the batches afterwards,
+    must be given the same ``rank``.
+    """
+    blocks = [[(file_idx, slice(lo, min(lo + block_rows, num_rows)))]
+              for file_idx, num_rows in enumerate(num_rows_per_file)
+              for lo in range(0, num_rows, block_rows)]
+    order = np.random.default_rng([seed, epoch, rank]).permutation(len(blocks))
+    worker_id = 0
+    worker = get_worker_info()
+    if worker is not None:
+        order = order[worker.id::worker.num_workers]
+        worker_id = worker.id
+    return [blocks[i] for i in order], np.random.default_rng([seed, epoch, rank, 1 + worker_id])
+
+
+def mmap_advise(arr: np.ndarray, advice: str, index=None) -> None:
+    """
+    ``madvise`` the pages of ``arr[index]`` (all of ``arr`` if not given), ``arr`` being a numpy memmap or a view of
+    one, with ``mmap.MADV_{advice}``, e.g. ``WILLNEED`` to read them ahead into the page cache. Nothing for arrays
+    not memory-mapped or advices not supported. The rows of a view not contiguous, e.g. the columns of a
+    feature-major array, are advised one by one.
+    """
+    mapping = getattr(arr, '_mmap', None)
+    advice = getattr(mmap, f"MADV_{advice}", None)
+    if mapping is None or advice is None or not hasattr(mapping, 'madvise'):
+        return
+    view = arr if index is None else arr[index]
+    if view.size == 0:
+        return
+    base = np.frombuffer(mapping, dtype=np.uint8).ctypes.data
+    for block in ([view] if view.flags.c_contiguous else view):
+        start = block.ctypes.data - base
+        aligned = start - start % mmap.PAGESIZE
+        mapping.madvise(advice, aligned, min(start + block.nbytes, len(mapping)) - aligned)
+
+
+def read_ahead(batches: Iterable[List[Tuple[int, slice]]],
+               arrays: Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]],
+               distance: int = 4,
+               feature_major: bool = False) -> Iterator[List[Tuple[int, slice]]]:
+    """
+    The pieces of ``batches``, see :func:`batch_row_ranges`, advising the kernel to read the rows of every batch
+    ``distance`` batches before it is yielded, from the memory-mapped per-file (dense, sparse, labels) ``arrays``. The
+    sparse arrays are ``[columns, rows]`` if ``feature_major``.
+    """
+    queue = deque()
+    for pieces in batches:
+        for file_idx, rows in pieces:
+            for arrs, index in zip(arrays, (rows, (slice(None), rows) if feature_major else rows, rows)):
+                mmap_advise(arrs[file_idx], 'WILLNEED', index)
+        queue.append(pieces)
+        if len(queue) > distance:
+            yield queue.popleft()
+    yield from queue
+
+
+def _take_rows(src: np.ndarray, order: np.ndarray, out: np.ndarray) -> None:
+    # np.take only writes to an output of the same dtype, memory-mapped arrays keep their stored dtype
+    if src.dtype == out.dtype:
+        np.take(src, order, axis=0, out=out)
+    else:
+        out[:] = np.take(src, order, axis=0)
+
+
+class BatchAssembler:
+    """
+    Assembles batches of rows read from row-major (dense, sparse, labels) numpy arrays into a ring of preallocated
+    buffers, pinned if ``pin_memory``.
+
+    The rows appended are kept as views until the batch is full, then gathered once into the batch buffers: shuffled
+    by a permutation drawn for every batch if ``shuffle``, the sparse ``columns`` transposed feature-major as the
+    values of a KeyedJaggedTensor of one id per bag. The gather goes by tiles of rows small enough for the transpose
+    to stay in cache, no intermediate concatenated, shuffled or transposed batch is made, except the concatenation
+    of the batches straddling two files into a staging buffer.
+
+    The tensors returned by :meth:`pop` are views of a buffer reused ``num_buffers`` batches later, the consumer must
+    hold fewer batches than that, see :func:`batch_buffers`. In a DataLoader worker, the buffers are allocated in
+    shared memory instead of pinned, so the batches reach the main process without a copy.
+
+    Args:
+        batch_size (int): rows per batch.
+        num_dense (int): dense features per row.
+        columns (np.ndarray): sparse columns of a batch, in order.
+        shuffle (bool): shuffle the rows of every batch.
+        num_buffers (int): batch buffers of the ring.
+        pin_memory (bool): pin the buffers, ignored without CUDA.
+        hashes (Optional[np.ndarray]): if given, the ids of every column are taken modulo its hash size, when the
+            sparse arrays are not hashed beforehand.
+        sparse_offsets (Optional[np.ndarray]): if given, added to the ids of every column after the hashing.
+    """
+
+    tile_rows = 1024
+
+    def __init__(self,
+                 batch_size: int,
+                 num_dense: int,
+                 columns: np.ndarray,
+                 shuffle: bool = False,
+                 num_buffers: int = 4,
+                 pin_memory: bool = False,
+                 hashes: Optional[np.ndarray] = None,
+                 sparse_offsets: Optional[np.ndarray] = None):
+        self.batch_size = batch_size
+        self.columns = np.asarray(columns)
+        self.shuffle = shuffle
+        in_worker = get_worker_info() is not None
+        self.pin_memory = pin_memory and not in_worker and torch.cuda.is_available()
+        self._buffers = [(torch.empty(batch_size, num_dense, dtype=torch.float32, pin_memory=self.pin_memory),
+                          torch.empty(len(self.columns), batch_size, dtype=torch.int64, pin_memory=self.pin_memory),
+                          torch.empty(batch_size, dtype=torch.int32, pin_memory=self.pin_memory))
+                         for _ in range(num_buffers)]
+        if in_worker:
+            for buffers in self._buffers:
+                for buffer in buffers:
+                    buffer.share_memory_()
+        self._hashes = None if hashes is None else torch.as_tensor(np.asarray(hashes), dtype=torch.int64).view(-1, 1)
+        self._sparse_offsets = None if sparse_offsets is None else \
+            torch.as_tensor(np.asarray(sparse_offsets), dtype=torch.int64).view(-1, 1)
+        self._slot = 0
+        self._pieces = []
+        self._staging = None
+        self._tile = None
+        self.rows = 0
+
+    def append(self, dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> None:
+        """
+        Add rows to the batch in assembly, at most the rows it misses. The arrays must not change until :meth:`pop`.
+        """
+        if self.rows + dense.shape[0] > self.batch_size:
+            raise ValueError(f"{dense.shape[0]} rows overflow a batch of {self.batch_size - self.rows} missing rows")
+        self._pieces.append((dense, sparse, labels.reshape(-1)))
+        self.rows += dense.shape[0]
+
+    def _rows(self):
+        """
+        The rows of the batch in assembly as single arrays, concatenated into the staging buffer if need be.
+        """
+        if len(self._pieces) == 1:
+            return self._pieces[0]
+        if self._staging is None:
+            self._staging = tuple(
+                np.empty((self.batch_size, *a.shape[1:]), dtype=a.dtype) for a in self._pieces[0])
+        for staging, arrays in zip(self._staging, zip(*self._pieces)):
+            np.concatenate(arrays, out=staging)
+        return self._staging
+
+    def pop(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        The full batch in assembly: dense features, feature-major sparse values and labels, and start the next one.
+        """
+        if self.rows != self.batch_size:
+            raise RuntimeError(f"The batch in assembly misses {self.batch_size - self.rows} rows")
+        dense, values, labels = self._buffers[self._slot]
+        src_dense, src_sparse, src_labels = self._rows()
+        out_values = values.numpy()
+        all_columns = len(self.columns) == src_sparse.shape[1] and \
+            bool((self.columns == np.arange(len(self.columns))).all())
+        if self.shuffle:
+            order = np.random.permutation(self.batch_size)
+            _take_rows(src_dense, order, dense.numpy())
+            _take_rows(src_labels, order, labels.numpy())
+            if self._tile is None:
+                self._tile = np.empty((self.tile_rows, src_sparse.shape[1]), dtype=src_sparse.dtype)
+        else:
+            dense.numpy()[:] = src_dense
+            labels.numpy()[:] = src_labels
+        for lo in range(0, self.batch_size, self.tile_rows):
+            hi = min(lo + self.tile_rows, self.batch_size)
+            if self.shuffle:
+                rows = np.take(src_sparse, order[lo:hi], axis=0, out=self._tile[:hi - lo])
+            else:
+                rows = src_sparse[lo:hi]
+            out_values[:, lo:hi] = rows.T if all_columns else rows.T[self.columns]
+        if self._hashes is not None:
+            values.remainder_(self._hashes)
+        if self._sparse_offsets is not None:
+            values.add_(self._sparse_offsets)
+        self._slot = (self._slot + 1) % len(self._buffers)
+        self._pieces = []
+        self.rows = 0
+        return dense, values.view(-1), labels
+
+
+class FeatureMajorBatchAssembler(BatchAssembler):
+    """
+    A :class:`BatchAssembler` over feature-major sparse arrays, ``[num_columns, num_rows]`` with the ids of every
+    column contiguous, the rows appended being column slices of them.
+
+    The ids of every column are taken once into the batch buffers, in the order of the permutation of the batch if
+    ``shuffle``, else as a plain copy of contiguous ranges, for the KeyedJaggedTensor values to be one contiguous
+    array. The dense features and labels of unshuffled batches within a single file are returned as views of the
+    arrays appended when not ``pin_memory``, without any copy.
+
+    ``sparse_offsets``, if given, is added to the ids of every column, e.g. to shift ids offset over all the tables
+    to the offsets over the tables of a batch. ``hashes`` is not supported, the ids must be hashed beforehand.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FeatureMajorBatchAssembler, self).__init__(*args, **kwargs)
+        if self._hashes is not None:
+            raise ValueError("FeatureMajorBatchAssembler requires the ids to be hashed beforehand")
+
+    def _rows(self):
+        if len(self._pieces) == 1:
+            return self._pieces[0]
+        if self._staging is None:
+            dense, sparse, labels = self._pieces[0]
+            self._staging = (np.empty((self.batch_size, dense.shape[1]), dtype=dense.dtype),
+                             np.empty((sparse.shape[0], self.batch_size), dtype=sparse.dtype),
+                             np.empty(self.batch_size, dtype=labels.dtype))
+        for axis, staging, arrays in zip((0, 1, 0), self._staging, zip(*self._pieces)):
+            np.concatenate(arrays, axis=axis, out=staging)
+        return self._staging
+
+    def pop(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if self.rows != self.batch_size:
+            raise RuntimeError(f"The batch in assembly misses {self.batch_size - self.rows} rows")
+        dense, values, labels = self._buffers[self._slot]
+        views = len(self._pieces) == 1 and not self.shuffle and not self.pin_memory
+        src_dense, src_sparse, src_labels = self._rows()
+        out_values = values.numpy()
+        if self.shuffle:
+            order = np.random.permutation(self.batch_size)
+            np.take(src_dense, order, axis=0, out=dense.numpy())
+            np.take(src_labels, order, axis=0, out=labels.numpy())
+            for j, c in enumerate(self.columns):
+                np.take(src_sparse[c], order, out=out_values[j])
+        else:
+            if views:
+                dense, labels = torch.from_numpy(src_dense), torch.from_numpy(src_labels)
+            else:
+                dense.numpy()[:] = src_dense
+                labels.numpy()[:] = src_labels
+            for j, c in enumerate(self.columns):
+                out_values[j] = src_sparse[c]
+        if self._sparse_offsets is not None:
+            values.add_(self._sparse_offsets)
+        self._slot = (self._slot + 1) % len(self._buffers)
+        self._pieces = []
+        self.rows = 0
+        return dense, values.view(-1), labels
+
+
+class ShuffleBuffer:
+    """
+    A shuffle buffer (reservoir) of ``capacity`` rows of (dense, sparse, labels) row-major arrays streamed through it
+    by :meth:`push`: once the buffer is full, every row pushed takes the slot of a buffered row drawn at random into
+    the batch in the making, so that rows of up to ``capacity`` rows apart are mixed in constant memory. The rows
+    left are drawn in a random order by :meth:`drain`.
+
+    The batches of ``batch_size`` rows yielded are new arrays, owned by the consumer.
+    """
+
+    def __init__(self, capacity: int, batch_size: int, rng: np.random.Generator):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.rng = rng
+        self._buffers: Optional[List[np.ndarray]] = None
+        self._size = 0
+        self._batch: Optional[List[np.ndarray]] = None
+        self._ready = 0
+
+    def _draw(self, slots: np.ndarray, rows: Optional[Tuple[np.ndarray, ...]] = None) -> Iterator[Tuple]:
+        # moves the buffered rows of slots into the batch, replaced by rows if any, yields the batch once full
+        if self._batch is None:
+            self._batch = [np.empty((self.batch_size, *buf.shape[1:]), dtype=buf.dtype) for buf in self._buffers]
+        for i, buf in enumerate(self._buffers):
+            self._batch[i][self._ready:self._ready + len(slots)] = buf[slots]
+            if rows is not None:
+                buf[slots] = rows[i]
+        self._ready += len(slots)
+        if self._ready == self.batch_size:
+            batch, self._batch, self._ready = self._batch, None, 0
+            yield tuple(batch)
+
+    def push(self, dense: np.ndarray, sparse: np.ndarray, labels: np.ndarray) -> Iterator[Tuple[np.ndarray, ...]]:
+        """
+        Streams the rows through the buffer, yields the batches completed meanwhile.
+        """
+        arrays = (dense, sparse, labels)
+        if self._buffers is None:
+            self._buffers = [np.empty((self.capacity, *a.shape[1:]), dtype=a.dtype) for a in arrays]
+        lo, num_rows = 0, len(dense)
+        while lo < num_rows:
+            if self._size < self.capacity:
+                rows = min(self.capacity - self._size, num_rows - lo)
+                for buf, a in zip(self._buffers, arrays):
+                    buf[self._size:self._size + rows] = a[lo:lo + rows]
+                self._size += rows
+            else:
+                rows = min(self.batch_size - self._ready, self.capacity, num_rows - lo)
+                slots = self.rng.choice(self.capacity, rows, replace=False)
+                yield from self._draw(slots, tuple(a[lo:lo + rows] for a in arrays))
+            lo += rows
+
+    def drain(self, drop_last: bool = True) -> Iterator[Tuple[np.ndarray, ...]]:
+        """
+        Yields the batches of the rows left in the buffer, in a random order, the last one short of rows unless
+        ``drop_last``, and empties the buffer.
+        """
+        order = self.rng.permutation(self._size)
+        lo = 0
+        while lo < self._size:
+            slots = order[lo:lo + self.batch_size - self._ready]
+            lo += len(slots)
+            yield from self._draw(slots)
+        if self._ready > 0 and not drop_last:
+            yield tuple(b[:self._ready] for b in self._batch)
+        self._size, self._batch, self._ready = 0, None, 0
+
+    def stream(self,
+               blocks: Iterable[List[Tuple[int, slice]]],
+               arrays: Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]],
+               feature_major: bool = False) -> Iterator[Tuple[np.ndarray, ...]]:
+        """
+        The batches of the rows of ``blocks``, see :func:`block_shuffle`, of the per-file (dense, sparse, labels)
+        ``arrays``, the sparse arrays being ``[columns, rows]`` if ``feature_major``, streamed through the buffer and
+        drained, the last batch short of rows dropped.
+        """
+        dense_arrs, sparse_arrs, labels_arrs = arrays
+        for pieces in blocks:
+            for file_idx, rows in pieces:
+                sparse = sparse_arrs[file_idx][:, rows].T if feature_major else sparse_arrs[file_idx][rows]
+                yield from self.push(dense_arrs[file_idx][rows], sparse, labels_arrs[file_idx][rows])
+        yield from self.drain()
@@ -1,5 +1,6 @@
 import os
 import time
+from collections import deque
 from dataclasses import dataclass, field
 from typing import List, Optional
 from tqdm import tqdm
@@ -10,8 +11,12 @@ import torchmetrics as metrics
 
 from recsys.utils import get_mem_info
 from recsys.datasets import criteo, avazu
+from recsys.datasets.id_remap import is_rank_space
 from recsys.models.dlrm import HybridParallelDLRM
-from recsys.utils import FiniteDataIter, TrainValTestResults
+from recsys.cache import CACHE_BACKENDS, CACHE_DTYPES, HOST_QUANTIZATIONS, LookaheadPrefetcher, StochasticRoundingSGD, \
+    format_cache_stats
+from recsys.utils import FiniteDataIter, TrainValTestResults, DecayedFrequency, NUMA_POLICIES, local_numa_node, \
+    set_process_numa_policy, measure_numa_bandwidth, format_numa_bandwidth
 
 import colossalai
 
@@ -73,10 +78,14 @@ def parse_args():
         action="store_true",
         help="--mmap_mode mmaps the dataset."
         " That is, the dataset is kept on disk but is accessed as if it were in memory."
-        " --mmap_mode is intended mostly for faster debugging. Use --mmap_mode to bypass"
-        " preloading the dataset when preloading takes too long or when there is "
+        " The Kaggle / Avazu npy files are mapped in their stored dtype, the ids are converted and hashed"
+        " batch by batch and read a few batches ahead, leaving the host memory to the embedding table."
+        " Use --mmap_mode to bypass preloading the dataset when preloading takes too long or when there is "
         " insufficient memory available to load the full dataset.",
     )
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="DataLoader worker processes assembling the batches of the in-memory datasets, every "
+                        "worker producing every num_workers-th batch into shared memory")
     parser.add_argument(
         "--dataset_dir",
         type=str,
@@ -90,6 +99,13 @@ def parse_args():
         action="store_true",
         help="Shuffle each batch during training.",
     )
+    parser.add_argument("--shuffle_block_rows", type=int, default=0,
+                        help="shuffle the training rows out of core instead of each batch: read the npy datasets by "
+                        "blocks of this many rows in a random order of every epoch and rank, streamed through a "
+                        "shuffle buffer of --shuffle_buffer_rows rows (the Terabyte parquet row groups are read in a "
+                        "random order already), 0 disables it")
+    parser.add_argument("--shuffle_buffer_rows", type=int, default=1 << 20,
+                        help="rows of the shuffle buffer of --shuffle_block_rows")
 
     # Model
     parser.add_argument(
@@ -118,18 +134,78 @@ def parse_args():
         help="Size of each embedding.",
     )
     parser.add_argument("--use_cpu", action='store_true')
-    parser.add_argument("--use_cache_mgr_async_copy", action='store_true')
+    parser.add_argument("--use_cache_mgr_async_copy", action='store_true',
+                        help="asynchronous cache row transfers. With the reference backend, the swaps run on a "
+                        "background transfer worker and its queue depth, gather / copy times and overlap are logged")
     parser.add_argument("--use_sparse_embed_grad", action='store_true')
     parser.add_argument("--use_cache", action='store_true')
+    parser.add_argument("--cache_backend", type=str, default='colossalai', choices=list(CACHE_BACKENDS),
+                        help="implementation of the software cache, the reference backend is a pure PyTorch "
+                        "single-process engine for experimenting with the cache internals")
     parser.add_argument("--cache_ratio",
                         type=float,
                         default=0.01,
                         help="cache ratio. "
                         "*** Please make sure it can hold AT LEAST ONE BATCH OF SPARSE FEATURE IDS ***")
+    parser.add_argument("--resident_rows", type=int, default=0,
+                        help="keep the tables of at most this many rows in a plain embedding bag on the device, "
+                        "only the larger tables go through the cache. On several processes the resident tables are "
+                        "replicated and their gradients all-reduced, not supported with --use_tablewise")
+    parser.add_argument("--cache_budget_bytes", type=int, default=None,
+                        help="device memory of the cached rows, replacing --cache_ratio. The rows are split over the "
+                        "tables to maximize the expected hits given --use_freq, tiny tables being fully cached")
     parser.add_argument("--use_freq", action='store_true',
                         help="use the dataset freq information to initialize the softwar cache")
+    parser.add_argument("--id_freq_counter", type=str, default='exact', choices=['exact', 'sketch', 'incremental'],
+                        help="how the dataset freq information is collected, exact histogram, "
+                        "approximate Count-Min / Space-Saving sketch, or exact per-file partials that only count "
+                        "new or changed files")
+    parser.add_argument("--sketch_capacity", type=int, default=1_000_000,
+                        help="number of the hottest ids tracked by the sketch counter")
     parser.add_argument("--use_lfu", action='store_true',
                         help="use the LFU as the cache eviction strategy. If false use DATASET aware version")
+    parser.add_argument("--eviction_policy", type=str, default=None,
+                        help="cache eviction policy, one of lfu | dataset | lru | decayed_lfu | arc | 2q, or a comma "
+                        "separated policy per table with --use_tablewise. Overrides --use_lfu, the colossalai "
+                        "backend only supports lfu and dataset")
+    parser.add_argument("--admission_filter", type=str, default='none', choices=['none', 'tinylfu'],
+                        help="only cache a missed row when it is estimated hotter than the row it would evict, the "
+                        "rejected rows are served from scratch rows for one step. Reference backend only")
+    parser.add_argument("--bypass_ratio", type=float, default=0.1,
+                        help="number of scratch rows serving the rows rejected by the admission filter, relative "
+                        "to the cache rows")
+    parser.add_argument("--numa_policy", type=str, default='none', choices=NUMA_POLICIES,
+                        help="NUMA placement of the host embedding table: bind it to the node local to the GPU, "
+                        "interleave it over the nodes, or shard its rows over the nodes (reference backend only). "
+                        "The host gather threads and staging buffers follow the placement")
+    parser.add_argument("--host_table_file", type=str, default=None,
+                        help="keep the host embedding table in this file, e.g. on a local NVMe drive, for tables "
+                        "larger than host memory. The file is overwritten. Reference backend only")
+    parser.add_argument("--host_cache_bytes", type=int, default=1 << 30,
+                        help="host memory caching blocks of --host_table_file")
+    parser.add_argument("--cache_dtype", type=str, default='fp32', choices=list(CACHE_DTYPES),
+                        help="precision of the cached embedding rows and of the unquantized host table, there is no "
+                        "fp32 master copy. "
+                        "--cache_ratio counts rows, double it to keep the cache footprint. Reference backend only")
+    parser.add_argument("--host_quantization", type=str, default='none', choices=['none', *HOST_QUANTIZATIONS],
+                        help="store the host embedding table row-wise int8 / int4 quantized. The rows are swapped "
+                        "in and out quantized, dequantized on the device on swap-in and requantized on it on "
+                        "write-back. Reference backend only")
+    parser.add_argument("--nearest_rounding", action='store_true',
+                        help="round the reduced-precision cached rows to the nearest on update instead of "
+                        "stochastically")
+    parser.add_argument("--readahead", type=int, default=0,
+                        help="with --lookahead, read the rows of this many more upcoming batches ahead from "
+                        "--host_table_file before preparing them")
+    parser.add_argument("--record_trace", type=str, default=None,
+                        help="record the sparse ids of every training batch, as loaded by the rank before any "
+                        "all-to-all, into this id trace file, suffixed with .rank<rank> when distributed, for replay by "
+                        "the cache benchmarks")
+    parser.add_argument("--freq_decay", type=float, default=None,
+                        help="track an exponentially-decayed running id frequency with this per-iteration decay, "
+                        "and refresh the LFU eviction ranking from it. Requires the lfu or decayed_lfu policy")
+    parser.add_argument("--freq_refresh_interval", type=int, default=1000,
+                        help="number of iterations between two refreshes of the eviction ranking")
     parser.add_argument("--warmup_ratio", type=float, default=0.7, help="warmup ratio of the software cache")
     parser.add_argument("--buffer_size", type=int, default=0,
                         help="limit buffer size, if buffer_size=1, do not use the buffer.")
@@ -156,6 +232,10 @@ def parse_args():
         default=1,
         help="Number of batch prefetched for caching",
     )
+    parser.add_argument("--lookahead", type=int, default=0,
+                        help="prepare the cache for this many batches ahead of the current one on a worker thread, "
+                        "one batch per iteration, pinning the rows of the batches in flight. Replaces the "
+                        "--prefetch_num chunking, requires a backend supporting pinning (reference)")
     parser.add_argument(
         "--adagrad",
         dest="adagrad",
@@ -211,11 +291,19 @@ def _train(model : HybridParallelDLRM,
            prof=None,
            use_overlap=True,
            use_distributed_dataloader=True,
-           prefetch_num = 1):
+           prefetch_num = 1,
+           running_freq : DecayedFrequency = None,
+           freq_refresh_interval = 0,
+           lookahead = 0,
+           readahead = 0):
     model.train()
     rank = torch.distributed.get_rank()
     world_size = torch.distributed.get_world_size()
 
+    # the epoch the block shuffle order is drawn for, the DataLoader workers iterate copies of the dataset
+    if hasattr(data_loader.dataset, "set_epoch"):
+        data_loader.dataset.set_epoch(epoch)
+
     if use_overlap:
         data_iter = FiniteDataIter(data_loader)
     else:
@@ -231,7 +319,23 @@ def _train(model : HybridParallelDLRM,
     labels_list = [None for i in range(prefetch_num)]
     sparse_values = [None for i in range(prefetch_num)]
 
-    print(f'prefetch_num {prefetch_num}')
+    prefetcher = None
+    if lookahead > 0:
+        prefetcher = LookaheadPrefetcher(model.sparse_modules.embed, readahead=readahead)
+        # (dense, sparse, labels) of the batches queued in the prefetcher
+        pending = deque()
+        exhausted = False
+
+    def load_batch():
+        batch = next(data_iter)
+        dense, sparse, labels = put_data_in_device(batch, model.dense_device, model.sparse_device,
+                                                   use_distributed_dataloader, rank, world_size)
+        model.sparse_modules.trace(sparse.values(), sparse.offsets(), sparse.stride())
+        if running_freq is not None:
+            running_freq.update(sparse.values())
+        return dense, [sparse.values(), sparse.offsets(), sparse.stride()], labels
+
+    print(f'prefetch_num {prefetch_num}, lookahead {lookahead}')
     for idx in meter:
         try:
             # We introduce a timer as a temporary solution to exclude interference
@@ -240,30 +344,40 @@ def _train(model : HybridParallelDLRM,
             
             start = time.time()
 
-            # trigger cache operations very prefetch num iterations.
-            # prefetch #prefetch_num batches.
-            prefetch_idx = idx % prefetch_num
-            if prefetch_idx == 0:
+            if prefetcher is not None:
+                # keep #lookahead (+ #readahead) batches queued behind the current one, preparing one new batch per
+                # iteration
                 with torch.no_grad():
-                    for i in range(prefetch_num):
-                        batch = next(data_iter)
-                        dense, sparse, labels = put_data_in_device(batch, model.dense_device, model.sparse_device,
-                                                                use_distributed_dataloader, rank, world_size)
-                        dense_list[i] = dense
-                        sparse_list[i] = [sparse.values(), sparse.offsets(), sparse.stride()]
-                        sparse_values[i] = sparse.values()
-                        labels_list[i] = labels
-
-                    
-                    with record_function("prefetch cache"):
-                        cuda_sparse_ids = model.sparse_modules.embed.cache_weight_mgr.prepare_ids(torch.cat(sparse_values))
-                        cuda_sparse_list = torch.chunk(cuda_sparse_ids, prefetch_num)
+                    while not exhausted and len(pending) <= lookahead + readahead:
+                        try:
+                            pending.append(load_batch())
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        prefetcher.put(pending[-1][1][0])
+                if not pending:
+                    raise StopIteration()
+                dense, sparse, labels = pending.popleft()
+                sparse[0] = prefetcher.get()
+            else:
+                # trigger cache operations very prefetch num iterations.
+                # prefetch #prefetch_num batches.
+                prefetch_idx = idx % prefetch_num
+                if prefetch_idx == 0:
+                    with torch.no_grad():
                         for i in range(prefetch_num):
-                            sparse_list[i][0] = cuda_sparse_list[i]
-            
-            dense = dense_list[prefetch_idx]
-            sparse = sparse_list[prefetch_idx]
-            labels = labels_list[prefetch_idx]
+                            dense_list[i], sparse_list[i], labels_list[i] = load_batch()
+                            sparse_values[i] = sparse_list[i][0]
+
+                        with record_function("prefetch cache"):
+                            cuda_sparse_ids = model.sparse_modules.embed.prepare_ids(torch.cat(sparse_values))
+                            cuda_sparse_list = torch.chunk(cuda_sparse_ids, prefetch_num)
+                            for i in range(prefetch_num):
+                                sparse_list[i][0] = cuda_sparse_list[i]
+
+                dense = dense_list[prefetch_idx]
+                sparse = sparse_list[prefetch_idx]
+                labels = labels_list[prefetch_idx]
 
             with record_function("(zhg)forward pass"):
                 logits = model(dense, sparse, cache_op = False).squeeze()
@@ -275,8 +389,20 @@ def _train(model : HybridParallelDLRM,
             with record_function("(zhg)backward pass"):
                 loss.backward()
 
+            if prefetcher is not None:
+                # the preparations of the upcoming batches write cache rows the step may update
+                prefetcher.wait_prepared()
             with record_function("(zhg)optimization"):
                 optimizer.step()
+            if prefetcher is not None:
+                prefetcher.release()
+
+            if running_freq is not None and freq_refresh_interval > 0 and (idx + 1) % freq_refresh_interval == 0:
+                with record_function("refresh eviction ranking"):
+                    if prefetcher is not None:
+                        prefetcher.call(model.sparse_modules.refresh_eviction_ranking, running_freq.snapshot())
+                    else:
+                        model.sparse_modules.refresh_eviction_ranking(running_freq.snapshot())
             time_elapse += time.time() - start
             if prof:
                 prof.step()
@@ -291,8 +417,10 @@ def _train(model : HybridParallelDLRM,
             # meter.set_postfix_str(postfix_str)
         except StopIteration:
             dist_logger.info(f"{get_mem_info('Training:  ')}, "
-                             f"{model.sparse_modules.embed.print_comm_stats_()}")
+                             f"{format_cache_stats(model.sparse_modules.embed.stats())}")
             break
+    if prefetcher is not None:
+        prefetcher.close()
     if hasattr(data_loader, "__len__"):
         dist_logger.info(f"average throughput: {len(data_loader) / time_elapse:.2f} it/s")
 
@@ -341,6 +469,7 @@ def train_val_test(
     train_dataloader,
     val_dataloader,
     test_dataloader,
+    running_freq=None,
 ):
     train_val_test_results = TrainValTestResults()
     with profile(
@@ -351,9 +480,11 @@ def train_val_test(
     ) as prof:
         for epoch in range(args.epochs):
 
-            model.sparse_modules.embed.set_cache_mgr_async_copy(args.use_cache_mgr_async_copy)
+            model.sparse_modules.embed.set_async_copy(args.use_cache_mgr_async_copy)
             _train(model, optimizer, criterion, train_dataloader, epoch, prof, args.use_overlap,
-                   args.use_distributed_dataloader, prefetch_num=args.prefetch_num)
+                   args.use_distributed_dataloader, prefetch_num=args.prefetch_num, running_freq=running_freq,
+                   freq_refresh_interval=args.freq_refresh_interval, lookahead=args.lookahead,
+                   readahead=args.readahead)
 
             if args.eval_acc:
                 val_accuracy, val_auroc = _evaluate(model, val_dataloader, "val", args.use_overlap,
@@ -391,6 +522,15 @@ def main():
     dist_logger.info(f"launch rank: {rank} / {world_size}")
     dist_logger.info(f"config: {args}", ranks=[0])
 
+    device = torch.device('cuda', torch.cuda.current_device())
+    if args.numa_policy != 'none':
+        # before the dataloaders and the model, so that their threads and host allocations follow the policy
+        set_process_numa_policy(args.numa_policy, local_numa_node(device))
+        if rank == 0:
+            # a single probe, concurrent ones on every rank would contend for the memory nodes they measure
+            dist_logger.info(f"host gather bandwidth per (cpu node, memory node):\n"
+                             f"{format_numa_bandwidth(measure_numa_bandwidth())}", ranks=[0])
+
     assigned_tables = None
     if args.use_tablewise:
         rank_arrange = None
@@ -419,9 +559,33 @@ def main():
 
     id_freq_map = None
     if args.use_freq:
-        id_freq_map = data_module.get_id_freq_map(args.dataset_dir)
+        id_freq_map = data_module.get_id_freq_map(args.dataset_dir,
+                                                  counter=args.id_freq_counter,
+                                                  sketch_capacity=args.sketch_capacity)
+
+    if args.eviction_policy is not None:
+        eviction_policy = args.eviction_policy.split(",")
+        eviction_policy = eviction_policy[0] if len(eviction_policy) == 1 else eviction_policy
+    else:
+        eviction_policy = 'lfu' if args.use_lfu else 'dataset'
+
+    policies = eviction_policy if isinstance(eviction_policy, list) else [eviction_policy]
+    model_id_freq_map = id_freq_map
+    if is_rank_space(args.dataset_dir, args.num_embeddings_per_feature) and all(p == 'dataset' for p in policies) \
+            and args.cache_budget_bytes is None:
+        # ids ranked by scripts/preprocess/remap_by_frequency.py: the dataset policy and the warmup follow the id
+        # order, without reordering the rows at startup
+        dist_logger.info("ids in frequency-rank space, the cache skips its reorder", ranks=[0])
+        model_id_freq_map = None
+
+    running_freq = None
+    if args.freq_decay is not None:
+        if any(p not in ('lfu', 'decayed_lfu') for p in policies) or \
+                (args.use_tablewise and args.cache_backend == 'colossalai'):
+            raise ValueError("--freq_decay refreshes the LFU eviction ranking, it requires the lfu or decayed_lfu "
+                             "policy and is not supported with --use_tablewise on the colossalai backend")
+        running_freq = DecayedFrequency(sum(args.num_embeddings_per_feature), decay=args.freq_decay, init=id_freq_map)
 
-    device = torch.device('cuda', torch.cuda.current_device())
     sparse_device = torch.device('cpu') if args.use_cpu else device
     model = HybridParallelDLRM(
         [args.num_embeddings]
@@ -437,14 +601,32 @@ def main():
         fused_op=args.fused_op,
         use_cache=args.use_cache,
         cache_ratio=args.cache_ratio,
-        id_freq_map=id_freq_map,
+        id_freq_map=model_id_freq_map,
         warmup_ratio=args.warmup_ratio,
         buffer_size=args.buffer_size,
         is_dist_dataloader=args.use_distributed_dataloader,
         use_lfu_eviction=args.use_lfu,
         use_tablewise=args.use_tablewise,
-        dataset=args.dataset_dir
+        dataset=args.dataset_dir,
+        cache_backend=args.cache_backend,
+        eviction_policy=eviction_policy,
+        admission_filter=args.admission_filter,
+        bypass_ratio=args.bypass_ratio,
+        numa_policy=args.numa_policy,
+        host_table_file=args.host_table_file,
+        host_cache_bytes=args.host_cache_bytes,
+        cache_dtype=args.cache_dtype,
+        host_quantization=args.host_quantization,
+        cache_budget_bytes=args.cache_budget_bytes,
+        # every table may see a full batch of unique ids, from every rank with tablewise, per pinned batch
+        min_cache_rows=args.batch_size * world_size * (args.lookahead + 1),
+        resident_rows=args.resident_rows
     )
+    if args.lookahead > 0 and (args.prefetch_num > 1 or not model.sparse_modules.embed.supports_pinning):
+        raise ValueError("--lookahead replaces --prefetch_num and requires a cache backend supporting pinning, "
+                         "e.g. --cache_backend reference")
+    if args.readahead > 0 and args.lookahead == 0:
+        raise ValueError("--readahead extends the --lookahead window, it requires --lookahead")
     dist_logger.info(f"{model.model_stats('DLRM')}", ranks=[0])
     dist_logger.info(f"{get_mem_info('After model init:  ')}", ranks=[0])
     for name, param in model.named_parameters():
@@ -452,13 +634,18 @@ def main():
 
     # TODO: a more canonical interface for optimizers.
     # currently not support ADAM
-    optimizer = torch.optim.SGD([{
+    param_groups = [{
         "params": model.sparse_modules.parameters(),
         "lr": args.learning_rate
     }, {
         "params": model.dense_modules.parameters(),
         "lr": args.learning_rate * world_size
-    }])
+    }]
+    if args.cache_dtype == 'fp32':
+        optimizer = torch.optim.SGD(param_groups)
+    else:
+        optimizer = StochasticRoundingSGD(param_groups, lr=args.learning_rate,
+                                          stochastic_rounding=not args.nearest_rounding)
     criterion = torch.nn.BCEWithLogitsLoss()
 
     if args.inspect_time:
@@ -494,7 +681,11 @@ def main():
             optimizer.step()
         exit(0)
 
-    train_val_test(args, model, optimizer, criterion, train_dataloader, val_dataloader, test_dataloader)
+    if args.record_trace is not None:
+        model.sparse_modules.start_trace(args.record_trace if world_size == 1 else f"{args.record_trace}.rank{rank}")
+    train_val_test(args, model, optimizer, criterion, train_dataloader, val_dataloader, test_dataloader,
+                   running_freq=running_freq)
+    model.sparse_modules.stop_trace()
 
 
 if __name__ == "__main__":
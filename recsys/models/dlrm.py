@@ -10,10 +10,9 @@ from typing import List
 from baselines.models.dlrm import DenseArch, OverArch, InteractionArch, choose
 from ..utils import get_time_elapsed
 from ..datasets.utils import KJTAllToAll
-from ..utils import prepare_tablewise_config
+from ..datasets.id_trace import IdTraceWriter
+from ..cache import build_cache_backend, ResidentSplitEmbeddingBag
 import colossalai
-from colossalai.nn.parallel.layers import ParallelFreqAwareEmbeddingBag, EvictionStrategy, \
-    TablewiseEmbeddingBagConfig, ParallelFreqAwareEmbeddingBagTablewise
 from colossalai.core import global_context as gpc
 from colossalai.context.parallel_mode import ParallelMode
 import numpy as np
@@ -24,7 +23,8 @@ dist_logger = colossalai.logging.get_dist_logger()
 
 
 def sparse_embedding_shape_hook(embeddings, feature_size, batch_size):
-    return embeddings.view(feature_size, batch_size, -1).transpose(0, 1)
+    # the embeddings only hold the batch shard of the rank with ResidentSplitEmbeddingBag, see its lookup
+    return embeddings.view(feature_size, -1, embeddings.shape[-1]).transpose(0, 1)
 
 def sparse_embedding_shape_hook_for_tablewise(embeddings, feature_size, batch_size):
     return embeddings.view(embeddings.shape[0], feature_size, -1)
@@ -46,40 +46,73 @@ class FusedSparseModules(nn.Module):
                  is_dist_dataloader=True,
                  use_lfu_eviction=False,
                  use_tablewise_parallel=False,
-                 dataset: str = None):
+                 dataset: str = None,
+                 cache_backend: str = 'colossalai',
+                 sparse_device=None,
+                 eviction_policy: Union[str, List[str]] = None,
+                 admission_filter: str = None,
+                 bypass_ratio: float = 0.1,
+                 numa_policy: str = 'none',
+                 host_table_file: str = None,
+                 host_cache_bytes: int = 1 << 30,
+                 cache_dtype: str = None,
+                 host_quantization: str = None,
+                 cache_budget_bytes: int = None,
+                 min_cache_rows: int = 0,
+                 resident_rows: int = 0):
         super(FusedSparseModules, self).__init__()
         self.sparse_feature_num = len(num_embeddings_per_feature)
+        if eviction_policy is None:
+            eviction_policy = 'lfu' if use_lfu_eviction else 'dataset'
         if use_cache:
-            if use_tablewise_parallel:
-                # establist config list
-                world_size = torch.distributed.get_world_size()
-                embedding_bag_config_list = prepare_tablewise_config(
-                    num_embeddings_per_feature, 0.01, id_freq_map, dataset, world_size)
-                self.embed = ParallelFreqAwareEmbeddingBagTablewise(
-                    embedding_bag_config_list,
-                    embedding_dim,
-                    sparse=sparse,
-                    mode=reduction_mode,
-                    include_last_offset=True,
-                    warmup_ratio=warmup_ratio,
-                    buffer_size=buffer_size,
-                    evict_strategy=EvictionStrategy.LFU if use_lfu_eviction else EvictionStrategy.DATASET,
-                )
-                self.shape_hook = sparse_embedding_shape_hook_for_tablewise
-            else:
-                self.embed = ParallelFreqAwareEmbeddingBag(
-                    sum(num_embeddings_per_feature),
-                    embedding_dim,
-                    sparse=sparse,
-                    mode=reduction_mode,
-                    include_last_offset=True,
-                    cache_ratio=cache_ratio,
-                    ids_freq_mapping=id_freq_map,
-                    warmup_ratio=warmup_ratio,
-                    buffer_size=buffer_size,
-                    evict_strategy=EvictionStrategy.LFU if use_lfu_eviction else EvictionStrategy.DATASET
-                )
-                self.shape_hook = sparse_embedding_shape_hook
+            # the tables of at most resident_rows rows are kept on the device next to the cache, which only sees
+            # the other tables
+            resident = [n <= resident_rows for n in num_embeddings_per_feature]
+            cached_tables = [t for t, r in enumerate(resident) if not r]
+            cached_num_embeddings = num_embeddings_per_feature
+            if any(resident):
+                if use_tablewise_parallel:
+                    raise NotImplementedError("Resident tables are only split from a feature-major cache, "
+                                              "not a tablewise one")
+                table_offsets = np.cumsum([0, *num_embeddings_per_feature])
+                cached_num_embeddings = [num_embeddings_per_feature[t] for t in cached_tables]
+                if id_freq_map is not None:
+                    id_freq_map = torch.cat([id_freq_map[table_offsets[t]:table_offsets[t + 1]]
+                                             for t in cached_tables])
+                if isinstance(eviction_policy, list):
+                    eviction_policy = [eviction_policy[t] for t in cached_tables]
+            self.embed = build_cache_backend(cache_backend,
+                                             cached_num_embeddings,
+                                             embedding_dim,
+                                             sparse=sparse,
+                                             mode=reduction_mode,
+                                             cache_ratio=cache_ratio,
+                                             id_freq_map=id_freq_map,
+                                             warmup_ratio=warmup_ratio,
+                                             buffer_size=buffer_size,
+                                             evict_strategy=eviction_policy,
+                                             tablewise=use_tablewise_parallel,
+                                             dataset=dataset,
+                                             device=sparse_device,
+                                             admission=admission_filter,
+                                             bypass_ratio=bypass_ratio,
+                                             numa_policy=numa_policy,
+                                             host_table_file=host_table_file,
+                                             host_cache_bytes=host_cache_bytes,
+                                             cache_dtype=cache_dtype,
+                                             host_quantization=host_quantization,
+                                             cache_budget_bytes=cache_budget_bytes,
+                                             min_cache_rows=min_cache_rows)
+            if any(resident):
+                self.embed = ResidentSplitEmbeddingBag(num_embeddings_per_feature,
+                                                       resident,
+                                                       self.embed,
+                                                       embedding_dim,
+                                                       mode=reduction_mode,
+                                                       sparse=sparse,
+                                                       device=sparse_device)
+            self.shape_hook = sparse_embedding_shape_hook if self.embed.feature_major_output \
+                else sparse_embedding_shape_hook_for_tablewise
         else:
             raise NotImplementedError("Other EmbeddingBags are under development")
 
@@ -88,25 +121,58 @@ class FusedSparseModules(nn.Module):
         else:
             self.kjt_collector = None
 
+        self._trace_writer = None
+
+    def start_trace(self, path: str):
+        """
+        Record the ids and offsets passed to :meth:`trace` from now on into an id trace at ``path``, see
+        ``recsys.datasets.id_trace``.
+        """
+        self.stop_trace()
+        self._trace_writer = IdTraceWriter(path)
+
+    def stop_trace(self):
+        if self._trace_writer is not None:
+            self._trace_writer.close()
+            self._trace_writer = None
+
+    def trace(self, ids: torch.Tensor, offsets: torch.Tensor, batch_size: int = None):
+        """
+        Append raw ids, before their translation into cache slots, to the trace being recorded if any. The training
+        loop calls it once per batch as loaded, before any all-to-all, :meth:`forward` never does so that evaluation
+        batches are not recorded.
+        """
+        if self._trace_writer is not None:
+            with record_function("(zhg)record id trace"):
+                self._trace_writer.append(ids, offsets, batch_size)
+
+    def refresh_eviction_ranking(self, freq: torch.Tensor):
+        """
+        Rank the cached rows for eviction by ``freq`` (indexed by id), e.g. a ``DecayedFrequency`` snapshot, so
+        the eviction follows the recent id popularity instead of the counts accumulated since warmup.
+        """
+        self.embed.refresh_eviction_ranking(freq)
+
     def forward(self, sparse_features : Union[List, KeyedJaggedTensor], cache_op: bool = True):
-        self.embed.set_cache_op(cache_op)
         if self.kjt_collector:
             with record_function("(zhg)KJT AllToAll collective"):
                 sparse_features = self.kjt_collector.all_to_all(sparse_features)
 
         if isinstance(sparse_features, list):
             batch_size = sparse_features[2]
-            flattened_sparse_embeddings = self.embed(
+            flattened_sparse_embeddings = self.embed.lookup(
                 sparse_features[0],
                 sparse_features[1],
-                shape_hook=lambda x: self.shape_hook(x, self.sparse_feature_num , batch_size), 
+                shape_hook=lambda x: self.shape_hook(x, self.sparse_feature_num , batch_size),
+                cache_op=cache_op,
                 )
         elif isinstance(sparse_features, KeyedJaggedTensor):
             batch_size = sparse_features.stride()
-            flattened_sparse_embeddings = self.embed(
+            flattened_sparse_embeddings = self.embed.lookup(
                 sparse_features.values(),
                 sparse_features.offsets(),
-                shape_hook=lambda x: self.shape_hook(x, self.sparse_feature_num , batch_size), 
+                shape_hook=lambda x: self.shape_hook(x, self.sparse_feature_num , batch_size),
+                cache_op=cache_op,
                 )
         else:
             raise TypeError
@@ -165,7 +231,19 @@ class HybridParallelDLRM(nn.Module):
                  is_dist_dataloader=True,
                  use_lfu_eviction=False,
                  use_tablewise=False,
-                 dataset: str = None):
+                 dataset: str = None,
+                 cache_backend: str = 'colossalai',
+                 eviction_policy: Union[str, List[str]] = None,
+                 admission_filter: str = None,
+                 bypass_ratio: float = 0.1,
+                 numa_policy: str = 'none',
+                 host_table_file: str = None,
+                 host_cache_bytes: int = 1 << 30,
+                 cache_dtype: str = None,
+                 host_quantization: str = None,
+                 cache_budget_bytes: int = None,
+                 min_cache_rows: int = 0,
+                 resident_rows: int = 0):
 
         super(HybridParallelDLRM, self).__init__()
         if use_cache and sparse_device.type != dense_device.type:
@@ -188,7 +266,20 @@ class HybridParallelDLRM(nn.Module):
                                                  is_dist_dataloader=is_dist_dataloader,
                                                  use_lfu_eviction=use_lfu_eviction,
                                                  use_tablewise_parallel=use_tablewise,
-                                                 dataset=dataset
+                                                 dataset=dataset,
+                                                 cache_backend=cache_backend,
+                                                 sparse_device=sparse_device,
+                                                 eviction_policy=eviction_policy,
+                                                 admission_filter=admission_filter,
+                                                 bypass_ratio=bypass_ratio,
+                                                 numa_policy=numa_policy,
+                                                 host_table_file=host_table_file,
+                                                 host_cache_bytes=host_cache_bytes,
+                                                 cache_dtype=cache_dtype,
+                                                 host_quantization=host_quantization,
+                                                 cache_budget_bytes=cache_budget_bytes,
+                                                 min_cache_rows=min_cache_rows,
+                                                 resident_rows=resident_rows
                                                  ).to(sparse_device)
         self.dense_modules = DDP(module=FusedDenseModules(embedding_dim, num_sparse_features, dense_in_features,
                                                           dense_arch_layer_sizes,
@@ -1,9 +1,13 @@
 from .misc import get_mem_info, compute_throughput, get_time_elapsed, Timer, get_partition, \
-    TrainValTestResults, count_parameters, prepare_tablewise_config, get_tablewise_rank_arrange
+    TrainValTestResults, count_parameters, prepare_tablewise_config, get_tablewise_rank_arrange, DecayedFrequency
 from .dataloader import CudaStreamDataIter, FiniteDataIter
+from .numa import NUMA_POLICIES, NumaLayout, numa_nodes, local_numa_node, bind_to_node, on_node, build_numa_layout, \
+    numa_empty, set_process_numa_policy, measure_numa_bandwidth, format_numa_bandwidth
 
 __all__ = [
     'get_mem_info', 'compute_throughput', 'get_time_elapsed', 'Timer', 'get_partition', 'CudaStreamDataIter',
     'FiniteDataIter', 'TrainValTestResults', 'count_parameters', 'prepare_tablewise_config',
-    'get_tablewise_rank_arrange'
+    'get_tablewise_rank_arrange', 'DecayedFrequency', 'NUMA_POLICIES', 'NumaLayout', 'numa_nodes', 'local_numa_node',
+    'bind_to_node', 'on_node', 'build_numa_layout', 'numa_empty', 'set_process_numa_policy', 'measure_numa_bandwidth',
+    'format_numa_bandwidth'
 ]
@@ -135,6 +135,76 @@ class Timer:
         self._elapsed = 0
 
 
+class DecayedFrequency:
+    """Exponentially-decayed running frequency of the ids seen during training.
+
+    After ``T`` calls to :meth:`update`, ``freq[i] = sum_t decay ** (T - t) * count_t(i)``. Decaying the whole
+    vector every step would cost ``O(num_embeddings)``, so the increments are scaled by ``decay ** -T``
+    instead and the float64 vector is renormalized once that scale exceeds ``_MAX_SCALE``, which keeps the
+    fresh increments within the precision of the accumulated counts.
+
+    Ids on a CUDA device are copied asynchronously to a pinned host buffer when the frequency lives on the
+    host, and only counted at the next :meth:`update` or :meth:`snapshot`, so that the training loop is not
+    synchronized with the device every iteration.
+
+    Args:
+        num_embeddings (int): number of ids tracked.
+        decay (float): per-update decay factor in (0, 1].
+        init (torch.Tensor, optional): initial frequencies, e.g. the dataset id-frequency map.
+        device (torch.device, optional): where the running frequency lives, defaults to cpu.
+    """
+
+    _MAX_SCALE = 1e6
+
+    def __init__(self, num_embeddings, decay=0.99, init=None, device=None):
+        assert 0. < decay <= 1., f"decay must be in (0, 1], got {decay}"
+        self.decay = decay
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        if init is not None:
+            self.freq = init.to(device=self.device, dtype=torch.float64)
+        else:
+            self.freq = torch.zeros(num_embeddings, dtype=torch.float64, device=self.device)
+        self._scale = 1.
+        # (pinned ids, copy event, scale) of the ids still in flight from the device
+        self._pending = None
+
+    def _count(self, ids: torch.Tensor, scale: float):
+        ids, counts = torch.unique(ids, return_counts=True)
+        self.freq.index_add_(0, ids, counts.to(torch.float64).mul_(scale))
+
+    def _flush(self):
+        if self._pending is not None:
+            ids, done, scale = self._pending
+            self._pending = None
+            done.synchronize()
+            self._count(ids, scale)
+
+    @torch.no_grad()
+    def update(self, ids: torch.Tensor):
+        """Decay every frequency once and count ``ids``.
+        """
+        self._flush()
+        self._scale /= self.decay
+        if self._scale > self._MAX_SCALE:
+            self.freq.div_(self._scale)
+            self._scale = 1.
+        if ids.is_cuda and self.device.type == 'cpu':
+            pinned = torch.empty(ids.shape, dtype=ids.dtype, pin_memory=True)
+            pinned.copy_(ids, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record()
+            self._pending = (pinned, done, self._scale)
+        else:
+            self._count(ids.to(self.device), self._scale)
+
+    @torch.no_grad()
+    def snapshot(self) -> torch.Tensor:
+        """The current decayed frequencies, in count units.
+        """
+        self._flush()
+        return self.freq / self._scale
+
+
 def get_partition(embedding_dim, rank, world_size):
     if world_size == 1:
         return 0, embedding_dim, True
@@ -158,9 +228,11 @@ def prepare_tablewise_config(num_embeddings_per_feature,
                              cache_ratio,
                              id_freq_map_total=None,
                              dataset="criteo_kaggle",
-                             world_size=2):
+                             world_size=2,
+                             cuda_row_nums=None):
     # WARNING, prototype. only support criteo_kaggle dataset and world_size == 2, 4
     # TODO: automatic arrange
+    # cuda_row_nums, the cache rows of every table, overrides cache_ratio
     embedding_bag_config_list: List[TablewiseEmbeddingBagConfig] = []
     rank_arrange = get_tablewise_rank_arrange(dataset, world_size)
     table_offsets = np.array([0, *np.cumsum(num_embeddings_per_feature)])
@@ -168,7 +240,10 @@ def prepare_tablewise_config(num_embeddings_per_feature,
         ids_freq_mapping = None
         if id_freq_map_total != None:
             ids_freq_mapping = id_freq_map_total[table_offsets[i] : table_offsets[i + 1]]
-        cuda_row_num = int(cache_ratio * num_embeddings) + 2000
+        if cuda_row_nums is not None:
+            cuda_row_num = cuda_row_nums[i]
+        else:
+            cuda_row_num = int(cache_ratio * num_embeddings) + 2000
         if cuda_row_num > num_embeddings:
             cuda_row_num = num_embeddings
         embedding_bag_config_list.append(
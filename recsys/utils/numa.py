@@ -0,0 +1,332 @@
+"""
+NUMA placement of the host-resident embedding table.
+
+Without a policy, the host table, the pinned staging buffers and the dataloader arrays land on the node of
+whichever thread first touches them, and swaps served from the far socket lose a large part of the bandwidth. The
+helpers here read the topology from sysfs, pin threads with ``sched_setaffinity``, and place memory either with
+libnuma (through ctypes, if installed) or by first touch from threads bound to the target node.
+
+Policies of a host table, see :func:`build_numa_layout`:
+
+* ``bind``: every row on the node local to the cache device.
+* ``interleave``: pages interleaved over all the nodes, the gather threads spread over the nodes.
+* ``shard``: contiguous row ranges per node, each gathered by threads bound to its node.
+"""
+import ctypes
+import ctypes.util
+import functools
+import mmap
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+SYSFS_NODE_DIR = "/sys/devices/system/node"
+NUMA_POLICIES = ('none', 'bind', 'interleave', 'shard')
+# granularity of the first-touch interleaving
+_INTERLEAVE_BYTES = 2 * 1024**2
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """
+    Parse a sysfs cpu list such as ``0-3,8,10-11``.
+    """
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+@functools.lru_cache()
+def numa_nodes() -> Dict[int, List[int]]:
+    """
+    The NUMA nodes with cpus and their cpus, restricted to the cpus this process may run on. Without NUMA
+    information, a single node 0 holds every allowed cpu.
+    """
+    allowed = set(os.sched_getaffinity(0))
+    nodes = {}
+    if os.path.isdir(SYSFS_NODE_DIR):
+        for name in sorted(os.listdir(SYSFS_NODE_DIR)):
+            if not (name.startswith("node") and name[4:].isdigit()):
+                continue
+            with open(os.path.join(SYSFS_NODE_DIR, name, "cpulist")) as f:
+                cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    return nodes or {0: sorted(allowed)}
+
+
+def device_numa_node(device: Optional[torch.device] = None) -> Optional[int]:
+    """
+    The node local to a cuda device, from the sysfs entry of its PCI device, None if unknown.
+    """
+    if device is None or device.type != 'cuda' or not torch.cuda.is_available():
+        return None
+    props = torch.cuda.get_device_properties(device)
+    if not hasattr(props, 'pci_bus_id'):
+        return None
+    bus_id = f"{getattr(props, 'pci_domain_id', 0):04x}:{props.pci_bus_id:02x}:{props.pci_device_id:02x}.0"
+    try:
+        with open(f"/sys/bus/pci/devices/{bus_id}/numa_node") as f:
+            node = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return node if node in numa_nodes() else None
+
+
+def current_numa_node() -> int:
+    """
+    The node holding most of the cpus this thread may run on.
+    """
+    allowed = os.sched_getaffinity(0)
+    counts = Counter({node: len(allowed.intersection(cpus)) for node, cpus in numa_nodes().items()})
+    return counts.most_common(1)[0][0]
+
+
+def local_numa_node(device: Optional[torch.device] = None) -> int:
+    """
+    The node local to ``device`` if known, else the node of the current thread.
+    """
+    node = device_numa_node(device)
+    return node if node is not None else current_numa_node()
+
+
+def bind_to_node(node: int) -> None:
+    """
+    Restrict the calling thread to the cpus of ``node``.
+    """
+    os.sched_setaffinity(0, numa_nodes()[node])
+
+
+@contextmanager
+def on_node(node: Optional[int]):
+    """
+    Run the block on the cpus of ``node``, so the memory it first touches is allocated there. No-op for None.
+    """
+    if node is None:
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    bind_to_node(node)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+class _LibNuma:
+    """
+    The few libnuma calls used to set memory policies.
+    """
+
+    def __init__(self, lib: ctypes.CDLL):
+        self.lib = lib
+        lib.numa_tonode_memory.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+        lib.numa_interleave_memory.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+        lib.numa_set_preferred.argtypes = [ctypes.c_int]
+        lib.numa_set_interleave_mask.argtypes = [ctypes.c_void_p]
+        self.all_nodes = ctypes.c_void_p.in_dll(lib, "numa_all_nodes_ptr").value
+
+    def tonode_memory(self, ptr: int, size: int, node: int):
+        self.lib.numa_tonode_memory(ptr, size, node)
+
+    def interleave_memory(self, ptr: int, size: int):
+        self.lib.numa_interleave_memory(ptr, size, self.all_nodes)
+
+    def set_preferred(self, node: int):
+        self.lib.numa_set_preferred(node)
+
+    def set_interleave(self):
+        self.lib.numa_set_interleave_mask(self.all_nodes)
+
+
+@functools.lru_cache()
+def libnuma() -> Optional[_LibNuma]:
+    """
+    libnuma if installed and the kernel supports NUMA, else None.
+    """
+    path = ctypes.util.find_library("numa")
+    if path is None:
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+        if lib.numa_available() < 0:
+            return None
+        return _LibNuma(lib)
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+@dataclass
+class NumaLayout:
+    """
+    Placement of a host table: rows ``row_bounds[i]:row_bounds[i + 1]`` live on ``nodes[i]`` for the ``shard``
+    policy, ``row_bounds`` is None when the rows are not owned by a single node.
+    """
+    policy: str
+    nodes: List[int]
+    local_node: int
+    row_bounds: Optional[List[int]] = None
+
+    def bind(self, node: int) -> None:
+        bind_to_node(node)
+
+    def on_local_node(self):
+        """
+        Context allocating on the local node, e.g. the pinned staging buffers.
+        """
+        return on_node(self.local_node)
+
+
+def build_numa_layout(num_rows: int, policy: str, local_node: Optional[int] = None) -> Optional[NumaLayout]:
+    """
+    The layout of a ``num_rows`` table under ``policy``, None for ``none``.
+    """
+    if policy not in NUMA_POLICIES:
+        raise ValueError(f"Unsupported NUMA policy {policy}, must be one of {' | '.join(NUMA_POLICIES)}")
+    if policy == 'none':
+        return None
+    local_node = current_numa_node() if local_node is None else local_node
+    if policy == 'bind':
+        return NumaLayout(policy, [local_node], local_node)
+    nodes = sorted(numa_nodes())
+    if policy == 'interleave':
+        return NumaLayout(policy, nodes, local_node)
+    row_bounds = [num_rows * i // len(nodes) for i in range(len(nodes) + 1)]
+    return NumaLayout(policy, nodes, local_node, row_bounds)
+
+
+def _touch(tensor: torch.Tensor, node: int, blocks: List[Tuple[int, int]]):
+    with on_node(node):
+        for lo, hi in blocks:
+            tensor[lo:hi].zero_()
+
+
+def place_rows(tensor: torch.Tensor, layout: NumaLayout) -> torch.Tensor:
+    """
+    Place the pages of a freshly allocated, untouched 2D cpu ``tensor`` according to ``layout`` and zero it.
+
+    With libnuma the memory policy of the pages is set first. Either way every node's rows are then zeroed by a
+    thread bound to that node, which places the pages by first touch when libnuma is missing.
+    """
+    num_rows = tensor.shape[0]
+    row_bytes = max(tensor[0].numel() * tensor.element_size(), 1) if num_rows > 0 else 1
+    lib = libnuma()
+    if lib is not None:
+        # mbind needs page-aligned ranges, the partial pages at both ends are placed by first touch
+        ptr = tensor.data_ptr()
+
+        def aligned(lo, hi):
+            start = -(-(ptr + lo * row_bytes) // mmap.PAGESIZE) * mmap.PAGESIZE
+            end = (ptr + hi * row_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+            return start, end - start
+
+        if layout.policy == 'interleave':
+            start, length = aligned(0, num_rows)
+            if length > 0:
+                lib.interleave_memory(start, length)
+        else:
+            bounds = layout.row_bounds or [0, num_rows]
+            for node, lo, hi in zip(layout.nodes, bounds[:-1], bounds[1:]):
+                start, length = aligned(lo, hi)
+                if length > 0:
+                    lib.tonode_memory(start, length, node)
+
+    blocks = {node: [] for node in layout.nodes}
+    if layout.policy == 'interleave':
+        step = max(_INTERLEAVE_BYTES // row_bytes, 1)
+        for i, lo in enumerate(range(0, num_rows, step)):
+            blocks[layout.nodes[i % len(layout.nodes)]].append((lo, min(lo + step, num_rows)))
+    else:
+        bounds = layout.row_bounds or [0, num_rows]
+        for node, lo, hi in zip(layout.nodes, bounds[:-1], bounds[1:]):
+            blocks[node].append((lo, hi))
+    threads = [threading.Thread(target=_touch, args=(tensor, node, node_blocks)) for node, node_blocks in
+               blocks.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return tensor
+
+
+def numa_empty(num_rows: int,
+               row_size: int,
+               dtype: torch.dtype = torch.float32,
+               policy: str = 'bind',
+               local_node: Optional[int] = None) -> Tuple[torch.Tensor, Optional[NumaLayout]]:
+    """
+    A zeroed ``(num_rows, row_size)`` cpu tensor placed by ``policy``, and its layout.
+    """
+    layout = build_numa_layout(num_rows, policy, local_node)
+    tensor = torch.empty(num_rows, row_size, dtype=dtype)
+    if layout is not None:
+        place_rows(tensor, layout)
+    return tensor, layout
+
+
+def set_process_numa_policy(policy: str, local_node: Optional[int] = None) -> None:
+    """
+    Apply ``policy`` to the calling thread and the threads and allocations it creates afterwards: ``bind`` keeps
+    them on the local node, ``interleave`` interleaves the new allocations over the nodes (libnuma only). ``shard``
+    places a single table and leaves the process alone.
+    """
+    if policy not in NUMA_POLICIES:
+        raise ValueError(f"Unsupported NUMA policy {policy}, must be one of {' | '.join(NUMA_POLICIES)}")
+    lib = libnuma()
+    if policy == 'bind':
+        node = current_numa_node() if local_node is None else local_node
+        bind_to_node(node)
+        if lib is not None:
+            lib.set_preferred(node)
+    elif policy == 'interleave' and lib is not None:
+        lib.set_interleave()
+
+
+def _gather_bandwidth(table: torch.Tensor, rows: torch.Tensor, out: torch.Tensor, repeat: int) -> float:
+    torch.index_select(table, 0, rows, out=out)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        torch.index_select(table, 0, rows, out=out)
+    return out.numel() * out.element_size() * repeat / (time.perf_counter() - start) / 1e9
+
+
+def measure_numa_bandwidth(num_rows: int = 1 << 20,
+                           embedding_dim: int = 128,
+                           batch_rows: int = 65536,
+                           repeat: int = 5) -> Dict[Tuple[int, int], float]:
+    """
+    Random row gather bandwidth in GB/s from a ``num_rows`` table on every memory node, by a thread on every cpu
+    node, keyed by ``(cpu node, memory node)``.
+    """
+    nodes = sorted(numa_nodes())
+    rows = torch.randint(0, num_rows, (batch_rows,))
+    result = {}
+    for memory_node in nodes:
+        table, _ = numa_empty(num_rows, embedding_dim, policy='bind', local_node=memory_node)
+        for cpu_node in nodes:
+            with on_node(cpu_node):
+                out = torch.empty(batch_rows, embedding_dim)
+                result[(cpu_node, memory_node)] = _gather_bandwidth(table, rows, out, repeat)
+        del table
+    return result
+
+
+def format_numa_bandwidth(bandwidth: Dict[Tuple[int, int], float]) -> str:
+    nodes = sorted({node for pair in bandwidth for node in pair})
+    lines = ["row gather GB/s, cpu node (rows) x memory node (columns):",
+             "      " + "".join(f"{node:>9}" for node in nodes)]
+    for cpu_node in nodes:
+        lines.append(f"{cpu_node:>6}" + "".join(f"{bandwidth[(cpu_node, node)]:9.2f}" for node in nodes))
+    return "\n".join(lines)
@@ -0,0 +1,47 @@
+#!/bin/bash
+
+# Compares the AUROC of the reference cache backend caching fp32, fp16 and bf16 embedding rows on criteo kaggle.
+# The reduced-precision runs double the cache ratio, to hold the same cache footprint in bytes.
+export DATAPATH=/data/scratch/RecSys/criteo_kaggle_data/
+export GPUNUM=1
+export BATCHSIZE=16384
+export CACHERATIO=0.01
+
+set_n_least_used_CUDA_VISIBLE_DEVICES() {
+    local n=${1:-"9999"}
+    echo "GPU Memory Usage:"
+    local FIRST_N_GPU_IDS=$(nvidia-smi --query-gpu=memory.used --format=csv \
+        | tail -n +2 \
+        | nl -v 0 \
+        | tee /dev/tty \
+        | sort -g -k 2 \
+        | awk '{print $1}' \
+        | head -n $n)
+    export CUDA_VISIBLE_DEVICES=$(echo $FIRST_N_GPU_IDS | sed 's/ /,/g')
+    echo "Now CUDA_VISIBLE_DEVICES is set to:"
+    echo "CUDA_VISIBLE_DEVICES=$CUDA_VISIBLE_DEVICES"
+}
+
+
+mkdir -p colo_logs
+for CACHE_DTYPE in fp32 fp16 bf16
+do
+if [[ ${CACHE_DTYPE} == fp32 ]];  then
+DTYPE_CACHERATIO=${CACHERATIO}
+else
+DTYPE_CACHERATIO=$(echo "${CACHERATIO} * 2" | bc -l)
+fi
+set_n_least_used_CUDA_VISIBLE_DEVICES ${GPUNUM}
+
+TASK_NAME="gpu_${GPUNUM}_bs_${BATCHSIZE}_cache_${DTYPE_CACHERATIO}_dtype_${CACHE_DTYPE}"
+torchx run -s local_cwd -cfg log_dir=log/kaggle/${TASK_NAME} dist.ddp -j 1x${GPUNUM} --script recsys/dlrm_main.py -- \
+    --dataset_dir ${DATAPATH} --pin_memory --shuffle_batches \
+    --learning_rate 1. --batch_size ${BATCHSIZE} --use_sparse_embed_grad --use_cache --use_freq --use_lfu --eval_acc \
+    --cache_backend reference --cache_dtype ${CACHE_DTYPE} \
+    --buffer_size 0 --cache_ratio ${DTYPE_CACHERATIO} 2>&1 | tee colo_logs/colo_${TASK_NAME}.txt
+done
+
+for CACHE_DTYPE in fp32 fp16 bf16
+do
+echo "${CACHE_DTYPE}: $(grep -h "AUROC over test set" colo_logs/colo_gpu_${GPUNUM}_bs_${BATCHSIZE}_cache_*_dtype_${CACHE_DTYPE}.txt | tail -n 1)"
+done
@@ -0,0 +1,46 @@
+#!/bin/bash
+
+# Compares the AUROC, the swap traffic and the host table memory of the reference cache backend over an fp32, int8
+# and int4 row-wise quantized host table on criteo kaggle, at the same cache ratio. The quantized rows are swapped in
+# and out packed, and converted on the device.
+export DATAPATH=/data/scratch/RecSys/criteo_kaggle_data/
+export GPUNUM=1
+export BATCHSIZE=16384
+export CACHERATIO=0.01
+
+set_n_least_used_CUDA_VISIBLE_DEVICES() {
+    local n=${1:-"9999"}
+    echo "GPU Memory Usage:"
+    local FIRST_N_GPU_IDS=$(nvidia-smi --query-gpu=memory.used --format=csv \
+        | tail -n +2 \
+        | nl -v 0 \
+        | tee /dev/tty \
+        | sort -g -k 2 \
+        | awk '{print $1}' \
+        | head -n $n)
+    export CUDA_VISIBLE_DEVICES=$(echo $FIRST_N_GPU_IDS | sed 's/ /,/g')
+    echo "Now CUDA_VISIBLE_DEVICES is set to:"
+    echo "CUDA_VISIBLE_DEVICES=$CUDA_VISIBLE_DEVICES"
+}
+
+
+mkdir -p colo_logs
+for HOST_QUANTIZATION in none int8 int4
+do
+set_n_least_used_CUDA_VISIBLE_DEVICES ${GPUNUM}
+
+TASK_NAME="gpu_${GPUNUM}_bs_${BATCHSIZE}_cache_${CACHERATIO}_host_${HOST_QUANTIZATION}"
+torchx run -s local_cwd -cfg log_dir=log/kaggle/${TASK_NAME} dist.ddp -j 1x${GPUNUM} --script recsys/dlrm_main.py -- \
+    --dataset_dir ${DATAPATH} --pin_memory --shuffle_batches \
+    --learning_rate 1. --batch_size ${BATCHSIZE} --use_sparse_embed_grad --use_cache --use_freq --use_lfu --eval_acc \
+    --cache_backend reference --host_quantization ${HOST_QUANTIZATION} \
+    --buffer_size 0 --cache_ratio ${CACHERATIO} 2>&1 | tee colo_logs/colo_${TASK_NAME}.txt
+done
+
+for HOST_QUANTIZATION in none int8 int4
+do
+LOG=colo_logs/colo_gpu_${GPUNUM}_bs_${BATCHSIZE}_cache_${CACHERATIO}_host_${HOST_QUANTIZATION}.txt
+echo "${HOST_QUANTIZATION}: $(grep -h "AUROC over test set" ${LOG} | tail -n 1)"
+echo "${HOST_QUANTIZATION}: $(grep -ho "swap in: [0-9,]* rows / [0-9.]* GB, swap out: [0-9,]* rows / [0-9.]* GB" ${LOG} | tail -n 1)"
+echo "${HOST_QUANTIZATION}: $(grep -ho "quantized host table: [^)]*)" ${LOG} | tail -n 1)"
+done
@@ -0,0 +1,72 @@
+# This script rewrites the sparse ids of a preprocessed Criteo Kaggle dataset feature-major.
+#
+# The row-major [N, 26] sparse npy files are rewritten as [26, N] int64 files, the ids of every feature contiguous,
+# hashed into the table sizes and offset by table: the KeyedJaggedTensor layout, so recsys.datasets.criteo
+# FeatureMajorCriteoIterDataPipe memory-maps them and copies the ids of a batch once, without hashing nor
+# transposing them. The id-frequency map of the input dir is written next to them.
+#
+# Usage (from the repository root):
+#       PYTHONPATH=. python scripts/preprocess/feature_major_criteo.py --input_dir <kaggle_npy_dir> \
+#           --output_dir <feature_major_kaggle_npy_dir>
+#
+# The dense and labels files are symlinked, not copied. The output dir must keep "kaggle" in its path for the
+# dataloaders to recognize it, and training must use the same --num_embeddings_per_feature.
+
+import argparse
+import os
+import sys
+from typing import List
+
+import numpy as np
+
+from recsys.datasets.criteo import FEATURE_MAJOR_SPARSE_SUFFIX, KAGGLE_NUM_EMBEDDINGS_PER_FEATURE, get_id_freq_map
+from recsys.datasets.freq_map import save_id_freq_map
+
+
+def to_feature_major(in_file: str, out_file: str, hash_sizes: List[int], chunk_rows: int):
+    sparse = np.load(in_file, mmap_mode='r')
+    hashes = np.array(hash_sizes, dtype=np.int64).reshape(1, -1)
+    offsets = np.array([0, *np.cumsum(hash_sizes)[:-1]], dtype=np.int64).reshape(1, -1)
+    out = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.int64, shape=sparse.shape[::-1])
+    for start in range(0, sparse.shape[0], chunk_rows):
+        ids = sparse[start:start + chunk_rows].astype(np.int64)
+        ids %= hashes
+        ids += offsets
+        out[:, start:start + chunk_rows] = ids.T
+    out.flush()
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Rewrite Criteo Kaggle sparse ids feature-major.")
+    parser.add_argument("--input_dir", type=str, required=True,
+                        help="kaggle npy dir (day_*_{dense,sparse,labels}.npy)")
+    parser.add_argument("--output_dir", type=str, required=True, help="output dir")
+    parser.add_argument("--num_embeddings_per_feature", type=str, default=KAGGLE_NUM_EMBEDDINGS_PER_FEATURE,
+                        help="comma separated table sizes the ids are hashed into")
+    parser.add_argument("--chunk_rows", type=int, default=1 << 22, help="npy rows rewritten at a time")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> None:
+    args = parse_args(argv)
+    hash_sizes = list(map(int, args.num_embeddings_per_feature.split(",")))
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for f in sorted(os.listdir(args.input_dir)):
+        in_file = os.path.join(args.input_dir, f)
+        if f.endswith("_sparse.npy"):
+            out_file = os.path.join(args.output_dir, f[:-len("_sparse.npy")] + FEATURE_MAJOR_SPARSE_SUFFIX)
+            print(f"Rewriting {in_file} to {out_file}...")
+            to_feature_major(in_file, out_file, hash_sizes, args.chunk_rows)
+        elif ('dense' in f or 'labels' in f) and f.endswith(".npy"):
+            out_file = os.path.join(args.output_dir, f)
+            if not os.path.exists(out_file):
+                os.symlink(os.path.abspath(in_file), out_file)
+
+    print(f"Counting the ids of {args.input_dir}...")
+    save_id_freq_map(os.path.join(args.output_dir, "id_freq_map.bin"), get_id_freq_map(args.input_dir), hash_sizes)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+# This script rewrites the sparse ids of a preprocessed Criteo dataset into frequency-rank space.
+#
+# The ids of every table are renumbered by decreasing frequency in the training files, see recsys.datasets.id_remap:
+# the hot rows become physically contiguous and the dataset eviction policy no longer needs the id-frequency map,
+# so the cache skips its startup reorder. The inverse permutation is stored as id_remap.npz in the output dir, to
+# map trained tables back to the original ids, and the id-frequency map is written in rank space next to it.
+#
+# Usage (from the repository root):
+#       PYTHONPATH=. python scripts/preprocess/remap_by_frequency.py --input_dir <kaggle_npy_dir> \
+#           --output_dir <ranked_kaggle_npy_dir>
+#       PYTHONPATH=. python scripts/preprocess/remap_by_frequency.py --input_dir <terabyte_parquet_dir> \
+#           --output_dir <ranked_terabyte_parquet_dir>
+#
+# The kaggle dense and labels files are symlinked, not copied. The output dir must keep "kaggle" in its path for the
+# dataloaders to recognize it, and training must use the same --num_embeddings_per_feature.
+
+import argparse
+import glob
+import os
+import sys
+from typing import List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from torchrec.datasets.criteo import DEFAULT_CAT_NAMES
+
+from recsys.datasets.criteo import get_id_freq_map, KAGGLE_NUM_EMBEDDINGS_PER_FEATURE, NUM_EMBEDDINGS_PER_FEATURE
+from recsys.datasets.freq_map import save_id_freq_map
+from recsys.datasets.id_remap import ID_REMAP_FILE, frequency_ranks, rank_lookup, ranked_id_freq_map, remap_sparse, \
+    save_id_remap
+
+
+def remap_npy(in_file: str, out_file: str, forward: List[np.ndarray], hash_sizes: List[int], chunk_rows: int):
+    sparse = np.load(in_file, mmap_mode='r')
+    out = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.int32, shape=sparse.shape)
+    for start in range(0, sparse.shape[0], chunk_rows):
+        remap_sparse(sparse[start:start + chunk_rows], forward, hash_sizes, out=out[start:start + chunk_rows])
+    out.flush()
+
+
+def remap_parquet(in_file: str, out_file: str, forward: List[np.ndarray]):
+    # the terabyte parquet ids are already hashed into the table sizes
+    parquet_file = pq.ParquetFile(in_file)
+    with pq.ParquetWriter(out_file, parquet_file.schema_arrow) as writer:
+        for row_group in range(parquet_file.metadata.num_row_groups):
+            table = parquet_file.read_row_group(row_group)
+            for t, name in enumerate(DEFAULT_CAT_NAMES):
+                column = table.column(name)
+                ranks = pa.array(np.take(forward[t], column.to_numpy()), type=column.type)
+                table = table.set_column(table.schema.get_field_index(name), name, ranks)
+            writer.write_table(table)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Rewrite Criteo sparse ids into frequency-rank space.")
+    parser.add_argument("--input_dir", type=str, required=True,
+                        help="kaggle npy dir (day_*_{dense,sparse,labels}.npy) or terabyte parquet dir "
+                        "({train,validation,test}/part_*.parquet)")
+    parser.add_argument("--output_dir", type=str, required=True, help="output dir, in the same layout")
+    parser.add_argument("--num_embeddings_per_feature", type=str, default=None,
+                        help="comma separated table sizes, the dataset defaults if not given")
+    parser.add_argument("--counter", type=str, default='exact', choices=['exact', 'sketch', 'incremental'],
+                        help="id-frequency counter, see recsys.datasets.feature_counter")
+    parser.add_argument("--chunk_rows", type=int, default=1 << 22, help="npy rows remapped at a time")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> None:
+    args = parse_args(argv)
+    kaggle = 'kaggle' in args.input_dir
+    if args.num_embeddings_per_feature is None:
+        args.num_embeddings_per_feature = KAGGLE_NUM_EMBEDDINGS_PER_FEATURE if kaggle else NUM_EMBEDDINGS_PER_FEATURE
+    hash_sizes = list(map(int, args.num_embeddings_per_feature.split(",")))
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    print(f"Counting the ids of {args.input_dir}...")
+    id_freq_map = get_id_freq_map(args.input_dir, counter=args.counter)
+    inverse = frequency_ranks(id_freq_map, hash_sizes)
+    forward = rank_lookup(inverse)
+
+    if kaggle:
+        for f in sorted(os.listdir(args.input_dir)):
+            in_file, out_file = os.path.join(args.input_dir, f), os.path.join(args.output_dir, f)
+            if 'sparse' in f and f.endswith(".npy"):
+                print(f"Remapping {in_file} to {out_file}...")
+                remap_npy(in_file, out_file, forward, hash_sizes, args.chunk_rows)
+            elif ('dense' in f or 'labels' in f) and f.endswith(".npy") and not os.path.exists(out_file):
+                os.symlink(os.path.abspath(in_file), out_file)
+    else:
+        for split in ("train", "validation", "test"):
+            os.makedirs(os.path.join(args.output_dir, split), exist_ok=True)
+            for in_file in sorted(glob.glob(os.path.join(args.input_dir, split, "*.parquet"))):
+                out_file = os.path.join(args.output_dir, split, os.path.basename(in_file))
+                print(f"Remapping {in_file} to {out_file}...")
+                remap_parquet(in_file, out_file, forward)
+
+    save_id_freq_map(os.path.join(args.output_dir, "id_freq_map.bin"), ranked_id_freq_map(id_freq_map, inverse),
+                     hash_sizes)
+    save_id_remap(os.path.join(args.output_dir, ID_REMAP_FILE), inverse)
+    print(f"Done, the inverse permutation is in {os.path.join(args.output_dir, ID_REMAP_FILE)}.")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])